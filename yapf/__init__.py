@@ -35,6 +35,7 @@ import sys
 from yapf.yapflib import errors
 from yapf.yapflib import file_resources
 from yapf.yapflib import py3compat
+from yapf.yapflib import pytree_utils
 from yapf.yapflib import style
 from yapf.yapflib import yapf_api
 
@@ -113,6 +114,49 @@ def main(argv):
       '--no-local-style',
       action='store_true',
       help="don't search for local style definition")
+  parser.add_argument(
+      '--search-beam-width',
+      metavar='K',
+      type=int,
+      default=None,
+      help=('keep only the K cheapest formatting states for each token of a '
+            'line, bounding the time spent on very long lines; overrides the '
+            'search_beam_width style setting'))
+  parser.add_argument(
+      '--line-time-limit',
+      metavar='SECONDS',
+      type=float,
+      default=None,
+      help=('stop searching for the formatting of a line after SECONDS and '
+            'finish it greedily; overrides the search_line_time_limit style '
+            'setting'))
+  parser.add_argument(
+      '--file-time-limit',
+      metavar='SECONDS',
+      type=float,
+      default=None,
+      help=('format the rest of a file greedily once its lines have been '
+            'searched for SECONDS; overrides the search_file_time_limit style '
+            'setting'))
+  parser.add_argument(
+      '--target-version',
+      choices=pytree_utils.TARGET_VERSIONS,
+      default=None,
+      help=('parse the code with the grammar of this Python version only, '
+            'instead of picking one for each file'))
+  parser.add_argument(
+      '--cache-dir',
+      metavar='DIR',
+      default=None,
+      help=('cache the parsed and annotated code in DIR so that formatting '
+            'unchanged code again is faster'))
+  parser.add_argument(
+      '--report-slow-lines',
+      metavar='MS',
+      type=float,
+      default=None,
+      help=('print the search counters of lines that took at least MS '
+            'milliseconds to format'))
   parser.add_argument('--verify', action='store_true', help=argparse.SUPPRESS)
   parser.add_argument(
       '-p',
@@ -174,13 +218,21 @@ def main(argv):
       style_config = file_resources.GetDefaultStyleForDir(os.getcwd())
 
     source = [line.rstrip() for line in original_source]
-    reformatted_source, _ = yapf_api.FormatCode(
+    result = yapf_api.FormatCode(
         py3compat.unicode('\n'.join(source) + '\n'),
         filename='<stdin>',
         style_config=style_config,
         lines=lines,
-        verify=args.verify)
-    file_resources.WriteReformattedCode('<stdout>', reformatted_source)
+        verify=args.verify,
+        search_beam_width=args.search_beam_width,
+        logger=logging.warning,
+        collect_line_stats=args.report_slow_lines is not None,
+        line_time_limit=args.line_time_limit,
+        file_time_limit=args.file_time_limit,
+        target_version=args.target_version,
+        cache_dir=args.cache_dir)
+    file_resources.WriteReformattedCode('<stdout>', result.reformatted_source)
+    _ReportSlowLines('<stdin>', result.line_stats, args.report_slow_lines)
     return 0
 
   files = file_resources.GetCommandLineFiles(args.files, args.recursive,
@@ -197,7 +249,13 @@ def main(argv):
       print_diff=args.diff,
       verify=args.verify,
       parallel=args.parallel,
-      verbose=args.verbose)
+      verbose=args.verbose,
+      search_beam_width=args.search_beam_width,
+      report_slow_lines=args.report_slow_lines,
+      line_time_limit=args.line_time_limit,
+      file_time_limit=args.file_time_limit,
+      target_version=args.target_version,
+      cache_dir=args.cache_dir)
   return 1 if changed and args.diff else 0
 
 
@@ -209,7 +267,13 @@ def FormatFiles(filenames,
                 print_diff=False,
                 verify=False,
                 parallel=False,
-                verbose=False):
+                verbose=False,
+                search_beam_width=None,
+                report_slow_lines=None,
+                line_time_limit=None,
+                file_time_limit=None,
+                target_version=None,
+                cache_dir=None):
   """Format a list of files.
 
   Arguments:
@@ -227,6 +291,18 @@ def FormatFiles(filenames,
     verify: (bool) True if reformatted code should be verified for syntax.
     parallel: (bool) True if should format multiple files in parallel.
     verbose: (bool) True if should print out filenames while processing.
+    search_beam_width: (int) If not None, the maximum number of formatting
+      states considered for each token. Overrides the style setting.
+    report_slow_lines: (float) If not None, print the search counters of the
+      lines that took at least this many milliseconds to format.
+    line_time_limit: (float) If not None, the number of seconds the formatting
+      search of a line may take. Overrides the style setting.
+    file_time_limit: (float) If not None, the number of seconds the formatting
+      searches of a file may take. Overrides the style setting.
+    target_version: (string) If not None, the Python version whose grammar the
+      files are parsed with. See pytree_utils.TARGET_VERSIONS.
+    cache_dir: (unicode) If not None, the directory to cache the parsed files
+      in.
 
   Returns:
     True if the source code changed in any of the files being formatted.
@@ -239,15 +315,19 @@ def FormatFiles(filenames,
     with concurrent.futures.ProcessPoolExecutor(workers) as executor:
       future_formats = [
           executor.submit(_FormatFile, filename, lines, style_config,
-                          no_local_style, in_place, print_diff, verify, verbose)
+                          no_local_style, in_place, print_diff, verify, verbose,
+                          search_beam_width, report_slow_lines, line_time_limit,
+                          file_time_limit, target_version, cache_dir)
           for filename in filenames
       ]
       for future in concurrent.futures.as_completed(future_formats):
         changed |= future.result()
   else:
     for filename in filenames:
-      changed |= _FormatFile(filename, lines, style_config, no_local_style,
-                             in_place, print_diff, verify, verbose)
+      changed |= _FormatFile(
+          filename, lines, style_config, no_local_style, in_place, print_diff,
+          verify, verbose, search_beam_width, report_slow_lines,
+          line_time_limit, file_time_limit, target_version, cache_dir)
   return changed
 
 
@@ -258,30 +338,57 @@ def _FormatFile(filename,
                 in_place=False,
                 print_diff=False,
                 verify=False,
-                verbose=False):
+                verbose=False,
+                search_beam_width=None,
+                report_slow_lines=None,
+                line_time_limit=None,
+                file_time_limit=None,
+                target_version=None,
+                cache_dir=None):
   if verbose:
     print('Reformatting %s' % filename)
   if style_config is None and not no_local_style:
     style_config = file_resources.GetDefaultStyleForDir(
         os.path.dirname(filename))
   try:
-    reformatted_code, encoding, has_change = yapf_api.FormatFile(
+    result = yapf_api.FormatFile(
         filename,
         in_place=in_place,
         style_config=style_config,
         lines=lines,
         print_diff=print_diff,
         verify=verify,
-        logger=logging.warning)
+        search_beam_width=search_beam_width,
+        logger=logging.warning,
+        collect_line_stats=report_slow_lines is not None,
+        line_time_limit=line_time_limit,
+        file_time_limit=file_time_limit,
+        target_version=target_version,
+        cache_dir=cache_dir)
+    reformatted_code, encoding, has_change = result
     if not in_place and reformatted_code:
       file_resources.WriteReformattedCode(filename, reformatted_code, encoding,
                                           in_place)
+    _ReportSlowLines(filename, result.line_stats, report_slow_lines)
     return has_change
   except SyntaxError as e:
     e.filename = filename
     raise
 
 
+def _ReportSlowLines(filename, line_stats, threshold):
+  """Print the search counters of the lines that took at least threshold ms."""
+  for stats in line_stats or []:
+    if stats.seconds * 1000 >= threshold:
+      timed_out = ', timed out' if stats.timed_out else ''
+      fell_back = ', fell back' if stats.fell_back else ''
+      sys.stderr.write(
+          '{0}:{1}: {2:.1f} ms, {3} pushed, {4} popped, {5} seen, peak queue '
+          '{6}{7}{8}\n'.format(filename, stats.lineno, stats.seconds * 1000,
+                               stats.pushed, stats.popped, stats.seen_hits,
+                               stats.peak_queue_size, timed_out, fell_back))
+
+
 def _GetLines(line_strings):
   """Parses the start and end lines from a line string like 'start-end'.
 
@@ -17,6 +17,7 @@ Calculates how many blank lines we need between classes, functions, and other
 entities at the same level.
 
   CalculateBlankLines(): the main function exported by this module.
+  BlankLineCalculator: the pass that CalculateBlankLines() runs.
 
 Annotations:
   newlines: The number of newlines required before the node.
@@ -49,12 +50,16 @@ def CalculateBlankLines(tree):
   Arguments:
     tree: the top-level pytree node to annotate with subtypes.
   """
-  blank_line_calculator = _BlankLineCalculator()
-  blank_line_calculator.Visit(tree)
+  pytree_visitor.RunPasses(tree, [BlankLineCalculator()])
 
 
-class _BlankLineCalculator(pytree_visitor.PyTreeVisitor):
-  """_BlankLineCalculator - see file-level docstring for a description."""
+class BlankLineCalculator(pytree_visitor.PyTreePass):
+  """BlankLineCalculator - see file-level docstring for a description."""
+
+  NAME = 'blank_line_calculator'
+  # The comments before a class or function definition are spliced into the
+  # definition's node after it's entered.
+  RUNS_AFTER_WALK = ('comment_splicer',)
 
   def __init__(self):
     self.class_level = 0
@@ -63,32 +68,36 @@ class _BlankLineCalculator(pytree_visitor.PyTreeVisitor):
     self.last_was_decorator = False
     self.last_was_class_or_function = False
 
-  def Visit_simple_stmt(self, node):  # pylint: disable=invalid-name
-    self.DefaultNodeVisit(node)
+  def Enter_simple_stmt(self, node):  # pylint: disable=invalid-name
+    self.DefaultNodeEnter(node)
+
+  def Leave_simple_stmt(self, node):  # pylint: disable=invalid-name
     if pytree_utils.NodeName(node.children[0]) == 'COMMENT':
       self.last_comment_lineno = node.children[0].lineno
 
-  def Visit_decorator(self, node):  # pylint: disable=invalid-name
+  def Enter_decorator(self, node):  # pylint: disable=invalid-name
     if (self.last_comment_lineno and
         self.last_comment_lineno == node.children[0].lineno - 1):
       self._SetNumNewlines(node.children[0], _NO_BLANK_LINES)
     else:
       self._SetNumNewlines(node.children[0], self._GetNumNewlines(node))
-    for child in node.children:
-      self.Visit(child)
+
+  def Leave_decorator(self, node):  # pylint: disable=invalid-name
     self.last_was_decorator = True
 
-  def Visit_classdef(self, node):  # pylint: disable=invalid-name
+  def Enter_classdef(self, node):  # pylint: disable=invalid-name
     self.last_was_class_or_function = False
     index = self._SetBlankLinesBetweenCommentAndClassFunc(node)
     self.last_was_decorator = False
     self.class_level += 1
-    for child in node.children[index:]:
-      self.Visit(child)
+    for child in node.children[:index]:
+      self.Skip(child)
+
+  def Leave_classdef(self, node):  # pylint: disable=invalid-name
     self.class_level -= 1
     self.last_was_class_or_function = True
 
-  def Visit_funcdef(self, node):  # pylint: disable=invalid-name
+  def Enter_funcdef(self, node):  # pylint: disable=invalid-name
     self.last_was_class_or_function = False
     index = self._SetBlankLinesBetweenCommentAndClassFunc(node)
     if _AsyncFunction(node):
@@ -99,32 +108,33 @@ class _BlankLineCalculator(pytree_visitor.PyTreeVisitor):
       index = self._SetBlankLinesBetweenCommentAndClassFunc(node)
     self.last_was_decorator = False
     self.function_level += 1
-    for child in node.children[index:]:
-      self.Visit(child)
+    for child in node.children[:index]:
+      self.Skip(child)
+
+  def Leave_funcdef(self, node):  # pylint: disable=invalid-name
     self.function_level -= 1
     self.last_was_class_or_function = True
 
-  def DefaultNodeVisit(self, node):
-    """Override the default visitor for Node.
+  def DefaultNodeEnter(self, node):
+    """Override the default hook for entering a Node.
 
     This will set the blank lines required if the last entity was a class or
     function.
 
     Arguments:
-      node: (pytree.Node) The node to visit.
+      node: (pytree.Node) The node being entered.
     """
     if self.last_was_class_or_function:
       if pytree_utils.NodeName(node) in _PYTHON_STATEMENTS:
         leaf = _GetFirstChildLeaf(node)
         self._SetNumNewlines(leaf, self._GetNumNewlines(leaf))
     self.last_was_class_or_function = False
-    super(_BlankLineCalculator, self).DefaultNodeVisit(node)
 
   def _SetBlankLinesBetweenCommentAndClassFunc(self, node):
     """Set the number of blanks between a comment and class or func definition.
 
     Class and function definitions have leading comments as children of the
-    classdef and functdef nodes.
+    classdef and functdef nodes. The caller skips them.
 
     Arguments:
       node: (pytree.Node) The classdef or funcdef node.
@@ -136,7 +146,6 @@ class _BlankLineCalculator(pytree_visitor.PyTreeVisitor):
     while pytree_utils.IsCommentStatement(node.children[index]):
       # Standalone comments are wrapped in a simple_stmt node with the comment
       # node as its only child.
-      self.Visit(node.children[index].children[0])
       if not self.last_was_decorator:
         self._SetNumNewlines(node.children[index].children[0], _ONE_BLANK_LINE)
       index += 1
@@ -178,6 +187,6 @@ def _AsyncFunction(node):
 
 
 def _GetFirstChildLeaf(node):
-  if isinstance(node, pytree.Leaf):
-    return node
-  return _GetFirstChildLeaf(node.children[0])
+  while not isinstance(node, pytree.Leaf):
+    node = node.children[0]
+  return node
@@ -19,6 +19,7 @@ functionality to splice comments out of prefixes and into nodes of their own,
 making them easier to process.
 
   SpliceComments(): the main function exported by this module.
+  CommentSplicer: the pass that SpliceComments() runs.
 """
 
 from lib2to3 import pygram
@@ -26,6 +27,7 @@ from lib2to3 import pytree
 from lib2to3.pgen2 import token
 
 from yapf.yapflib import pytree_utils
+from yapf.yapflib import pytree_visitor
 
 
 def SpliceComments(tree):
@@ -38,158 +40,226 @@ def SpliceComments(tree):
     tree: a pytree.Node - the tree to work on. The tree is modified by this
         function.
   """
-  # The previous leaf node encountered in the traversal.
-  # This is a list because Python 2.x doesn't have 'nonlocal' :)
-  prev_leaf = [None]
-  _AnnotateIndents(tree)
-
-  def _VisitNodeRec(node):
-    # This loop may insert into node.children, so we'll iterate over a copy.
-    for child in node.children[:]:
-      if isinstance(child, pytree.Node):
-        # Nodes don't have prefixes.
-        _VisitNodeRec(child)
-      else:
-        if child.prefix.lstrip().startswith('#'):
-          # We have a comment prefix in this child, so splicing is needed.
-          comment_prefix = child.prefix
-          comment_lineno = child.lineno - comment_prefix.count('\n')
-          comment_column = child.column
-
-          # Remember the leading indentation of this prefix and clear it.
-          # Mopping up the prefix is important because we may go over this same
-          # child in the next iteration...
-          child_prefix = child.prefix.lstrip('\n')
-          prefix_indent = child_prefix[:child_prefix.find('#')]
-          if '\n' in prefix_indent:
-            prefix_indent = prefix_indent[prefix_indent.rfind('\n') + 1:]
-          child.prefix = ''
-
-          if child.type == token.NEWLINE:
-            # If the prefix was on a NEWLINE leaf, it's part of the line so it
-            # will be inserted after the previously encountered leaf.
-            # We can't just insert it before the NEWLINE node, because as a
-            # result of the way pytrees are organized, this node can be under
-            # an inappropriate parent.
-            comment_column -= len(comment_prefix.lstrip())
-            pytree_utils.InsertNodesAfter(
-                _CreateCommentsFromPrefix(
-                    comment_prefix,
-                    comment_lineno,
-                    comment_column,
-                    standalone=False), prev_leaf[0])
-          elif child.type == token.DEDENT:
-            # Comment prefixes on DEDENT nodes also deserve special treatment,
-            # because their final placement depends on their prefix.
-            # We'll look for an ancestor of this child with a matching
-            # indentation, and insert the comment before it if the ancestor is
-            # on a DEDENT node and after it otherwise.
-            #
-            # lib2to3 places comments that should be separated into the same
-            # DEDENT node. For example, "comment 1" and "comment 2" will be
-            # combined.
-            #
-            #   def _():
-            #     for x in y:
-            #       pass
-            #       # comment 1
-            #
-            #     # comment 2
-            #     pass
-            #
-            # In this case, we need to split them up ourselves.
-
-            # Split into groups of comments at decreasing levels of indentation
-            comment_groups = []
-            comment_column = None
-            for cmt in comment_prefix.split('\n'):
-              col = cmt.find('#')
-              if col < 0:
-                if comment_column is None:
-                  # Skip empty lines at the top of the first comment group
-                  comment_lineno += 1
-                  continue
-              elif comment_column is None or col < comment_column:
-                comment_column = col
-                comment_indent = cmt[:comment_column]
-                comment_groups.append((comment_column, comment_indent, []))
-              comment_groups[-1][-1].append(cmt)
-
-            # Insert a node for each group
-            for comment_column, comment_indent, comment_group in comment_groups:
-              ancestor_at_indent = _FindAncestorAtIndent(child, comment_indent)
-              if ancestor_at_indent.type == token.DEDENT:
-                InsertNodes = pytree_utils.InsertNodesBefore  # pylint: disable=invalid-name
-              else:
-                InsertNodes = pytree_utils.InsertNodesAfter  # pylint: disable=invalid-name
-              InsertNodes(
-                  _CreateCommentsFromPrefix(
-                      '\n'.join(comment_group) + '\n',
-                      comment_lineno,
-                      comment_column,
-                      standalone=True), ancestor_at_indent)
-              comment_lineno += len(comment_group)
-          else:
-            # Otherwise there are two cases.
-            #
-            # 1. The comment is on its own line
-            # 2. The comment is part of an expression.
-            #
-            # Unfortunately, it's fairly difficult to distinguish between the
-            # two in lib2to3 trees. The algorithm here is to determine whether
-            # child is the first leaf in the statement it belongs to. If it is,
-            # then the comment (which is a prefix) belongs on a separate line.
-            # If it is not, it means the comment is buried deep in the statement
-            # and is part of some expression.
-            stmt_parent = _FindStmtParent(child)
-
-            for leaf_in_parent in stmt_parent.leaves():
-              if leaf_in_parent.type == token.NEWLINE:
-                continue
-              elif id(leaf_in_parent) == id(child):
-                # This comment stands on its own line, and it has to be inserted
-                # into the appropriate parent. We'll have to find a suitable
-                # parent to insert into. See comments above
-                # _STANDALONE_LINE_NODES for more details.
-                node_with_line_parent = _FindNodeWithStandaloneLineParent(child)
-                pytree_utils.InsertNodesBefore(
-                    _CreateCommentsFromPrefix(
-                        comment_prefix, comment_lineno, 0, standalone=True),
-                    node_with_line_parent)
-                break
-              else:
-                if comment_lineno == prev_leaf[0].lineno:
-                  comment_lines = comment_prefix.splitlines()
-                  value = comment_lines[0].lstrip()
-                  if value.rstrip('\n'):
-                    comment_column = prev_leaf[0].column
-                    comment_column += len(prev_leaf[0].value)
-                    comment_column += (
-                        len(comment_lines[0]) - len(comment_lines[0].lstrip()))
-                    comment_leaf = pytree.Leaf(
-                        type=token.COMMENT,
-                        value=value.rstrip('\n'),
-                        context=('', (comment_lineno, comment_column)))
-                    pytree_utils.InsertNodesAfter([comment_leaf], prev_leaf[0])
-                    comment_prefix = '\n'.join(comment_lines[1:])
-                    comment_lineno += 1
-
-                rindex = (0 if '\n' not in comment_prefix.rstrip() else
-                          comment_prefix.rstrip().rindex('\n') + 1)
-                comment_column = (
-                    len(comment_prefix[rindex:]) -
-                    len(comment_prefix[rindex:].lstrip()))
-                comments = _CreateCommentsFromPrefix(
-                    comment_prefix,
-                    comment_lineno,
-                    comment_column,
-                    standalone=False)
-                pytree_utils.InsertNodesBefore(comments, child)
-                break
-
-        prev_leaf[0] = child
-
-  _VisitNodeRec(tree)
+  pytree_visitor.RunPasses(tree, [CommentSplicer()])
+
+
+class CommentSplicer(pytree_visitor.PyTreePass):
+  """Splices comments out of the prefixes of leaves into nodes.
+
+  A node's child_indent annotation is set when the node is entered, so the
+  annotations of a leaf's ancestors are there when its comments are spliced.
+
+  The comment nodes are collected during the walk and inserted when it's over,
+  with a single rebuild of the children of each parent they go into. Where they
+  end up is the same as if each had been inserted when it was found.
+  """
+
+  NAME = 'comment_splicer'
+
+  def __init__(self):
+    # The previous leaf node encountered in the traversal.
+    self._prev_leaf = None
+    # The comment nodes to insert, as (parent, nodes before, nodes after) by
+    # the id() of the parent. The nodes before and after a child are lists
+    # keyed by the id() of the child.
+    self._insertions = {}
+    # The results of _FindAncestorAtIndent() for the children of a node, by
+    # the id() of the node and the indentation.
+    self._ancestors_at_indent = {}
+
+  def DefaultNodeEnter(self, node):
+    _AnnotateIndent(node)
+
+  def DefaultLeafEnter(self, leaf):
+    if leaf.prefix.lstrip().startswith('#'):
+      # We have a comment prefix in this leaf, so splicing is needed.
+      self._SpliceComments(leaf)
+    self._prev_leaf = leaf
+
+  def Finish(self):
+    for parent, nodes_before, nodes_after in self._insertions.values():
+      children = []
+      for child in parent.children:
+        if id(child) in nodes_before:
+          children.extend(nodes_before.pop(id(child)))
+        children.append(child)
+        if id(child) in nodes_after:
+          children.extend(nodes_after.pop(id(child)))
+      if nodes_before or nodes_after:
+        raise RuntimeError('unable to find insertion point for target node',
+                           (parent,))
+      for child in children:
+        child.parent = parent
+      parent.children[:] = children
+      if hasattr(parent, 'invalidate_sibling_maps'):
+        # Some versions of lib2to3 cache the siblings.
+        parent.invalidate_sibling_maps()
+    self._insertions.clear()
+    self._ancestors_at_indent.clear()
+
+  def _InsertNodes(self, new_nodes, target, after=False):
+    """Insert the nodes before or after the target when the walk is over.
+
+    Arguments:
+      new_nodes: (list of pytree.Base) The nodes to insert, which aren't in the
+        tree.
+      target: (pytree.Base) The node to insert them next to.
+      after: (bool) Whether to insert them after the target rather than before.
+
+    Raises:
+      RuntimeError: if the target isn't in a tree.
+    """
+    parent = target.parent
+    if parent is None:
+      raise RuntimeError('expected target node to have a parent', (target,))
+    if id(parent) not in self._insertions:
+      self._insertions[id(parent)] = (parent, {}, {})
+    _, nodes_before, nodes_after = self._insertions[id(parent)]
+    if after:
+      # Nodes inserted after the target later go before the earlier ones.
+      nodes_after[id(target)] = new_nodes + nodes_after.get(id(target), [])
+    else:
+      nodes_before.setdefault(id(target), []).extend(new_nodes)
+
+  def _FindAncestorAtIndent(self, leaf, indent):
+    """Like _FindAncestorAtIndent(), with the lookups above the leaf reused."""
+    key = (id(leaf.parent), indent)
+    if key not in self._ancestors_at_indent:
+      ancestor = _FindAncestorAtIndent(leaf, indent)
+      # The leaf itself is found by any of its siblings.
+      self._ancestors_at_indent[key] = None if ancestor is leaf else ancestor
+    return self._ancestors_at_indent[key] or leaf
+
+  def _SpliceComments(self, leaf):
+    """Splice the comments out of the leaf's prefix."""
+    comment_prefix = leaf.prefix
+    comment_lineno = leaf.lineno - comment_prefix.count('\n')
+    comment_column = leaf.column
+
+    # Remember the leading indentation of this prefix and clear it.
+    # Mopping up the prefix is important because we may go over this same
+    # leaf in the next iteration...
+    child_prefix = leaf.prefix.lstrip('\n')
+    prefix_indent = child_prefix[:child_prefix.find('#')]
+    if '\n' in prefix_indent:
+      prefix_indent = prefix_indent[prefix_indent.rfind('\n') + 1:]
+    leaf.prefix = ''
+
+    if leaf.type == token.NEWLINE:
+      # If the prefix was on a NEWLINE leaf, it's part of the line so it
+      # will be inserted after the previously encountered leaf.
+      # We can't just insert it before the NEWLINE node, because as a
+      # result of the way pytrees are organized, this node can be under
+      # an inappropriate parent.
+      comment_column -= len(comment_prefix.lstrip())
+      self._InsertNodes(
+          _CreateCommentsFromPrefix(
+              comment_prefix, comment_lineno, comment_column, standalone=False),
+          self._prev_leaf,
+          after=True)
+    elif leaf.type == token.DEDENT:
+      # Comment prefixes on DEDENT nodes also deserve special treatment,
+      # because their final placement depends on their prefix.
+      # We'll look for an ancestor of this leaf with a matching
+      # indentation, and insert the comment before it if the ancestor is
+      # on a DEDENT node and after it otherwise.
+      #
+      # lib2to3 places comments that should be separated into the same
+      # DEDENT node. For example, "comment 1" and "comment 2" will be
+      # combined.
+      #
+      #   def _():
+      #     for x in y:
+      #       pass
+      #       # comment 1
+      #
+      #     # comment 2
+      #     pass
+      #
+      # In this case, we need to split them up ourselves.
+
+      # Split into groups of comments at decreasing levels of indentation
+      comment_groups = []
+      comment_column = None
+      for cmt in comment_prefix.split('\n'):
+        col = cmt.find('#')
+        if col < 0:
+          if comment_column is None:
+            # Skip empty lines at the top of the first comment group
+            comment_lineno += 1
+            continue
+        elif comment_column is None or col < comment_column:
+          comment_column = col
+          comment_indent = cmt[:comment_column]
+          comment_groups.append((comment_column, comment_indent, []))
+        comment_groups[-1][-1].append(cmt)
+
+      # Insert a node for each group
+      for comment_column, comment_indent, comment_group in comment_groups:
+        ancestor_at_indent = self._FindAncestorAtIndent(leaf, comment_indent)
+        self._InsertNodes(
+            _CreateCommentsFromPrefix(
+                '\n'.join(comment_group) + '\n',
+                comment_lineno,
+                comment_column,
+                standalone=True),
+            ancestor_at_indent,
+            after=ancestor_at_indent.type != token.DEDENT)
+        comment_lineno += len(comment_group)
+    else:
+      # Otherwise there are two cases.
+      #
+      # 1. The comment is on its own line
+      # 2. The comment is part of an expression.
+      #
+      # Unfortunately, it's fairly difficult to distinguish between the
+      # two in lib2to3 trees. The algorithm here is to determine whether
+      # leaf is the first leaf in the statement it belongs to. If it is,
+      # then the comment (which is a prefix) belongs on a separate line.
+      # If it is not, it means the comment is buried deep in the statement
+      # and is part of some expression.
+      stmt_parent = _FindStmtParent(leaf)
+
+      for leaf_in_parent in pytree_utils.IterLeaves(stmt_parent):
+        if leaf_in_parent.type == token.NEWLINE:
+          continue
+        elif id(leaf_in_parent) == id(leaf):
+          # This comment stands on its own line, and it has to be inserted
+          # into the appropriate parent. We'll have to find a suitable
+          # parent to insert into. See comments above
+          # _STANDALONE_LINE_NODES for more details.
+          node_with_line_parent = _FindNodeWithStandaloneLineParent(leaf)
+          self._InsertNodes(
+              _CreateCommentsFromPrefix(
+                  comment_prefix, comment_lineno, 0, standalone=True),
+              node_with_line_parent)
+          break
+        else:
+          if comment_lineno == self._prev_leaf.lineno:
+            comment_lines = comment_prefix.splitlines()
+            value = comment_lines[0].lstrip()
+            if value.rstrip('\n'):
+              comment_column = self._prev_leaf.column
+              comment_column += len(self._prev_leaf.value)
+              comment_column += (
+                  len(comment_lines[0]) - len(comment_lines[0].lstrip()))
+              comment_leaf = pytree.Leaf(
+                  type=token.COMMENT,
+                  value=value.rstrip('\n'),
+                  context=('', (comment_lineno, comment_column)))
+              self._InsertNodes([comment_leaf], self._prev_leaf, after=True)
+              comment_prefix = '\n'.join(comment_lines[1:])
+              comment_lineno += 1
+
+          rindex = (0 if '\n' not in comment_prefix.rstrip() else
+                    comment_prefix.rstrip().rindex('\n') + 1)
+          comment_column = (
+              len(comment_prefix[rindex:]) -
+              len(comment_prefix[rindex:].lstrip()))
+          comments = _CreateCommentsFromPrefix(
+              comment_prefix, comment_lineno, comment_column, standalone=False)
+          self._InsertNodes(comments, leaf)
+          break
 
 
 def _CreateCommentsFromPrefix(comment_prefix,
@@ -268,12 +338,11 @@ def _FindNodeWithStandaloneLineParent(node):
   Returns:
     Suitable node that's either the node itself or one of its ancestors.
   """
-  if pytree_utils.NodeName(node.parent) in _STANDALONE_LINE_NODES:
-    return node
-  else:
-    # This is guaranteed to terminate because 'file_input' is the root node of
-    # any pytree.
-    return _FindNodeWithStandaloneLineParent(node.parent)
+  # This is guaranteed to terminate because 'file_input' is the root node of any
+  # pytree.
+  while pytree_utils.NodeName(node.parent) not in _STANDALONE_LINE_NODES:
+    node = node.parent
+  return node
 
 
 # "Statement nodes" are standalone statements. The don't have to start a new
@@ -290,10 +359,9 @@ def _FindStmtParent(node):
   Returns:
     Nearest parent (or node itself, if suitable).
   """
-  if pytree_utils.NodeName(node) in _STATEMENT_NODES:
-    return node
-  else:
-    return _FindStmtParent(node.parent)
+  while pytree_utils.NodeName(node) not in _STATEMENT_NODES:
+    node = node.parent
+  return node
 
 
 def _FindAncestorAtIndent(node, indent):
@@ -302,53 +370,51 @@ def _FindAncestorAtIndent(node, indent):
   Arguments:
     node: node to start from. This must not be the tree root.
     indent: indentation string for the ancestor we're looking for.
-        See _AnnotateIndents for more details.
+        See _AnnotateIndent for more details.
 
   Returns:
     An ancestor node with suitable indentation. If no suitable ancestor is
     found, the closest ancestor to the tree root is returned.
   """
-  if node.parent.parent is None:
-    # Our parent is the tree root, so there's nowhere else to go.
-    return node
-
-  # If the parent has an indent annotation, and it's shorter than node's
-  # indent, this is a suitable ancestor.
-  # The reason for "shorter" rather than "equal" is that comments may be
-  # improperly indented (i.e. by three spaces, where surrounding statements
-  # have either zero or two or four), and we don't want to propagate them all
-  # the way to the root.
-  parent_indent = pytree_utils.GetNodeAnnotation(
-      node.parent, pytree_utils.Annotation.CHILD_INDENT)
-  if parent_indent is not None and indent.startswith(parent_indent):
-    return node
-  else:
+  while node.parent.parent is not None:
+    # If the parent has an indent annotation, and it's shorter than node's
+    # indent, this is a suitable ancestor.
+    # The reason for "shorter" rather than "equal" is that comments may be
+    # improperly indented (i.e. by three spaces, where surrounding statements
+    # have either zero or two or four), and we don't want to propagate them all
+    # the way to the root.
+    parent_indent = pytree_utils.GetNodeAnnotation(
+        node.parent, pytree_utils.Annotation.CHILD_INDENT)
+    if parent_indent is not None and indent.startswith(parent_indent):
+      return node
     # Keep looking up the tree.
-    return _FindAncestorAtIndent(node.parent, indent)
+    node = node.parent
+
+  # Our parent is the tree root, so there's nowhere else to go.
+  return node
 
 
-def _AnnotateIndents(tree):
-  """Annotate the tree with child_indent annotations.
+def _AnnotateIndent(node):
+  """Annotate the node with a child_indent annotation.
 
   A child_indent annotation on a node specifies the indentation (as a string,
   like "  ") of its children. It is inferred from the INDENT child of a node.
 
   Arguments:
-    tree: root of a pytree. The pytree is modified to add annotations to nodes.
+    node: a node of a pytree. The node is modified to add the annotation.
 
   Raises:
     RuntimeError: if the tree is malformed.
   """
   # Annotate the root of the tree with zero indent.
-  if tree.parent is None:
-    pytree_utils.SetNodeAnnotation(tree, pytree_utils.Annotation.CHILD_INDENT,
+  if node.parent is None:
+    pytree_utils.SetNodeAnnotation(node, pytree_utils.Annotation.CHILD_INDENT,
                                    '')
-  for child in tree.children:
+  for child in node.children:
     if child.type == token.INDENT:
       child_indent = pytree_utils.GetNodeAnnotation(
-          tree, pytree_utils.Annotation.CHILD_INDENT)
+          node, pytree_utils.Annotation.CHILD_INDENT)
       if child_indent is not None and child_indent != child.value:
-        raise RuntimeError('inconsistent indentation for child', (tree, child))
-      pytree_utils.SetNodeAnnotation(tree, pytree_utils.Annotation.CHILD_INDENT,
+        raise RuntimeError('inconsistent indentation for child', (node, child))
+      pytree_utils.SetNodeAnnotation(node, pytree_utils.Annotation.CHILD_INDENT,
                                      child.value)
-    _AnnotateIndents(child)
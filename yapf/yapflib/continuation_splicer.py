@@ -17,11 +17,13 @@ The "backslash-newline" continuation marker is shoved into the node's prefix.
 Pull them out and make it into nodes of their own.
 
   SpliceContinuations(): the main function exported by this module.
+  ContinuationSplicer: the pass that SpliceContinuations() runs.
 """
 
 from lib2to3 import pytree
 
 from yapf.yapflib import format_token
+from yapf.yapflib import pytree_visitor
 
 
 def SpliceContinuations(tree):
@@ -31,22 +33,43 @@ def SpliceContinuations(tree):
     tree: (pytree.Node) The tree to work on. The tree is modified by this
       function.
   """
+  pytree_visitor.RunPasses(tree, [ContinuationSplicer()])
 
-  def RecSplicer(node):
-    """Inserts a continuation marker into the node."""
-    if isinstance(node, pytree.Leaf):
-      if node.prefix.lstrip().startswith('\\\n'):
-        new_lineno = node.lineno - node.prefix.count('\n')
-        return pytree.Leaf(
-            type=format_token.CONTINUATION,
-            value=node.prefix,
-            context=('', (new_lineno, 0)))
-      return None
-    num_inserted = 0
-    for index, child in enumerate(node.children[:]):
-      continuation_node = RecSplicer(child)
-      if continuation_node:
-        node.children.insert(index + num_inserted, continuation_node)
-        num_inserted += 1
-
-  RecSplicer(tree)
+
+class ContinuationSplicer(pytree_visitor.PyTreePass):
+  """Inserts continuation markers before the leaves with them in the prefix.
+
+  The markers are collected during the walk and inserted when it's over, with
+  a single rebuild of the children of each parent they go into.
+  """
+
+  NAME = 'continuation_splicer'
+  RUNS_AFTER = ('comment_splicer',)
+
+  def __init__(self):
+    # The parents of the leaves with markers, and the markers keyed by the id()
+    # of the leaf they go before, by the id() of the parent.
+    self._continuations = {}
+
+  def DefaultLeafEnter(self, leaf):
+    prefix = leaf.prefix
+    if '\\' in prefix and prefix.lstrip().startswith('\\\n'):
+      new_lineno = leaf.lineno - prefix.count('\n')
+      continuation_node = pytree.Leaf(
+          type=format_token.CONTINUATION,
+          value=prefix,
+          context=('', (new_lineno, 0)))
+      parent = leaf.parent
+      if id(parent) not in self._continuations:
+        self._continuations[id(parent)] = (parent, {})
+      self._continuations[id(parent)][1][id(leaf)] = continuation_node
+
+  def Finish(self):
+    for parent, continuations in self._continuations.values():
+      children = []
+      for child in parent.children:
+        if id(child) in continuations:
+          children.append(continuations[id(child)])
+        children.append(child)
+      parent.children[:] = children
+    self._continuations.clear()
@@ -18,7 +18,9 @@ decisions are made. A graph of potential whitespace formattings is created,
 where each node in the graph is a format decision state object. The heuristic
 tries formatting the token with and without a newline before it to determine
 which one has the least penalty. Therefore, the format decision state object for
-each decision needs to be its own unique copy.
+each decision needs to be its own unique copy. To keep copying cheap, the
+bracket and comprehension stacks are persistent: their frames are immutable and
+a copy shares every frame it doesn't change with the state it was copied from.
 
 Once the heuristic determines the best formatting, it makes a non-dry run pass
 through the code to commit the whitespace formatting.
@@ -30,13 +32,14 @@ from yapf.yapflib import format_token
 from yapf.yapflib import object_state
 from yapf.yapflib import split_penalty
 from yapf.yapflib import style
-from yapf.yapflib import unwrapped_line
 
 
 class FormatDecisionState(object):
   """The current state when indenting an unwrapped line.
 
   The FormatDecisionState object is meant to be copied instead of referenced.
+  Copies share the (immutable) frames of the parenthesis and comprehension
+  stacks, so they must never be modified in place.
 
   Attributes:
     first_indent: The indent of the first token.
@@ -47,14 +50,21 @@ class FormatDecisionState(object):
     newline: Indicates if a newline is added along the edge to this format
       decision state node.
     previous: The previous format decision state in the decision tree.
-    stack: A stack (of _ParenState) keeping track of properties applying to
-      parenthesis levels.
-    comp_stack: A stack (of ComprehensionState) keeping track of properties
-      applying to comprehensions.
+    stack: A persistent stack (of _ParenState) keeping track of properties
+      applying to parenthesis levels.
+    comp_stack: A persistent stack (of ComprehensionState) keeping track of
+      properties applying to comprehensions, or None if it's empty.
     ignore_stack_for_comparison: Ignore the stack of _ParenState for state
       comparison.
+    style: The style.Style the line is formatted with.
+    split_table: The _SplitTable for the line, shared by all states.
   """
 
+  __slots__ = ('next_token', 'column', 'line', 'paren_level',
+               'lowest_level_on_line', 'ignore_stack_for_comparison', 'stack',
+               'comp_stack', 'first_indent', 'newline', 'previous',
+               'column_limit', 'style', 'split_table')
+
   def __init__(self, line, first_indent):
     """Initializer.
 
@@ -71,28 +81,36 @@ class FormatDecisionState(object):
     self.paren_level = 0
     self.lowest_level_on_line = 0
     self.ignore_stack_for_comparison = False
-    self.stack = [_ParenState(first_indent, first_indent)]
-    self.comp_stack = []
+    self.stack = _FrameStack(_ParenState(first_indent, first_indent))
+    self.comp_stack = None
     self.first_indent = first_indent
     self.newline = False
     self.previous = None
-    self.column_limit = style.Get('COLUMN_LIMIT')
+    self.style = style.Current()
+    self.column_limit = self.style.COLUMN_LIMIT
+    self.split_table = _SplitTable(line)
 
   def Clone(self):
-    """Clones a FormatDecisionState object."""
-    new = FormatDecisionState(self.line, self.first_indent)
+    """Clones a FormatDecisionState object.
+
+    The clone shares the stacks' frames with this state. This is safe because
+    frames are never modified in place.
+    """
+    new = FormatDecisionState.__new__(FormatDecisionState)
     new.next_token = self.next_token
     new.column = self.column
     new.line = self.line
     new.paren_level = self.paren_level
-    new.line.depth = self.line.depth
     new.lowest_level_on_line = self.lowest_level_on_line
     new.ignore_stack_for_comparison = self.ignore_stack_for_comparison
+    new.stack = self.stack
+    new.comp_stack = self.comp_stack
     new.first_indent = self.first_indent
     new.newline = self.newline
     new.previous = self.previous
-    new.stack = [state.Clone() for state in self.stack]
-    new.comp_stack = [state.Clone() for state in self.comp_stack]
+    new.column_limit = self.column_limit
+    new.style = self.style
+    new.split_table = self.split_table
     return new
 
   def __eq__(self, other):
@@ -129,339 +147,20 @@ class FormatDecisionState(object):
     Returns:
       True if the line can be split before the next token.
     """
-    current = self.next_token
-    previous = current.previous_token
-
-    if current.is_pseudo_paren:
-      return False
-
-    if (not must_split and
-        format_token.Subtype.DICTIONARY_KEY_PART in current.subtypes and
-        format_token.Subtype.DICTIONARY_KEY not in current.subtypes and
-        not style.Get('ALLOW_MULTILINE_DICTIONARY_KEYS')):
-      # In some situations, a dictionary may be multiline, but pylint doesn't
-      # like it. So don't allow it unless forced to.
-      return False
-
-    if (not must_split and
-        format_token.Subtype.DICTIONARY_VALUE in current.subtypes and
-        not style.Get('ALLOW_SPLIT_BEFORE_DICT_VALUE')):
-      return False
-
-    if previous and previous.value == '(' and current.value == ')':
-      # Don't split an empty function call list if we aren't splitting before
-      # dict values.
-      token = previous.previous_token
-      while token:
-        prev = token.previous_token
-        if not prev or prev.name not in {'NAME', 'DOT'}:
-          break
-        token = token.previous_token
-      if token and format_token.Subtype.DICTIONARY_VALUE in token.subtypes:
-        if not style.Get('ALLOW_SPLIT_BEFORE_DICT_VALUE'):
-          return False
-
-    return current.can_break_before
+    return self.split_table.CanSplit(self.next_token, must_split)
 
   def MustSplit(self):
-    """Returns True if the line must split before the next token."""
-    current = self.next_token
-    previous = current.previous_token
-
-    if current.is_pseudo_paren:
-      return False
-
-    if current.must_break_before:
-      return True
-
-    if not previous:
-      return False
-
-    if (self.stack[-1].split_before_closing_bracket and
-        current.value in '}]' and style.Get('SPLIT_BEFORE_CLOSING_BRACKET')):
-      # Split before the closing bracket if we can.
-      return current.node_split_penalty != split_penalty.UNBREAKABLE
-
-    if (current.value == ')' and previous.value == ',' and
-        not _IsSingleElementTuple(current.matching_bracket)):
-      return True
-
-    # Prevent splitting before the first argument in compound statements
-    # with the exception of function declarations.
-    if (style.Get('SPLIT_BEFORE_FIRST_ARGUMENT') and
-        _IsCompoundStatement(self.line.first) and
-        not _IsFunctionDef(self.line.first)):
-      return False
-
-    ###########################################################################
-    # List Splitting
-    if (style.Get('DEDENT_CLOSING_BRACKETS') or
-        style.Get('SPLIT_BEFORE_FIRST_ARGUMENT')):
-      bracket = current if current.ClosesScope() else previous
-      if format_token.Subtype.SUBSCRIPT_BRACKET not in bracket.subtypes:
-        if bracket.OpensScope():
-          if style.Get('COALESCE_BRACKETS'):
-            if current.OpensScope():
-              # Prefer to keep all opening brackets together.
-              return False
-
-          if (not _IsLastScopeInLine(bracket) or
-              unwrapped_line.IsSurroundedByBrackets(bracket)):
-            last_token = bracket.matching_bracket
-          else:
-            last_token = _LastTokenInLine(bracket.matching_bracket)
-
-          if not self._FitsOnLine(bracket, last_token):
-            # Split before the first element if the whole list can't fit on a
-            # single line.
-            self.stack[-1].split_before_closing_bracket = True
-            return True
-
-        elif style.Get('DEDENT_CLOSING_BRACKETS') and current.ClosesScope():
-          # Split before and dedent the closing bracket.
-          return self.stack[-1].split_before_closing_bracket
-
-    if (style.Get('SPLIT_BEFORE_EXPRESSION_AFTER_OPENING_PAREN') and
-        current.is_name):
-      # An expression that's surrounded by parens gets split after the opening
-      # parenthesis.
-      def SurroundedByParens(token):
-        """Check if it's an expression surrounded by parentheses."""
-        while token:
-          if token.value == ',':
-            return False
-          if token.value == ')':
-            return not token.next_token
-          if token.OpensScope():
-            token = token.matching_bracket.next_token
-          else:
-            token = token.next_token
-        return False
-
-      if (previous.value == '(' and not previous.is_pseudo_paren and
-          not unwrapped_line.IsSurroundedByBrackets(previous)):
-        pptoken = previous.previous_token
-        if (pptoken and not pptoken.is_name and not pptoken.is_keyword and
-            SurroundedByParens(current)):
-          return True
-
-    if (current.is_name or current.is_string) and previous.value == ',':
-      # If the list has function calls in it and the full list itself cannot
-      # fit on the line, then we want to split. Otherwise, we'll get something
-      # like this:
-      #
-      #     X = [
-      #         Bar(xxx='some string',
-      #             yyy='another long string',
-      #             zzz='a third long string'), Bar(
-      #                 xxx='some string',
-      #                 yyy='another long string',
-      #                 zzz='a third long string')
-      #     ]
-      #
-      # or when a string formatting syntax.
-      func_call_or_string_format = False
-      tok = current.next_token
-      if current.is_name:
-        while tok and (tok.is_name or tok.value == '.'):
-          tok = tok.next_token
-        func_call_or_string_format = tok and tok.value == '('
-      elif current.is_string:
-        while tok and tok.is_string:
-          tok = tok.next_token
-        func_call_or_string_format = tok and tok.value == '%'
-      if func_call_or_string_format:
-        open_bracket = unwrapped_line.IsSurroundedByBrackets(current)
-        if open_bracket:
-          if open_bracket.value in '[{':
-            if not self._FitsOnLine(open_bracket,
-                                    open_bracket.matching_bracket):
-              return True
-          elif tok.value == '(':
-            if not self._FitsOnLine(current, tok.matching_bracket):
-              return True
-
-    ###########################################################################
-    # Dict/Set Splitting
-    if (style.Get('EACH_DICT_ENTRY_ON_SEPARATE_LINE') and
-        format_token.Subtype.DICTIONARY_KEY in current.subtypes and
-        not current.is_comment):
-      # Place each dictionary entry onto its own line.
-      if previous.value == '{' and previous.previous_token:
-        opening = _GetOpeningBracket(previous.previous_token)
-        if (opening and opening.value == '(' and opening.previous_token and
-            opening.previous_token.is_name):
-          # This is a dictionary that's an argument to a function.
-          if (self._FitsOnLine(previous, previous.matching_bracket) and
-              previous.matching_bracket.next_token and
-              (not opening.matching_bracket.next_token or
-               opening.matching_bracket.next_token.value != '.') and
-              _ScopeHasNoCommas(previous)):
-            # Don't split before the key if:
-            #   - The dictionary fits on a line, and
-            #   - The function call isn't part of a builder-style call and
-            #   - The dictionary has one entry and no trailing comma
-            return False
-      return True
-
-    if (style.Get('SPLIT_BEFORE_DICT_SET_GENERATOR') and
-        format_token.Subtype.DICT_SET_GENERATOR in current.subtypes):
-      # Split before a dict/set generator.
-      return True
-
-    if (format_token.Subtype.DICTIONARY_VALUE in current.subtypes or
-        (previous.is_pseudo_paren and previous.value == '(' and
-         not current.is_comment)):
-      # Split before the dictionary value if we can't fit every dictionary
-      # entry on its own line.
-      if not current.OpensScope():
-        opening = _GetOpeningBracket(current)
-        if not self._EachDictEntryFitsOnOneLine(opening):
-          return style.Get('ALLOW_SPLIT_BEFORE_DICT_VALUE')
-
-    if previous.value == '{':
-      # Split if the dict/set cannot fit on one line and ends in a comma.
-      closing = previous.matching_bracket
-      if (not self._FitsOnLine(previous, closing) and
-          closing.previous_token.value == ','):
-        self.stack[-1].split_before_closing_bracket = True
-        return True
-
-    ###########################################################################
-    # Argument List Splitting
-    if (style.Get('SPLIT_BEFORE_NAMED_ASSIGNS') and not current.is_comment and
-        format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN_ARG_LIST in
-        current.subtypes):
-      if (previous.value not in {'=', ':', '*', '**'} and
-          current.value not in ':=,)' and not _IsFunctionDefinition(previous)):
-        # If we're going to split the lines because of named arguments, then we
-        # want to split after the opening bracket as well. But not when this is
-        # part of a function definition.
-        if previous.value == '(':
-          # Make sure we don't split after the opening bracket if the
-          # continuation indent is greater than the opening bracket:
-          #
-          #  a(
-          #      b=1,
-          #      c=2)
-          if (self._FitsOnLine(previous, previous.matching_bracket) and
-              unwrapped_line.IsSurroundedByBrackets(previous)):
-            # An argument to a function is a function call with named
-            # assigns.
-            return False
-
-          column = self.column - self.stack[-1].last_space
-          return column > style.Get('CONTINUATION_INDENT_WIDTH')
-
-        opening = _GetOpeningBracket(current)
-        if opening:
-          arglist_length = (
-              opening.matching_bracket.total_length - opening.total_length +
-              self.stack[-1].indent)
-          return arglist_length > self.column_limit
-
-    if (current.value not in '{)' and previous.value == '(' and
-        self._ArgumentListHasDictionaryEntry(current)):
-      return True
-
-    if style.Get('SPLIT_ARGUMENTS_WHEN_COMMA_TERMINATED'):
-      # Split before arguments in a function call or definition if the
-      # arguments are terminated by a comma.
-      opening = _GetOpeningBracket(current)
-      if opening and opening.previous_token and opening.previous_token.is_name:
-        if previous.value in '(,':
-          if opening.matching_bracket.previous_token.value == ',':
-            return True
-
-    if ((current.is_name or current.value in {'*', '**'}) and
-        previous.value == ','):
-      # If we have a function call within an argument list and it won't fit on
-      # the remaining line, but it will fit on a line by itself, then go ahead
-      # and split before the call.
-      opening = _GetOpeningBracket(current)
-      if (opening and opening.value == '(' and opening.previous_token and
-          (opening.previous_token.is_name or
-           opening.previous_token.value in {'*', '**'})):
-        is_func_call = False
-        opening = current
-        while opening:
-          if opening.value == '(':
-            is_func_call = True
-            break
-          if (not (opening.is_name or opening.value in {'*', '**'}) and
-              opening.value != '.'):
-            break
-          opening = opening.next_token
-
-        if is_func_call:
-          if (not self._FitsOnLine(current, opening.matching_bracket) or
-              (opening.matching_bracket.next_token and
-               opening.matching_bracket.next_token.value != ',' and
-               not opening.matching_bracket.next_token.ClosesScope())):
-            return True
-
-    pprevious = previous.previous_token
-    if (current.is_name and pprevious and pprevious.is_name and
-        previous.value == '('):
-      if (not self._FitsOnLine(previous, previous.matching_bracket) and
-          _IsFunctionCallWithArguments(current)):
-        # There is a function call, with more than 1 argument, where the first
-        # argument is itself a function call with arguments.  In this specific
-        # case, if we split after the first argument's opening '(', then the
-        # formatting will look bad for the rest of the arguments. E.g.:
-        #
-        #     outer_function_call(inner_function_call(
-        #         inner_arg1, inner_arg2),
-        #                         outer_arg1, outer_arg2)
-        #
-        # Instead, enforce a split before that argument to keep things looking
-        # good.
-        return True
-
-    if (previous.OpensScope() and not current.OpensScope() and
-        not current.is_comment and
-        format_token.Subtype.SUBSCRIPT_BRACKET not in previous.subtypes):
-      if pprevious and not pprevious.is_keyword and not pprevious.is_name:
-        # We want to split if there's a comment in the container.
-        token = current
-        while token != previous.matching_bracket:
-          if token.is_comment:
-            return True
-          token = token.next_token
-      if previous.value == '(':
-        pptoken = previous.previous_token
-        if not pptoken or not pptoken.is_name:
-          # Split after the opening of a tuple if it doesn't fit on the current
-          # line and it's not a function call.
-          if self._FitsOnLine(previous, previous.matching_bracket):
-            return False
-        elif not self._FitsOnLine(previous, previous.matching_bracket):
-          if (self.column_limit - self.column) / float(self.column_limit) < 0.3:
-            # Try not to squish all of the arguments off to the right.
-            return current.next_token != previous.matching_bracket
-      else:
-        # Split after the opening of a container if it doesn't fit on the
-        # current line.
-        if not self._FitsOnLine(previous, previous.matching_bracket):
-          return True
-
-    ###########################################################################
-    # Original Formatting Splitting
-    # These checks rely upon the original formatting. This is in order to
-    # attempt to keep hand-written code in the same condition as it was before.
-    # However, this may cause the formatter to fail to be idempotent.
-    if (style.Get('SPLIT_BEFORE_BITWISE_OPERATOR') and current.value in '&|' and
-        previous.lineno < current.lineno):
-      # Retain the split before a bitwise operator.
-      return True
-
-    if (current.is_comment and
-        previous.lineno < current.lineno - current.value.count('\n')):
-      # If a comment comes in the middle of an unwrapped line (like an if
-      # conditional with comments interspersed), then we want to split if the
-      # original comments were on a separate line.
-      return True
+    """Returns True if the line must split before the next token.
 
+    The parts of the decision that depend only on the line's tokens are worked
+    out once per line by the _SplitTable. What is left are checks against the
+    current column and bracket stack, which are run in order until one of them
+    decides.
+    """
+    for check, args in self.split_table.MustSplitChecks(self.next_token):
+      result = check(self, *args)
+      if result is not None:
+        return result
     return False
 
   def AddTokenToState(self, newline, dry_run, must_split=False):
@@ -512,13 +211,16 @@ class FormatDecisionState(object):
         #     foo = [a,
         #            b,
         #           ]
-        self.stack[-1].closing_scope_indent = self.column - 1
-        if style.Get('ALIGN_CLOSING_BRACKET_WITH_VISUAL_INDENT'):
-          self.stack[-1].closing_scope_indent += 1
-        self.stack[-1].indent = self.column + spaces
+        closing_scope_indent = self.column - 1
+        if self.style.ALIGN_CLOSING_BRACKET_WITH_VISUAL_INDENT:
+          closing_scope_indent += 1
+        self._ReplaceParenState(
+            indent=self.column + spaces,
+            closing_scope_indent=closing_scope_indent)
       else:
-        self.stack[-1].closing_scope_indent = (
-            self.stack[-1].indent - style.Get('CONTINUATION_INDENT_WIDTH'))
+        self._ReplaceParenState(
+            closing_scope_indent=(
+                self.stack.top.indent - self.style.CONTINUATION_INDENT_WIDTH))
 
     self.column += spaces
 
@@ -545,21 +247,21 @@ class FormatDecisionState(object):
       indent_level = self.line.depth
       spaces = self.column
       if spaces:
-        spaces -= indent_level * style.Get('INDENT_WIDTH')
+        spaces -= indent_level * self.style.INDENT_WIDTH
       current.AddWhitespacePrefix(
           newlines_before=1, spaces=spaces, indent_level=indent_level)
 
     if not current.is_comment:
-      self.stack[-1].last_space = self.column
+      self._ReplaceParenState(last_space=self.column)
     self.lowest_level_on_line = self.paren_level
 
     if (previous.OpensScope() or
         (previous.is_comment and previous.previous_token is not None and
          previous.previous_token.OpensScope())):
-      self.stack[-1].closing_scope_indent = max(
-          0, self.stack[-1].indent - style.Get('CONTINUATION_INDENT_WIDTH'))
-
-      self.stack[-1].split_before_closing_bracket = True
+      self._ReplaceParenState(
+          closing_scope_indent=max(
+              0, self.stack.top.indent - self.style.CONTINUATION_INDENT_WIDTH),
+          split_before_closing_bracket=True)
 
     # Calculate the split penalty.
     penalty = current.split_penalty
@@ -575,11 +277,10 @@ class FormatDecisionState(object):
     # Add a penalty for each increasing newline we add, but don't penalize for
     # splitting before an if-expression or list comprehension.
     if current.value not in {'if', 'for'}:
-      last = self.stack[-1]
-      last.num_line_splits += 1
+      num_line_splits = self.stack.top.num_line_splits + 1
+      self._ReplaceParenState(num_line_splits=num_line_splits)
       penalty += (
-          style.Get('SPLIT_PENALTY_FOR_ADDED_LINE_SPLIT') *
-          last.num_line_splits)
+          self.style.SPLIT_PENALTY_FOR_ADDED_LINE_SPLIT * num_line_splits)
 
     if current.OpensScope() and previous.OpensScope():
       # Prefer to keep opening brackets coalesced (unless it's at the beginning
@@ -608,20 +309,21 @@ class FormatDecisionState(object):
     # If we encounter an opening bracket, we add a level to our stack to prepare
     # for the subsequent tokens.
     if current.OpensScope():
-      last = self.stack[-1]
-      new_indent = style.Get('CONTINUATION_INDENT_WIDTH') + last.last_space
+      last = self.stack.top
+      new_indent = self.style.CONTINUATION_INDENT_WIDTH + last.last_space
 
-      self.stack.append(_ParenState(new_indent, self.stack[-1].last_space))
+      self.stack = self.stack.Push(_ParenState(new_indent, last.last_space))
       self.paren_level += 1
 
     # If we encounter a closing bracket, we can remove a level from our
     # parenthesis stack.
-    if len(self.stack) > 1 and current.ClosesScope():
-      if format_token.Subtype.DICTIONARY_KEY_PART in current.subtypes:
-        self.stack[-2].last_space = self.stack[-2].indent
+    if self.stack.below is not None and current.ClosesScope():
+      last = self.stack.top
+      self.stack = self.stack.below
+      if current.subtypes & format_token.Subtype.DICTIONARY_KEY_PART:
+        self._ReplaceParenState(last_space=self.stack.top.indent)
       else:
-        self.stack[-2].last_space = self.stack[-1].last_space
-      self.stack.pop()
+        self._ReplaceParenState(last_space=last.last_space)
       self.paren_level -= 1
 
     is_multiline_string = current.is_string and '\n' in current.value
@@ -637,7 +339,7 @@ class FormatDecisionState(object):
     penalty = 0
     if not current.is_pylint_comment and self.column > self.column_limit:
       excess_characters = self.column - self.column_limit
-      penalty += style.Get('SPLIT_PENALTY_EXCESS_CHARACTER') * excess_characters
+      penalty += self.style.SPLIT_PENALTY_EXCESS_CHARACTER * excess_characters
 
     if is_multiline_string:
       # If this is a multiline string, the column is actually the
@@ -658,29 +360,31 @@ class FormatDecisionState(object):
     """
     current = self.next_token
     previous = current.previous_token
-    top_of_stack = self.comp_stack[-1] if self.comp_stack else None
+    top_of_stack = self.comp_stack.top if self.comp_stack else None
     penalty = 0
 
     if top_of_stack is not None:
       # Check if the token terminates the current comprehension.
       if current == top_of_stack.closing_bracket:
-        last = self.comp_stack.pop()
+        self.comp_stack = self.comp_stack.below
         # Lightly penalize comprehensions that are split across multiple lines.
-        if last.has_interior_split:
-          penalty += style.Get('SPLIT_PENALTY_COMPREHENSION')
+        if top_of_stack.has_interior_split:
+          penalty += self.style.SPLIT_PENALTY_COMPREHENSION
 
         return penalty
 
-      if newline:
-        top_of_stack.has_interior_split = True
+      if newline and not top_of_stack.has_interior_split:
+        top_of_stack = top_of_stack.Replace(has_interior_split=True)
+        self.comp_stack = self.comp_stack.ReplaceTop(top_of_stack)
 
-    if (format_token.Subtype.COMP_EXPR in current.subtypes and
-        format_token.Subtype.COMP_EXPR not in previous.subtypes):
-      self.comp_stack.append(object_state.ComprehensionState(current))
+    if (current.subtypes & format_token.Subtype.COMP_EXPR and
+        not previous.subtypes & format_token.Subtype.COMP_EXPR):
+      self.comp_stack = _FrameStack(
+          object_state.ComprehensionState(current), self.comp_stack)
       return penalty
 
     if (current.value == 'for' and
-        format_token.Subtype.COMP_FOR in current.subtypes):
+        current.subtypes & format_token.Subtype.COMP_FOR):
       if top_of_stack.for_token is not None:
         # Treat nested comprehensions like normal comp_if expressions.
         # Example:
@@ -690,25 +394,26 @@ class FormatDecisionState(object):
         #   -->   for b in bar   <--
         #         if a.zut + b.zut
         #     ]
-        if (style.Get('SPLIT_COMPLEX_COMPREHENSION') and
+        if (self.style.SPLIT_COMPLEX_COMPREHENSION and
             top_of_stack.has_split_at_for != newline and
             (top_of_stack.has_split_at_for or
              not top_of_stack.HasTrivialExpr())):
           penalty += split_penalty.UNBREAKABLE
       else:
-        top_of_stack.for_token = current
-        top_of_stack.has_split_at_for = newline
+        top_of_stack = top_of_stack.Replace(
+            for_token=current, has_split_at_for=newline)
+        self.comp_stack = self.comp_stack.ReplaceTop(top_of_stack)
 
         # Try to keep trivial expressions on the same line as the comp_for.
-        if (style.Get('SPLIT_COMPLEX_COMPREHENSION') and newline and
+        if (self.style.SPLIT_COMPLEX_COMPREHENSION and newline and
             top_of_stack.HasTrivialExpr()):
           penalty += split_penalty.CONNECTED
 
-    if (format_token.Subtype.COMP_IF in current.subtypes and
-        format_token.Subtype.COMP_IF not in previous.subtypes):
+    if (current.subtypes & format_token.Subtype.COMP_IF and
+        not previous.subtypes & format_token.Subtype.COMP_IF):
       # Penalize breaking at comp_if when it doesn't match the newline structure
       # in the rest of the comprehension.
-      if (style.Get('SPLIT_COMPLEX_COMPREHENSION') and
+      if (self.style.SPLIT_COMPLEX_COMPREHENSION and
           top_of_stack.has_split_at_for != newline and
           (top_of_stack.has_split_at_for or not top_of_stack.HasTrivialExpr())):
         penalty += split_penalty.UNBREAKABLE
@@ -719,7 +424,7 @@ class FormatDecisionState(object):
     """Return the new column on the newline."""
     current = self.next_token
     previous = current.previous_token
-    top_of_stack = self.stack[-1]
+    top_of_stack = self.stack.top
 
     if current.spaces_required_before > 2 or self.line.disable:
       return current.spaces_required_before
@@ -732,110 +437,32 @@ class FormatDecisionState(object):
           (previous.is_comment and previous.previous_token is not None and
            previous.previous_token.OpensScope())):
         return max(0,
-                   top_of_stack.indent - style.Get('CONTINUATION_INDENT_WIDTH'))
+                   top_of_stack.indent - self.style.CONTINUATION_INDENT_WIDTH)
       return top_of_stack.closing_scope_indent
 
     if (previous and previous.is_string and current.is_string and
-        format_token.Subtype.DICTIONARY_VALUE in current.subtypes):
+        current.subtypes & format_token.Subtype.DICTIONARY_VALUE):
       return previous.column
 
-    if style.Get('INDENT_DICTIONARY_VALUE'):
+    if self.style.INDENT_DICTIONARY_VALUE:
       if previous and (previous.value == ':' or previous.is_pseudo_paren):
-        if format_token.Subtype.DICTIONARY_VALUE in current.subtypes:
+        if current.subtypes & format_token.Subtype.DICTIONARY_VALUE:
           return top_of_stack.indent
 
     if (_IsCompoundStatement(self.line.first) and
-        (not style.Get('DEDENT_CLOSING_BRACKETS') or
-         style.Get('SPLIT_BEFORE_FIRST_ARGUMENT'))):
+        (not self.style.DEDENT_CLOSING_BRACKETS or
+         self.style.SPLIT_BEFORE_FIRST_ARGUMENT)):
       token_indent = (
           len(self.line.first.whitespace_prefix.split('\n')[-1]) +
-          style.Get('INDENT_WIDTH'))
+          self.style.INDENT_WIDTH)
       if token_indent == top_of_stack.indent:
-        return top_of_stack.indent + style.Get('CONTINUATION_INDENT_WIDTH')
+        return top_of_stack.indent + self.style.CONTINUATION_INDENT_WIDTH
 
     return top_of_stack.indent
 
-  def _FitsOnLine(self, start, end):
-    """Determines if line between start and end can fit on the current line."""
-    length = end.total_length - start.total_length
-    if not start.is_pseudo_paren:
-      length += len(start.value)
-    return length + self.column <= self.column_limit
-
-  def _EachDictEntryFitsOnOneLine(self, opening):
-    """Determine if each dict elems can fit on one line."""
-
-    def PreviousNonCommentToken(tok):
-      tok = tok.previous_token
-      while tok.is_comment:
-        tok = tok.previous_token
-      return tok
-
-    def ImplicitStringConcatenation(tok):
-      num_strings = 0
-      if tok.is_pseudo_paren:
-        tok = tok.next_token
-      while tok.is_string:
-        num_strings += 1
-        tok = tok.next_token
-      return num_strings > 1
-
-    closing = opening.matching_bracket
-    entry_start = opening.next_token
-    current = opening.next_token.next_token
-
-    while current and current != closing:
-      if format_token.Subtype.DICTIONARY_KEY in current.subtypes:
-        prev = PreviousNonCommentToken(current)
-        length = prev.total_length - entry_start.total_length
-        length += len(entry_start.value)
-        if length + self.stack[-2].indent >= self.column_limit:
-          return False
-        entry_start = current
-      if current.OpensScope():
-        if ((current.value == '{' or
-             (current.is_pseudo_paren and current.next_token.value == '{') and
-             format_token.Subtype.DICTIONARY_VALUE in current.subtypes) or
-            ImplicitStringConcatenation(current)):
-          # A dictionary entry that cannot fit on a single line shouldn't matter
-          # to this calculation. If it can't fit on a single line, then the
-          # opening should be on the same line as the key and the rest on
-          # newlines after it. But the other entries should be on single lines
-          # if possible.
-          if current.matching_bracket:
-            current = current.matching_bracket
-          while current:
-            if current == closing:
-              return True
-            if format_token.Subtype.DICTIONARY_KEY in current.subtypes:
-              entry_start = current
-              break
-            current = current.next_token
-        else:
-          current = current.matching_bracket
-      else:
-        current = current.next_token
-
-    # At this point, current is the closing bracket. Go back one to get the the
-    # end of the dictionary entry.
-    current = PreviousNonCommentToken(current)
-    length = current.total_length - entry_start.total_length
-    length += len(entry_start.value)
-    return length + self.stack[-2].indent <= self.column_limit
-
-  def _ArgumentListHasDictionaryEntry(self, token):
-    """Check if the function argument list has a dictionary as an arg."""
-    if _IsArgumentToFunction(token):
-      while token:
-        if token.value == '{':
-          length = token.matching_bracket.total_length - token.total_length
-          return length + self.stack[-2].indent > self.column_limit
-        if token.ClosesScope():
-          break
-        if token.OpensScope():
-          token = token.matching_bracket
-        token = token.next_token
-    return False
+  def _ReplaceParenState(self, **kwargs):
+    """Replace the top of the paren stack with an updated copy of it."""
+    self.stack = self.stack.ReplaceTop(self.stack.top.Replace(**kwargs))
 
 
 _COMPOUND_STMTS = frozenset(
@@ -865,91 +492,626 @@ def _IsFunctionCallWithArguments(token):
   return False
 
 
-def _IsArgumentToFunction(token):
-  bracket = unwrapped_line.IsSurroundedByBrackets(token)
-  if not bracket or bracket.value != '(':
-    return False
-  previous = bracket.previous_token
-  return previous and previous.is_name
-
-
-def _GetLengthOfSubtype(token, subtype, exclude=None):
+def _GetLengthOfSubtype(token, subtype, exclude=format_token.Subtype.NONE):
   current = token
-  while (current.next_token and subtype in current.subtypes and
-         (exclude is None or exclude not in current.subtypes)):
+  while (current.next_token and current.subtypes & subtype and
+         not current.subtypes & exclude):
     current = current.next_token
   return current.total_length - token.total_length + 1
 
 
-def _GetOpeningBracket(current):
-  """Get the opening bracket containing the current token."""
-  if current.matching_bracket and not current.is_pseudo_paren:
-    return current.matching_bracket
-  while current:
-    if current.ClosesScope():
-      current = current.matching_bracket
-    elif current.is_pseudo_paren:
-      current = current.previous_token
-    elif current.OpensScope():
-      return current
-    current = current.previous_token
-  return None
-
-
-def _LastTokenInLine(current):
-  while not current.is_comment and current.next_token:
-    current = current.next_token
-  return current
-
-
 def _IsFunctionDefinition(current):
   prev = current.previous_token
   return (current.value == '(' and prev and
-          format_token.Subtype.FUNC_DEF in prev.subtypes)
-
-
-def _IsLastScopeInLine(current):
-  while current:
-    current = current.next_token
-    if current and current.OpensScope():
-      return False
-  return True
+          prev.subtypes & format_token.Subtype.FUNC_DEF)
 
 
 def _IsSingleElementTuple(token):
   """Check if it's a single-element tuple."""
-  close = token.matching_bracket
-  token = token.next_token
-  num_commas = 0
-  while token != close:
-    if token.value == ',':
-      num_commas += 1
-    if token.OpensScope():
-      token = token.matching_bracket
-    else:
-      token = token.next_token
-  return num_commas == 1
+  return token.bracket_scope.num_commas == 1
 
 
 def _ScopeHasNoCommas(token):
   """Check if the scope has no commas."""
-  close = token.matching_bracket
-  token = token.next_token
-  while token != close:
+  return token.bracket_scope.num_commas == 0
+
+
+def _SurroundedByParens(token):
+  """Check if it's an expression surrounded by parentheses."""
+  while token:
     if token.value == ',':
       return False
+    if token.value == ')':
+      return not token.next_token
     if token.OpensScope():
-      token = token.matching_bracket
+      token = token.matching_bracket.next_token
     else:
       token = token.next_token
-  return True
+  return False
+
+
+def _Length(start, end):
+  """The length of the tokens from start to end when put on one line."""
+  length = end.total_length - start.total_length
+  if not start.is_pseudo_paren:
+    length += len(start.value)
+  return length
+
+
+_CLOSING_TO_OPENING = {')': '(', ']': '[', '}': '{'}
+
+
+class _SplitTable(object):
+  """The split decisions for an unwrapped line that don't depend on the state.
+
+  CanSplit() and MustSplit() are asked about every state the reformatter looks
+  at. But most of what they need to know -- the subtypes of the tokens, which
+  bracket encloses a token, the length of a bracketed list -- is the same for
+  every state of the line. The table works that out once for each token, the
+  first time it's asked, and is shared by all of the line's states.
+
+  MustSplit()'s rules are kept for each token as a list of checks, in the order
+  the rules are applied. A rule that only depends on the tokens is decided when
+  the table is built. The others become a check on the state, which returns
+  True or False if it decides, and None otherwise.
+  """
+
+  __slots__ = ('_line', '_index', '_can_split', '_can_split_when_required',
+               '_must_split_checks', '_opening_bracket', '_surrounding_bracket',
+               '_last_scope_in_line', '_last_token_in_line',
+               '_dict_entry_lengths')
+
+  def __init__(self, line):
+    self._line = line
+    self._index = None
+
+  def CanSplit(self, token, must_split):
+    """Returns True if the line can be split before the token."""
+    index = self._Index(token)
+    if must_split:
+      return self._can_split_when_required[index]
+    return self._can_split[index]
+
+  def MustSplitChecks(self, token):
+    """Returns the (check, args) pairs that decide MustSplit() for the token."""
+    index = self._Index(token)
+    return self._must_split_checks[index]
+
+  def _Index(self, token):
+    if self._index is None:
+      self._Build()
+    return self._index[token]
+
+  def _Build(self):
+    tokens = self._line.tokens
+    self._index = {}
+    for index, token in enumerate(tokens):
+      self._index[token] = index
+    self._BuildBrackets(tokens)
+    self._dict_entry_lengths = {}
+    current_style = style.Current()
+    self._can_split = [
+        _CanSplit(token, False, current_style) for token in tokens
+    ]
+    self._can_split_when_required = [
+        _CanSplit(token, True, current_style) for token in tokens
+    ]
+    self._must_split_checks = [
+        self._MustSplitChecks(token, current_style) for token in tokens
+    ]
+
+  def _BuildBrackets(self, tokens):
+    """Find the brackets enclosing each token in a pass in each direction."""
+    # _opening_bracket[i] is where the walk back from the i-th token looking
+    # for an opening bracket ends. The walk jumps over bracketed scopes and the
+    # token before a pseudo paren.
+    self._opening_bracket = []
+    for token in tokens:
+      if token.ClosesScope():
+        start = token.matching_bracket and token.matching_bracket.previous_token
+      elif token.is_pseudo_paren:
+        start = token.previous_token and token.previous_token.previous_token
+      elif token.OpensScope():
+        self._opening_bracket.append(token)
+        continue
+      else:
+        start = token.previous_token
+      self._opening_bracket.append(self._opening_bracket[self._index[start]]
+                                   if start else None)
+
+    # IsSurroundedByBrackets() matches each kind of bracket on its own, so keep
+    # a separate stack of the unmatched brackets of each kind.
+    self._surrounding_bracket = []
+    unmatched = {'(': [], '[': [], '{': []}
+    for index, token in enumerate(tokens):
+      innermost = max(
+          stack[-1] if stack else -1 for stack in unmatched.values())
+      self._surrounding_bracket.append(tokens[innermost]
+                                       if innermost >= 0 else None)
+      if token.value in unmatched:
+        unmatched[token.value].append(index)
+      elif token.value in _CLOSING_TO_OPENING:
+        stack = unmatched[_CLOSING_TO_OPENING[token.value]]
+        if stack:
+          stack.pop()
+
+    self._last_scope_in_line = [True] * len(tokens)
+    self._last_token_in_line = [None] * len(tokens)
+    last_scope = True
+    last_token = tokens[-1] if tokens else None
+    for index in range(len(tokens) - 1, -1, -1):
+      token = tokens[index]
+      self._last_scope_in_line[index] = last_scope
+      if token.is_comment:
+        last_token = token
+      self._last_token_in_line[index] = last_token
+      if token.OpensScope():
+        last_scope = False
+
+  def _OpeningBracket(self, token):
+    """Get the opening bracket containing the token."""
+    if token.matching_bracket and not token.is_pseudo_paren:
+      return token.matching_bracket
+    return self._opening_bracket[self._index[token]]
+
+  def _SurroundingBracket(self, token):
+    """The same as unwrapped_line.IsSurroundedByBrackets(token)."""
+    return self._surrounding_bracket[self._index[token]]
+
+  def _MustSplitChecks(self, current, current_style):
+    """The checks deciding if the line must split before the current token.
+
+    The rules are those of FormatDecisionState.MustSplit(), in the same order.
+    Once a rule decides, the rules after it can't apply, so they're left off.
+    """
+    previous = current.previous_token
+
+    if current.is_pseudo_paren:
+      return [(_MustSplitDecided, (False,))]
+
+    if current.must_break_before:
+      return [(_MustSplitDecided, (True,))]
+
+    if not previous:
+      return [(_MustSplitDecided, (False,))]
+
+    checks = []
+    if current.value in '}]' and current_style.SPLIT_BEFORE_CLOSING_BRACKET:
+      # Split before the closing bracket if we can.
+      checks.append(
+          (_MustSplitBeforeClosingBracket,
+           (current.node_split_penalty != split_penalty.UNBREAKABLE,)))
+
+    if (current.value == ')' and previous.value == ',' and
+        not _IsSingleElementTuple(current.matching_bracket)):
+      return checks + [(_MustSplitDecided, (True,))]
+
+    # Prevent splitting before the first argument in compound statements
+    # with the exception of function declarations.
+    if (current_style.SPLIT_BEFORE_FIRST_ARGUMENT and
+        _IsCompoundStatement(self._line.first) and
+        not _IsFunctionDef(self._line.first)):
+      return checks + [(_MustSplitDecided, (False,))]
+
+    ###########################################################################
+    # List Splitting
+    if (current_style.DEDENT_CLOSING_BRACKETS or
+        current_style.SPLIT_BEFORE_FIRST_ARGUMENT):
+      bracket = current if current.ClosesScope() else previous
+      if not bracket.subtypes & format_token.Subtype.SUBSCRIPT_BRACKET:
+        if bracket.OpensScope():
+          if current_style.COALESCE_BRACKETS:
+            if current.OpensScope():
+              # Prefer to keep all opening brackets together.
+              return checks + [(_MustSplitDecided, (False,))]
+
+          if (not self._last_scope_in_line[self._index[bracket]] or
+              self._SurroundingBracket(bracket)):
+            last_token = bracket.matching_bracket
+          else:
+            last_token = self._last_token_in_line[self._index[
+                bracket.matching_bracket]]
+
+          # Split before the first element if the whole list can't fit on a
+          # single line.
+          length = _Length(bracket, last_token)
+          checks.append((_MustSplitBeforeFirstElement, (length,)))
+
+        elif current_style.DEDENT_CLOSING_BRACKETS and current.ClosesScope():
+          # Split before and dedent the closing bracket.
+          return checks + [(_MustSplitBeforeDedentedBracket, ())]
+
+    if (current_style.SPLIT_BEFORE_EXPRESSION_AFTER_OPENING_PAREN and
+        current.is_name):
+      # An expression that's surrounded by parens gets split after the opening
+      # parenthesis.
+      if (previous.value == '(' and not previous.is_pseudo_paren and
+          not self._SurroundingBracket(previous)):
+        pptoken = previous.previous_token
+        if (pptoken and not pptoken.is_name and not pptoken.is_keyword and
+            _SurroundedByParens(current)):
+          return checks + [(_MustSplitDecided, (True,))]
+
+    if (current.is_name or current.is_string) and previous.value == ',':
+      # If the list has function calls in it and the full list itself cannot
+      # fit on the line, then we want to split. Otherwise, we'll get something
+      # like this:
+      #
+      #     X = [
+      #         Bar(xxx='some string',
+      #             yyy='another long string',
+      #             zzz='a third long string'), Bar(
+      #                 xxx='some string',
+      #                 yyy='another long string',
+      #                 zzz='a third long string')
+      #     ]
+      #
+      # or when a string formatting syntax.
+      func_call_or_string_format = False
+      tok = current.next_token
+      if current.is_name:
+        while tok and (tok.is_name or tok.value == '.'):
+          tok = tok.next_token
+        func_call_or_string_format = tok and tok.value == '('
+      elif current.is_string:
+        while tok and tok.is_string:
+          tok = tok.next_token
+        func_call_or_string_format = tok and tok.value == '%'
+      if func_call_or_string_format:
+        open_bracket = self._SurroundingBracket(current)
+        if open_bracket:
+          if open_bracket.value in '[{':
+            length = _Length(open_bracket, open_bracket.matching_bracket)
+            checks.append((_MustSplitIfTooLong, (length,)))
+          elif tok.value == '(':
+            length = _Length(current, tok.matching_bracket)
+            checks.append((_MustSplitIfTooLong, (length,)))
+
+    ###########################################################################
+    # Dict/Set Splitting
+    if (current_style.EACH_DICT_ENTRY_ON_SEPARATE_LINE and
+        current.subtypes & format_token.Subtype.DICTIONARY_KEY and
+        not current.is_comment):
+      # Place each dictionary entry onto its own line.
+      if previous.value == '{' and previous.previous_token:
+        opening = self._OpeningBracket(previous.previous_token)
+        if (opening and opening.value == '(' and opening.previous_token and
+            opening.previous_token.is_name):
+          # This is a dictionary that's an argument to a function.
+          if (previous.matching_bracket.next_token and
+              (not opening.matching_bracket.next_token or
+               opening.matching_bracket.next_token.value != '.') and
+              _ScopeHasNoCommas(previous)):
+            # Don't split before the key if:
+            #   - The dictionary fits on a line, and
+            #   - The function call isn't part of a builder-style call and
+            #   - The dictionary has one entry and no trailing comma
+            return checks + [(_MustSplitUnlessFits,
+                              (_Length(previous, previous.matching_bracket),))]
+      return checks + [(_MustSplitDecided, (True,))]
+
+    if (current_style.SPLIT_BEFORE_DICT_SET_GENERATOR and
+        current.subtypes & format_token.Subtype.DICT_SET_GENERATOR):
+      # Split before a dict/set generator.
+      return checks + [(_MustSplitDecided, (True,))]
+
+    if (current.subtypes & format_token.Subtype.DICTIONARY_VALUE or
+        (previous.is_pseudo_paren and previous.value == '(' and
+         not current.is_comment)):
+      # Split before the dictionary value if we can't fit every dictionary
+      # entry on its own line.
+      opening = self._OpeningBracket(current)
+      if not current.OpensScope() and opening:
+        longest_entry, last_entry = self._DictEntryLengths(opening)
+        checks.append((_MustSplitBeforeDictValue,
+                       (longest_entry, last_entry,
+                        current_style.ALLOW_SPLIT_BEFORE_DICT_VALUE)))
+
+    if previous.value == '{':
+      # Split if the dict/set cannot fit on one line and ends in a comma.
+      closing = previous.matching_bracket
+      if closing.previous_token.value == ',':
+        length = _Length(previous, closing)
+        checks.append((_MustSplitBeforeFirstElement, (length,)))
+
+    ###########################################################################
+    # Argument List Splitting
+    if (current_style.SPLIT_BEFORE_NAMED_ASSIGNS and not current.is_comment and
+        current.subtypes &
+        format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN_ARG_LIST):
+      if (previous.value not in {'=', ':', '*', '**'} and
+          current.value not in ':=,)' and not _IsFunctionDefinition(previous)):
+        # If we're going to split the lines because of named arguments, then we
+        # want to split after the opening bracket as well. But not when this is
+        # part of a function definition.
+        if previous.value == '(':
+          # Make sure we don't split after the opening bracket if the
+          # continuation indent is greater than the opening bracket:
+          #
+          #  a(
+          #      b=1,
+          #      c=2)
+          #
+          # An argument to a function is a function call with named assigns,
+          # and doesn't need the split if it fits.
+          return checks + [(_MustSplitAfterParenForNamedAssigns,
+                            (_Length(previous, previous.matching_bracket),
+                             bool(self._SurroundingBracket(previous)),
+                             current_style.CONTINUATION_INDENT_WIDTH))]
+
+        opening = self._OpeningBracket(current)
+        if opening:
+          return checks + [
+              (_MustSplitNamedAssigns,
+               (opening.matching_bracket.total_length - opening.total_length,))
+          ]
+
+    if current.value not in '{)' and previous.value == '(':
+      length = self._ArgumentListDictionaryLength(current)
+      if length is not None:
+        checks.append((_MustSplitBeforeDictionaryArgument, (length,)))
+
+    if current_style.SPLIT_ARGUMENTS_WHEN_COMMA_TERMINATED:
+      # Split before arguments in a function call or definition if the
+      # arguments are terminated by a comma.
+      opening = self._OpeningBracket(current)
+      if opening and opening.previous_token and opening.previous_token.is_name:
+        if previous.value in '(,':
+          if opening.matching_bracket.previous_token.value == ',':
+            return checks + [(_MustSplitDecided, (True,))]
+
+    if ((current.is_name or current.value in {'*', '**'}) and
+        previous.value == ','):
+      # If we have a function call within an argument list and it won't fit on
+      # the remaining line, but it will fit on a line by itself, then go ahead
+      # and split before the call.
+      opening = self._OpeningBracket(current)
+      if (opening and opening.value == '(' and opening.previous_token and
+          (opening.previous_token.is_name or
+           opening.previous_token.value in {'*', '**'})):
+        is_func_call = False
+        opening = current
+        while opening:
+          if opening.value == '(':
+            is_func_call = True
+            break
+          if (not (opening.is_name or opening.value in {'*', '**'}) and
+              opening.value != '.'):
+            break
+          opening = opening.next_token
+
+        if is_func_call:
+          if (opening.matching_bracket.next_token and
+              opening.matching_bracket.next_token.value != ',' and
+              not opening.matching_bracket.next_token.ClosesScope()):
+            return checks + [(_MustSplitDecided, (True,))]
+          checks.append((_MustSplitIfTooLong,
+                         (_Length(current, opening.matching_bracket),)))
+
+    pprevious = previous.previous_token
+    if (current.is_name and pprevious and pprevious.is_name and
+        previous.value == '(' and _IsFunctionCallWithArguments(current)):
+      # There is a function call, with more than 1 argument, where the first
+      # argument is itself a function call with arguments.  In this specific
+      # case, if we split after the first argument's opening '(', then the
+      # formatting will look bad for the rest of the arguments. E.g.:
+      #
+      #     outer_function_call(inner_function_call(
+      #         inner_arg1, inner_arg2),
+      #                         outer_arg1, outer_arg2)
+      #
+      # Instead, enforce a split before that argument to keep things looking
+      # good.
+      checks.append((_MustSplitIfTooLong,
+                     (_Length(previous, previous.matching_bracket),)))
+
+    if (previous.OpensScope() and not current.OpensScope() and
+        not current.is_comment and
+        not previous.subtypes & format_token.Subtype.SUBSCRIPT_BRACKET):
+      if (pprevious and not pprevious.is_keyword and not pprevious.is_name and
+          previous.bracket_scope.has_comment):
+        # We want to split if there's a comment in the container.
+        return checks + [(_MustSplitDecided, (True,))]
+      length = _Length(previous, previous.matching_bracket)
+      if previous.value == '(':
+        pptoken = previous.previous_token
+        if not pptoken or not pptoken.is_name:
+          # Split after the opening of a tuple if it doesn't fit on the current
+          # line and it's not a function call.
+          checks.append((_MustNotSplitIfFits, (length,)))
+        else:
+          # Try not to squish all of the arguments off to the right.
+          checks.append((_MustSplitFunctionCallArguments,
+                         (length,
+                          current.next_token != previous.matching_bracket)))
+      else:
+        # Split after the opening of a container if it doesn't fit on the
+        # current line.
+        checks.append((_MustSplitIfTooLong, (length,)))
+
+    ###########################################################################
+    # Original Formatting Splitting
+    # These checks rely upon the original formatting. This is in order to
+    # attempt to keep hand-written code in the same condition as it was before.
+    # However, this may cause the formatter to fail to be idempotent.
+    if (current_style.SPLIT_BEFORE_BITWISE_OPERATOR and
+        current.value in '&|' and previous.lineno < current.lineno):
+      # Retain the split before a bitwise operator.
+      return checks + [(_MustSplitDecided, (True,))]
+
+    if (current.is_comment and
+        previous.lineno < current.lineno - current.value.count('\n')):
+      # If a comment comes in the middle of an unwrapped line (like an if
+      # conditional with comments interspersed), then we want to split if the
+      # original comments were on a separate line.
+      return checks + [(_MustSplitDecided, (True,))]
+
+    return checks
+
+  def _ArgumentListDictionaryLength(self, token):
+    """The length of the first dictionary argument in the argument list.
+
+    Returns:
+      The length of the dictionary, or None if the token isn't the start of an
+      argument list with a dictionary in it.
+    """
+    bracket = self._SurroundingBracket(token)
+    if (not bracket or bracket.value != '(' or not bracket.previous_token or
+        not bracket.previous_token.is_name):
+      return None
+    brace = bracket.bracket_scope.first_brace
+    if not brace:
+      return None
+    return brace.matching_bracket.total_length - brace.total_length
+
+  def _DictEntryLengths(self, opening):
+    """The lengths of the dict entries that must each fit on one line.
+
+    Arguments:
+      opening: (format_token.FormatToken) The opening bracket of the dict.
+
+    Returns:
+      A tuple of the length of the longest entry before the final one (or None
+      if there are none) and the length of the final entry (or None if it
+      doesn't matter).
+    """
+    if opening not in self._dict_entry_lengths:
+      spans, last_span = opening.bracket_scope.DictEntrySpans()
+      lengths = [_Length(start, end) for start, end in spans]
+      longest_entry = max(lengths) if lengths else None
+      last_entry = _Length(*last_span) if last_span else None
+      self._dict_entry_lengths[opening] = (longest_entry, last_entry)
+    return self._dict_entry_lengths[opening]
+
+
+def _CanSplit(current, must_split, current_style):
+  """Determine if we can split before the current token.
+
+  Arguments:
+    current: (format_token.FormatToken) The token.
+    must_split: (bool) A newline was required before this token.
+    current_style: (style.Style) The style the line is formatted with.
+
+  Returns:
+    True if the line can be split before the token.
+  """
+  previous = current.previous_token
+
+  if current.is_pseudo_paren:
+    return False
+
+  if (not must_split and
+      current.subtypes & format_token.Subtype.DICTIONARY_KEY_PART and
+      not current.subtypes & format_token.Subtype.DICTIONARY_KEY and
+      not current_style.ALLOW_MULTILINE_DICTIONARY_KEYS):
+    # In some situations, a dictionary may be multiline, but pylint doesn't
+    # like it. So don't allow it unless forced to.
+    return False
+
+  if (not must_split and
+      current.subtypes & format_token.Subtype.DICTIONARY_VALUE and
+      not current_style.ALLOW_SPLIT_BEFORE_DICT_VALUE):
+    return False
+
+  if previous and previous.value == '(' and current.value == ')':
+    # Don't split an empty function call list if we aren't splitting before
+    # dict values.
+    token = previous.previous_token
+    while token:
+      prev = token.previous_token
+      if not prev or prev.name not in {'NAME', 'DOT'}:
+        break
+      token = token.previous_token
+    if token and token.subtypes & format_token.Subtype.DICTIONARY_VALUE:
+      if not current_style.ALLOW_SPLIT_BEFORE_DICT_VALUE:
+        return False
+
+  return current.can_break_before
+
+
+# The checks that MustSplit() runs on the state. Each one returns True or False
+# if it decides whether the line must split, and None if it leaves it to the
+# checks after it.
+
+
+def _MustSplitDecided(state, must_split):
+  return must_split
+
+
+def _MustSplitBeforeClosingBracket(state, can_split):
+  if state.stack.top.split_before_closing_bracket:
+    return can_split
+  return None
+
+
+def _MustSplitBeforeFirstElement(state, length):
+  if length + state.column > state.column_limit:
+    state._ReplaceParenState(split_before_closing_bracket=True)
+    return True
+  return None
+
+
+def _MustSplitBeforeDedentedBracket(state):
+  return state.stack.top.split_before_closing_bracket
+
+
+def _MustSplitIfTooLong(state, length):
+  if length + state.column > state.column_limit:
+    return True
+  return None
+
+
+def _MustSplitUnlessFits(state, length):
+  return length + state.column > state.column_limit
+
+
+def _MustNotSplitIfFits(state, length):
+  if length + state.column <= state.column_limit:
+    return False
+  return None
+
+
+def _MustSplitBeforeDictValue(state, longest_entry, last_entry, allow_split):
+  # Each dict entry is measured from the dict's indent.
+  indent = state.stack.below.top.indent
+  if ((longest_entry is not None and
+       longest_entry + indent >= state.column_limit) or
+      (last_entry is not None and last_entry + indent > state.column_limit)):
+    return allow_split
+  return None
+
+
+def _MustSplitAfterParenForNamedAssigns(state, length, surrounded,
+                                        continuation_indent_width):
+  if surrounded and length + state.column <= state.column_limit:
+    return False
+  column = state.column - state.stack.top.last_space
+  return column > continuation_indent_width
+
+
+def _MustSplitNamedAssigns(state, length):
+  return length + state.stack.top.indent > state.column_limit
+
+
+def _MustSplitBeforeDictionaryArgument(state, length):
+  if length + state.stack.below.top.indent > state.column_limit:
+    return True
+  return None
+
+
+def _MustSplitFunctionCallArguments(state, length, must_split):
+  if (length + state.column > state.column_limit and
+      (state.column_limit - state.column) / float(state.column_limit) < 0.3):
+    return must_split
+  return None
 
 
 class _ParenState(object):
   """Maintains the state of the bracket enclosures.
 
   A stack of _ParenState objects are kept so that we know how to indent relative
-  to the brackets.
+  to the brackets. _ParenState objects are immutable, so that the stack can be
+  shared between format decision states. Use Replace() to get a modified copy.
 
   Attributes:
     indent: The column position to which a specified parenthesis level needs to
@@ -964,19 +1126,45 @@ class _ParenState(object):
 
   # TODO(morbo): This doesn't track "bin packing."
 
-  def __init__(self, indent, last_space):
+  __slots__ = ('indent', 'last_space', 'closing_scope_indent',
+               'split_before_closing_bracket', 'num_line_splits', '_hash')
+
+  def __init__(self,
+               indent,
+               last_space,
+               closing_scope_indent=0,
+               split_before_closing_bracket=False,
+               num_line_splits=0):
     self.indent = indent
     self.last_space = last_space
-    self.closing_scope_indent = 0
-    self.split_before_closing_bracket = False
-    self.num_line_splits = 0
-
-  def Clone(self):
-    state = _ParenState(self.indent, self.last_space)
-    state.closing_scope_indent = self.closing_scope_indent
-    state.split_before_closing_bracket = self.split_before_closing_bracket
-    state.num_line_splits = self.num_line_splits
-    return state
+    self.closing_scope_indent = closing_scope_indent
+    self.split_before_closing_bracket = split_before_closing_bracket
+    self.num_line_splits = num_line_splits
+    self._hash = hash((indent, last_space, closing_scope_indent,
+                       split_before_closing_bracket, num_line_splits))
+
+  def Replace(self,
+              indent=None,
+              last_space=None,
+              closing_scope_indent=None,
+              split_before_closing_bracket=None,
+              num_line_splits=None):
+    """Return a copy of this state with the given attributes replaced.
+
+    Attributes that are None keep their current value.
+    """
+    if indent is None:
+      indent = self.indent
+    if last_space is None:
+      last_space = self.last_space
+    if closing_scope_indent is None:
+      closing_scope_indent = self.closing_scope_indent
+    if split_before_closing_bracket is None:
+      split_before_closing_bracket = self.split_before_closing_bracket
+    if num_line_splits is None:
+      num_line_splits = self.num_line_splits
+    return _ParenState(indent, last_space, closing_scope_indent,
+                       split_before_closing_bracket, num_line_splits)
 
   def __repr__(self):
     return '[indent::%d, last_space::%d, closing_scope_indent::%d]' % (
@@ -989,5 +1177,65 @@ class _ParenState(object):
     return not self == other
 
   def __hash__(self, *args, **kwargs):
-    return hash((self.indent, self.last_space, self.closing_scope_indent,
-                 self.split_before_closing_bracket, self.num_line_splits))
+    return self._hash
+
+
+class _FrameStack(object):
+  """A persistent stack of immutable frames.
+
+  The stack is a linked list from the top frame down to the bottom one. Pushing,
+  popping, or replacing the top frame creates a new stack that shares all of the
+  frames below the top with the original stack.
+
+  The hash of the stack is computed incrementally from the hash of the stack
+  below it. Comparing two stacks therefore rarely looks at more than the top
+  frame: stacks with different hashes are unequal, and the comparison stops at
+  the first frame the two stacks share.
+
+  Attributes:
+    top: The frame on the top of the stack.
+    below: The stack below the top frame, or None if this is the bottom frame.
+  """
+
+  __slots__ = ('top', 'below', '_hash')
+
+  def __init__(self, top, below=None):
+    self.top = top
+    self.below = below
+    if below is None:
+      self._hash = hash(top)
+    else:
+      self._hash = hash((below._hash, hash(top)))  # pylint: disable=protected-access
+
+  def Push(self, frame):
+    """Return a new stack with frame on top of this one."""
+    return _FrameStack(frame, self)
+
+  def ReplaceTop(self, frame):
+    """Return a new stack with the top frame replaced by frame."""
+    return _FrameStack(frame, self.below)
+
+  def __iter__(self):
+    """Iterate over the frames from the bottom of the stack to the top."""
+    frames = []
+    stack = self
+    while stack is not None:
+      frames.append(stack.top)
+      stack = stack.below
+    return reversed(frames)
+
+  def __eq__(self, other):
+    this = self
+    while this is not other:
+      if (other is None or this is None or this._hash != other._hash or  # pylint: disable=protected-access
+          this.top != other.top):
+        return False
+      this = this.below
+      other = other.below
+    return True
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return self._hash
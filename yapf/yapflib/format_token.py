@@ -33,29 +33,32 @@ class Subtype(object):
   """Subtype information about tokens.
 
   Gleaned from parsing the code. Helps determine the best formatting.
+
+  The subtypes are bit flags. A token's subtypes are the bitwise or of its
+  flags, so they're tested with '&'.
   """
   NONE = 0
-  UNARY_OPERATOR = 1
-  BINARY_OPERATOR = 2
-  SUBSCRIPT_COLON = 3
-  SUBSCRIPT_BRACKET = 4
-  DEFAULT_OR_NAMED_ASSIGN = 5
-  DEFAULT_OR_NAMED_ASSIGN_ARG_LIST = 6
-  VARARGS_LIST = 7
-  VARARGS_STAR = 8
-  KWARGS_STAR_STAR = 9
-  ASSIGN_OPERATOR = 10
-  DICTIONARY_KEY = 11
-  DICTIONARY_KEY_PART = 12
-  DICTIONARY_VALUE = 13
-  DICT_SET_GENERATOR = 14
-  COMP_EXPR = 21
-  COMP_FOR = 15
-  COMP_IF = 16
-  FUNC_DEF = 17
-  DECORATOR = 18
-  TYPED_NAME = 19
-  TYPED_NAME_ARG_LIST = 20
+  UNARY_OPERATOR = 1 << 0
+  BINARY_OPERATOR = 1 << 1
+  SUBSCRIPT_COLON = 1 << 2
+  SUBSCRIPT_BRACKET = 1 << 3
+  DEFAULT_OR_NAMED_ASSIGN = 1 << 4
+  DEFAULT_OR_NAMED_ASSIGN_ARG_LIST = 1 << 5
+  VARARGS_LIST = 1 << 6
+  VARARGS_STAR = 1 << 7
+  KWARGS_STAR_STAR = 1 << 8
+  ASSIGN_OPERATOR = 1 << 9
+  DICTIONARY_KEY = 1 << 10
+  DICTIONARY_KEY_PART = 1 << 11
+  DICTIONARY_VALUE = 1 << 12
+  DICT_SET_GENERATOR = 1 << 13
+  COMP_EXPR = 1 << 14
+  COMP_FOR = 1 << 15
+  COMP_IF = 1 << 16
+  FUNC_DEF = 1 << 17
+  DECORATOR = 1 << 18
+  TYPED_NAME = 1 << 19
+  TYPED_NAME_ARG_LIST = 1 << 20
 
 
 class FormatToken(object):
@@ -71,6 +74,8 @@ class FormatToken(object):
       this is the first token in the unwrapped line.
     matching_bracket: If a bracket token ('[', '{', or '(') the matching
       bracket.
+    bracket_scope: If an opening bracket, the object_state.BracketScope of the
+      tokens up to its matching bracket.
     whitespace_prefix: The prefix for the whitespace.
     spaces_required_before: The number of spaces required before a token. This
       is a lower-bound for the formatter and not a hard requirement. For
@@ -84,6 +89,7 @@ class FormatToken(object):
       whitespace and this token. However, this doesn't include the initial
       indentation amount.
     split_penalty: The penalty for splitting the line before this token.
+    annotations: The pytree_utils.NodeAnnotations of the node.
   """
 
   def __init__(self, node):
@@ -93,9 +99,11 @@ class FormatToken(object):
       node: (pytree.Leaf) The node that's being wrapped.
     """
     self.node = node
+    self.annotations = pytree_utils.GetNodeAnnotations(node)
     self.next_token = None
     self.previous_token = None
     self.matching_bracket = None
+    self.bracket_scope = None
     self.whitespace_prefix = ''
     self.can_break_before = False
     self.must_break_before = False
@@ -103,7 +111,7 @@ class FormatToken(object):
     self.split_penalty = 0
 
     if self.is_comment:
-      self.spaces_required_before = style.Get('SPACES_BEFORE_COMMENT')
+      self.spaces_required_before = style.Current().SPACES_BEFORE_COMMENT
     else:
       self.spaces_required_before = 0
 
@@ -122,11 +130,12 @@ class FormatToken(object):
       spaces: (int) The number of spaces to place before the token.
       indent_level: (int) The indentation level.
     """
-    if style.Get('USE_TABS'):
+    current_style = style.Current()
+    if current_style.USE_TABS:
       indent_before = '\t' * indent_level + ' ' * spaces
     else:
       indent_before = (
-          ' ' * indent_level * style.Get('INDENT_WIDTH') + ' ' * spaces)
+          ' ' * indent_level * current_style.INDENT_WIDTH + ' ' * spaces)
 
     if self.is_comment:
       comment_lines = [s.lstrip() for s in self.value.splitlines()]
@@ -166,7 +175,7 @@ class FormatToken(object):
         (previous.is_pseudo_paren and previous.value != ')' and
          cur_lineno != previous.previous_token.lineno)):
       self.spaces_required_before = (
-          self.column - first_column + depth * style.Get('INDENT_WIDTH'))
+          self.column - first_column + depth * style.Current().INDENT_WIDTH)
       return
 
     cur_column = self.node.column
@@ -199,20 +208,18 @@ class FormatToken(object):
   @py3compat.lru_cache()
   def node_split_penalty(self):
     """Split penalty attached to the pytree node of this token."""
-    return pytree_utils.GetNodeAnnotation(
-        self.node, pytree_utils.Annotation.SPLIT_PENALTY, default=0)
+    split_penalty = self.annotations.split_penalty
+    return 0 if split_penalty is None else split_penalty
 
   @property
   def newlines(self):
     """The number of newlines needed before this token."""
-    return pytree_utils.GetNodeAnnotation(self.node,
-                                          pytree_utils.Annotation.NEWLINES)
+    return self.annotations.newlines
 
   @property
   def must_split(self):
     """Return true if the token requires a split before it."""
-    return pytree_utils.GetNodeAnnotation(self.node,
-                                          pytree_utils.Annotation.MUST_SPLIT)
+    return self.annotations.must_split
 
   @property
   def column(self):
@@ -225,18 +232,15 @@ class FormatToken(object):
     return self.node.lineno
 
   @property
-  @py3compat.lru_cache()
   def subtypes(self):
-    """Extra type information for directing formatting."""
-    value = pytree_utils.GetNodeAnnotation(self.node,
-                                           pytree_utils.Annotation.SUBTYPE)
-    return [Subtype.NONE] if value is None else value
+    """Extra type information for directing formatting, as Subtype flags."""
+    return self.annotations.subtype or Subtype.NONE
 
   @property
   @py3compat.lru_cache()
   def is_binary_op(self):
     """Token is a binary operator."""
-    return Subtype.BINARY_OPERATOR in self.subtypes
+    return bool(self.subtypes & Subtype.BINARY_OPERATOR)
 
   @property
   @py3compat.lru_cache()
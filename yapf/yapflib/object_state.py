@@ -22,6 +22,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+from yapf.yapflib import format_token
+
 
 class ComprehensionState(object):
   """Maintains the state of list comprehension formatting decisions.
@@ -29,6 +31,9 @@ class ComprehensionState(object):
   A stack of ComprehensionState objects are kept to ensure that list
   comprehensions are wrapped with well-defined rules.
 
+  ComprehensionState objects are immutable, so that they can be shared between
+  format decision states. Use Replace() to create a modified copy.
+
   Attributes:
     expr_token: The first token in the comprehension.
     for_token: The first 'for' token of the comprehension.
@@ -38,11 +43,20 @@ class ComprehensionState(object):
         That is, a split somewhere after expr_token or before closing_bracket.
   """
 
-  def __init__(self, expr_token):
+  __slots__ = ('expr_token', 'for_token', 'has_split_at_for',
+               'has_interior_split', '_hash')
+
+  def __init__(self,
+               expr_token,
+               for_token=None,
+               has_split_at_for=False,
+               has_interior_split=False):
     self.expr_token = expr_token
-    self.for_token = None
-    self.has_split_at_for = False
-    self.has_interior_split = False
+    self.for_token = for_token
+    self.has_split_at_for = has_split_at_for
+    self.has_interior_split = has_interior_split
+    self._hash = hash((expr_token, for_token, has_split_at_for,
+                       has_interior_split))
 
   def HasTrivialExpr(self):
     """Returns whether the comp_expr is "trivial" i.e. is a single token."""
@@ -56,12 +70,29 @@ class ComprehensionState(object):
   def closing_bracket(self):
     return self.opening_bracket.matching_bracket
 
-  def Clone(self):
-    clone = ComprehensionState(self.expr_token)
-    clone.for_token = self.for_token
-    clone.has_split_at_for = self.has_split_at_for
-    clone.has_interior_split = self.has_interior_split
-    return clone
+  def Replace(self,
+              for_token=None,
+              has_split_at_for=None,
+              has_interior_split=None):
+    """Return a copy of this state with the given attributes replaced.
+
+    Arguments:
+      for_token: (format_token.FormatToken) The new 'for' token or None to keep
+        the current one.
+      has_split_at_for: (bool) The new value or None to keep the current one.
+      has_interior_split: (bool) The new value or None to keep the current one.
+
+    Returns:
+      A new ComprehensionState object.
+    """
+    if for_token is None:
+      for_token = self.for_token
+    if has_split_at_for is None:
+      has_split_at_for = self.has_split_at_for
+    if has_interior_split is None:
+      has_interior_split = self.has_interior_split
+    return ComprehensionState(self.expr_token, for_token, has_split_at_for,
+                              has_interior_split)
 
   def __repr__(self):
     return ('[opening_bracket::%s, for_token::%s, has_split_at_for::%s,'
@@ -76,5 +107,99 @@ class ComprehensionState(object):
     return not self == other
 
   def __hash__(self, *args, **kwargs):
-    return hash((self.expr_token, self.for_token, self.has_split_at_for,
-                 self.has_interior_split))
+    return self._hash
+
+
+class BracketScope(object):
+  """Facts about the tokens between a pair of matching brackets.
+
+  These are gathered when the brackets are matched, so that the formatter can
+  look them up instead of walking the tokens in the scope each time.
+
+  Attributes:
+    opening_bracket: The opening bracket of the scope.
+    num_commas: The number of commas in the scope, not counting those in nested
+      scopes.
+    has_comment: Whether there's a comment anywhere in the scope.
+    first_brace: The first '{' in the scope that isn't in a nested scope, or
+      None if there isn't one.
+  """
+
+  __slots__ = ('opening_bracket', 'num_commas', 'has_comment', 'first_brace',
+               '_dict_entry_spans')
+
+  def __init__(self, opening_bracket):
+    self.opening_bracket = opening_bracket
+    self.num_commas = 0
+    self.has_comment = False
+    self.first_brace = None
+    self._dict_entry_spans = None
+
+  def DictEntrySpans(self):
+    """Get the dict entries in the scope that should each fit on one line.
+
+    Returns:
+      A pair of a list of the (first, last) tokens of the entries, and the
+      (first, last) tokens of the final entry. The final entry is None if the
+      entries after a multiline value don't matter.
+    """
+    if self._dict_entry_spans is None:
+      self._dict_entry_spans = _DictEntrySpans(self.opening_bracket)
+    return self._dict_entry_spans
+
+
+def _DictEntrySpans(opening):
+  """Walk the dict entries in the scope, see BracketScope.DictEntrySpans."""
+  spans = []
+  closing = opening.matching_bracket
+  entry_start = opening.next_token
+  current = opening.next_token.next_token
+
+  while current and current != closing:
+    if current.subtypes & format_token.Subtype.DICTIONARY_KEY:
+      spans.append((entry_start, _PreviousNonCommentToken(current)))
+      entry_start = current
+    if current.OpensScope():
+      if ((current.value == '{' or
+           (current.is_pseudo_paren and current.next_token.value == '{') and
+           current.subtypes & format_token.Subtype.DICTIONARY_VALUE) or
+          _ImplicitStringConcatenation(current)):
+        # A dictionary entry that cannot fit on a single line shouldn't matter
+        # to this calculation. If it can't fit on a single line, then the
+        # opening should be on the same line as the key and the rest on
+        # newlines after it. But the other entries should be on single lines
+        # if possible.
+        if current.matching_bracket:
+          current = current.matching_bracket
+        while current:
+          if current == closing:
+            return spans, None
+          if current.subtypes & format_token.Subtype.DICTIONARY_KEY:
+            entry_start = current
+            break
+          current = current.next_token
+      else:
+        current = current.matching_bracket
+    else:
+      current = current.next_token
+
+  # At this point, current is the closing bracket. Go back one to get the the
+  # end of the dictionary entry.
+  return spans, (entry_start, _PreviousNonCommentToken(current))
+
+
+def _PreviousNonCommentToken(tok):
+  tok = tok.previous_token
+  while tok.is_comment:
+    tok = tok.previous_token
+  return tok
+
+
+def _ImplicitStringConcatenation(tok):
+  num_strings = 0
+  if tok.is_pseudo_paren:
+    tok = tok.next_token
+  while tok.is_string:
+    num_strings += 1
+    tok = tok.next_token
+  return num_strings > 1
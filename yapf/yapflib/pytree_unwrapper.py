@@ -31,6 +31,7 @@ For most uses, the convenience function UnwrapPyTree should be sufficient.
 from lib2to3 import pytree
 from lib2to3.pgen2 import token as grammar_token
 
+from yapf.yapflib import object_state
 from yapf.yapflib import pytree_utils
 from yapf.yapflib import pytree_visitor
 from yapf.yapflib import split_penalty
@@ -47,10 +48,8 @@ def UnwrapPyTree(tree):
     A list of UnwrappedLine objects.
   """
   unwrapper = PyTreeUnwrapper()
-  unwrapper.Visit(tree)
-  uwlines = unwrapper.GetUnwrappedLines()
-  uwlines.sort(key=lambda x: x.lineno)
-  return uwlines
+  pytree_visitor.RunPasses(tree, [unwrapper])
+  return unwrapper.GetUnwrappedLines()
 
 
 # Grammar tokens considered as whitespace for the purpose of unwrapping.
@@ -60,21 +59,26 @@ _WHITESPACE_TOKENS = frozenset([
 ])
 
 
-class PyTreeUnwrapper(pytree_visitor.PyTreeVisitor):
+class PyTreeUnwrapper(pytree_visitor.PyTreePass):
   """PyTreeUnwrapper - see file-level docstring for detailed description.
 
-  Note: since this implements PyTreeVisitor and node names in lib2to3 are
-  underscore_separated, the visiting methods of this class are named as
-  Visit_node_name. invalid-name pragmas are added to each such method to silence
-  a style warning. This is forced on us by the usage of lib2to3, and re-munging
-  method names to make them different from actual node names sounded like a
-  confusing and brittle affair that wasn't worth it for this small & controlled
-  deviation from the style guide.
+  Note: since this implements PyTreePass and node names in lib2to3 are
+  underscore_separated, the hooks of this class are named as Enter_node_name
+  and Leave_node_name. invalid-name pragmas are added to each such method to
+  silence a style warning. This is forced on us by the usage of lib2to3, and
+  re-munging method names to make them different from actual node names
+  sounded like a confusing and brittle affair that wasn't worth it for this
+  small & controlled deviation from the style guide.
 
-  To understand the connection between visitor methods in this class, some
+  To understand the connection between the hooks in this class, some
   familiarity with the Python grammar is required.
   """
 
+  NAME = 'unwrapper'
+  # The brackets of the lines are matched and the split penalties adjusted once
+  # the walk is over, and the adjustments take precedence.
+  RUNS_AFTER = ('split_penalty',)
+
   def __init__(self):
     # A list of all unwrapped lines finished visiting so far.
     self._unwrapped_lines = []
@@ -89,14 +93,20 @@ class PyTreeUnwrapper(pytree_visitor.PyTreeVisitor):
   def GetUnwrappedLines(self):
     """Fetch the result of the tree walk.
 
-    Note: only call this after visiting the whole tree.
+    Note: only call this after the walk is over.
 
     Returns:
-      A list of UnwrappedLine objects.
+      A list of UnwrappedLine objects, sorted by their line numbers.
     """
+    return self._unwrapped_lines
+
+  def Finish(self):
     # Make sure the last line that was being populated is flushed.
     self._StartNewLine()
-    return self._unwrapped_lines
+    for uwline in self._unwrapped_lines:
+      _MatchBrackets(uwline)
+      _AdjustSplitPenalty(uwline)
+    self._unwrapped_lines.sort(key=lambda x: x.lineno)
 
   def _StartNewLine(self):
     """Finish current line and start a new one.
@@ -106,8 +116,6 @@ class PyTreeUnwrapper(pytree_visitor.PyTreeVisitor):
     """
     if self._cur_unwrapped_line.tokens:
       self._unwrapped_lines.append(self._cur_unwrapped_line)
-      _MatchBrackets(self._cur_unwrapped_line)
-      _AdjustSplitPenalty(self._cur_unwrapped_line)
     self._cur_unwrapped_line = unwrapped_line.UnwrappedLine(self._cur_depth)
 
   _STMT_TYPES = frozenset({
@@ -122,7 +130,7 @@ class PyTreeUnwrapper(pytree_visitor.PyTreeVisitor):
   })
 
   # pylint: disable=invalid-name,missing-docstring
-  def Visit_simple_stmt(self, node):
+  def Enter_simple_stmt(self, node):
     # A 'simple_stmt' conveniently represents a non-compound Python statement,
     # i.e. a statement that does not contain other statements.
 
@@ -133,144 +141,85 @@ class PyTreeUnwrapper(pytree_visitor.PyTreeVisitor):
     # standalone comment and in the case of it coming directly after the
     # funcdef, it is a "top" comment for the whole function.
     # TODO(eliben): add more relevant compound statements here.
-    single_stmt_suite = (
-        node.parent and pytree_utils.NodeName(node.parent) in self._STMT_TYPES)
-    is_comment_stmt = pytree_utils.IsCommentStatement(node)
-    if single_stmt_suite and not is_comment_stmt:
+    if self._IsSingleStmtSuite(node):
       self._cur_depth += 1
     self._StartNewLine()
-    self.DefaultNodeVisit(node)
-    if single_stmt_suite and not is_comment_stmt:
-      self._cur_depth -= 1
 
-  def _VisitCompoundStatement(self, node, substatement_names):
-    """Helper for visiting compound statements.
-
-    Python compound statements serve as containers for other statements. Thus,
-    when we encounter a new compound statement we start a new unwrapped line.
+  def Leave_simple_stmt(self, node):
+    if self._IsSingleStmtSuite(node):
+      self._cur_depth -= 1
 
-    Arguments:
-      node: the node to visit.
-      substatement_names: set of node names. A compound statement will be
-        recognized as a NAME node with a name in this set.
-    """
-    for child in node.children:
-      # A pytree is structured in such a way that a single 'if_stmt' node will
-      # contain all the 'if', 'elif' and 'else' nodes as children (similar
-      # structure applies to 'while' statements, 'try' blocks, etc). Therefore,
-      # we visit all children here and create a new line before the requested
-      # set of nodes.
-      if (child.type == grammar_token.NAME and
-          child.value in substatement_names):
+  def _IsSingleStmtSuite(self, node):
+    single_stmt_suite = (
+        node.parent and pytree_utils.NodeName(node.parent) in self._STMT_TYPES)
+    return single_stmt_suite and not pytree_utils.IsCommentStatement(node)
+
+  # A pytree is structured in such a way that a single 'if_stmt' node will
+  # contain all the 'if', 'elif' and 'else' nodes as children (similar structure
+  # applies to 'while' statements, 'try' blocks, etc). Therefore, a new line is
+  # started before the NAME children of these compound statements that begin
+  # their parts.
+  _COMPOUND_STMT_ELEMS = {
+      'if_stmt': frozenset({'if', 'else', 'elif'}),
+      'while_stmt': frozenset({'while', 'else'}),
+      'for_stmt': frozenset({'for', 'else'}),
+      'try_stmt': frozenset({'try', 'except', 'else', 'finally'}),
+      'except_clause': frozenset({'except'}),
+      'funcdef': frozenset({'def'}),
+      'classdef': frozenset({'class'}),
+      'with_stmt': frozenset({'with'}),
+  }
+
+  _ASYNC_STMT_TYPES = frozenset({'async_funcdef', 'async_stmt'})
+
+  def Enter_NAME(self, leaf):
+    elems = self._COMPOUND_STMT_ELEMS.get(pytree_utils.NodeName(leaf.parent))
+    if elems and leaf.value in elems:
+      # The statement after an 'async' continues its line.
+      grandparent_name = pytree_utils.NodeName(leaf.parent.parent)
+      if grandparent_name not in self._ASYNC_STMT_TYPES:
         self._StartNewLine()
-      self.Visit(child)
-
-  _IF_STMT_ELEMS = frozenset({'if', 'else', 'elif'})
-
-  def Visit_if_stmt(self, node):  # pylint: disable=invalid-name
-    self._VisitCompoundStatement(node, self._IF_STMT_ELEMS)
-
-  _WHILE_STMT_ELEMS = frozenset({'while', 'else'})
-
-  def Visit_while_stmt(self, node):  # pylint: disable=invalid-name
-    self._VisitCompoundStatement(node, self._WHILE_STMT_ELEMS)
-
-  _FOR_STMT_ELEMS = frozenset({'for', 'else'})
+    self.DefaultLeafEnter(leaf)
 
-  def Visit_for_stmt(self, node):  # pylint: disable=invalid-name
-    self._VisitCompoundStatement(node, self._FOR_STMT_ELEMS)
-
-  _TRY_STMT_ELEMS = frozenset({'try', 'except', 'else', 'finally'})
-
-  def Visit_try_stmt(self, node):  # pylint: disable=invalid-name
-    self._VisitCompoundStatement(node, self._TRY_STMT_ELEMS)
-
-  _EXCEPT_STMT_ELEMS = frozenset({'except'})
-
-  def Visit_except_clause(self, node):  # pylint: disable=invalid-name
-    self._VisitCompoundStatement(node, self._EXCEPT_STMT_ELEMS)
-
-  _FUNC_DEF_ELEMS = frozenset({'def'})
-
-  def Visit_funcdef(self, node):  # pylint: disable=invalid-name
-    self._VisitCompoundStatement(node, self._FUNC_DEF_ELEMS)
-
-  def Visit_async_funcdef(self, node):  # pylint: disable=invalid-name
+  def Enter_async_funcdef(self, node):
     self._StartNewLine()
-    index = 0
-    for child in node.children:
-      index += 1
-      self.Visit(child)
-      if pytree_utils.NodeName(child) == 'ASYNC':
-        break
-    for child in node.children[index].children:
-      self.Visit(child)
-
-  _CLASS_DEF_ELEMS = frozenset({'class'})
-
-  def Visit_classdef(self, node):  # pylint: disable=invalid-name
-    self._VisitCompoundStatement(node, self._CLASS_DEF_ELEMS)
 
-  def Visit_async_stmt(self, node):  # pylint: disable=invalid-name
+  def Enter_async_stmt(self, node):
     self._StartNewLine()
-    index = 0
-    for child in node.children:
-      index += 1
-      self.Visit(child)
-      if pytree_utils.NodeName(child) == 'ASYNC':
-        break
-    for child in node.children[index].children:
-      self.Visit(child)
-
-  def Visit_decorators(self, node):  # pylint: disable=invalid-name
-    for child in node.children:
-      self._StartNewLine()
-      self.Visit(child)
-
-  def Visit_decorated(self, node):  # pylint: disable=invalid-name
-    for child in node.children:
-      self._StartNewLine()
-      self.Visit(child)
-
-  _WITH_STMT_ELEMS = frozenset({'with'})
 
-  def Visit_with_stmt(self, node):  # pylint: disable=invalid-name
-    self._VisitCompoundStatement(node, self._WITH_STMT_ELEMS)
+  def Enter_decorator(self, node):
+    # Each decorator of a definition is on a line of its own.
+    self._StartNewLine()
 
-  def Visit_suite(self, node):  # pylint: disable=invalid-name
+  def Enter_suite(self, node):
     # A 'suite' starts a new indentation level in Python.
     self._cur_depth += 1
     self._StartNewLine()
-    self.DefaultNodeVisit(node)
+
+  def Leave_suite(self, node):
     self._cur_depth -= 1
 
-  def Visit_listmaker(self, node):  # pylint: disable=invalid-name
+  def Enter_listmaker(self, node):
     _DetermineMustSplitAnnotation(node)
-    self.DefaultNodeVisit(node)
 
-  def Visit_dictsetmaker(self, node):  # pylint: disable=invalid-name
+  def Enter_dictsetmaker(self, node):
     _DetermineMustSplitAnnotation(node)
-    self.DefaultNodeVisit(node)
 
-  def Visit_import_as_names(self, node):  # pylint: disable=invalid-name
+  def Enter_import_as_names(self, node):
     if node.prev_sibling.value == '(':
       _DetermineMustSplitAnnotation(node)
-    self.DefaultNodeVisit(node)
 
-  def Visit_testlist_gexp(self, node):  # pylint: disable=invalid-name
+  def Enter_testlist_gexp(self, node):
     _DetermineMustSplitAnnotation(node)
-    self.DefaultNodeVisit(node)
 
-  def Visit_arglist(self, node):  # pylint: disable=invalid-name
+  def Enter_arglist(self, node):
     _DetermineMustSplitAnnotation(node)
-    self.DefaultNodeVisit(node)
 
-  def Visit_typedargslist(self, node):  # pylint: disable=invalid-name
+  def Enter_typedargslist(self, node):
     _DetermineMustSplitAnnotation(node)
-    self.DefaultNodeVisit(node)
 
-  def DefaultLeafVisit(self, leaf):
-    """Default visitor for tree leaves.
+  def DefaultLeafEnter(self, leaf):
+    """Default hook for tree leaves.
 
     A tree leaf is always just gets appended to the current unwrapped line.
 
@@ -292,19 +241,32 @@ def _MatchBrackets(uwline):
 
   For every open bracket ('[', '{', or '('), find the associated closing bracket
   and "match" them up. I.e., save in the token a pointer to its associated open
-  or close bracket.
+  or close bracket. Also gather the facts about the tokens in between into the
+  open bracket's BracketScope.
 
   Arguments:
     uwline: (UnwrappedLine) An unwrapped line.
   """
   bracket_stack = []
   for token in uwline.tokens:
+    if bracket_stack:
+      scope = bracket_stack[-1].bracket_scope
+      if token.value == ',':
+        scope.num_commas += 1
+      elif token.value == '{' and not scope.first_brace:
+        scope.first_brace = token
+      elif token.is_comment:
+        scope.has_comment = True
+
     if token.value in pytree_utils.OPENING_BRACKETS:
+      token.bracket_scope = object_state.BracketScope(token)
       bracket_stack.append(token)
     elif token.value in pytree_utils.CLOSING_BRACKETS:
       bracket_stack[-1].matching_bracket = token
       token.matching_bracket = bracket_stack[-1]
-      bracket_stack.pop()
+      scope = bracket_stack.pop().bracket_scope
+      if scope.has_comment and bracket_stack:
+        bracket_stack[-1].bracket_scope.has_comment = True
 
 
 def _AdjustSplitPenalty(uwline):
@@ -319,9 +281,7 @@ def _AdjustSplitPenalty(uwline):
   bracket_level = 0
   for index, token in enumerate(uwline.tokens):
     if index and not bracket_level:
-      pytree_utils.SetNodeAnnotation(token.node,
-                                     pytree_utils.Annotation.SPLIT_PENALTY,
-                                     split_penalty.UNBREAKABLE)
+      token.annotations.split_penalty = split_penalty.UNBREAKABLE
     if token.value in pytree_utils.OPENING_BRACKETS:
       bracket_level += 1
     elif token.value in pytree_utils.CLOSING_BRACKETS:
@@ -331,7 +291,7 @@ def _AdjustSplitPenalty(uwline):
 def _DetermineMustSplitAnnotation(node):
   """Enforce a split in the list if the list ends with a comma."""
   if not _ContainsComments(node):
-    token = next(node.parent.leaves())
+    token = next(pytree_utils.IterLeaves(node.parent))
     if token.value == '(':
       if sum(1 for ch in node.children
              if pytree_utils.NodeName(ch) == 'COMMA') < 2:
@@ -356,21 +316,13 @@ def _DetermineMustSplitAnnotation(node):
 
 def _ContainsComments(node):
   """Return True if the list has a comment in it."""
-  if isinstance(node, pytree.Leaf):
-    return node.type == grammar_token.COMMENT
-  for child in node.children:
-    if _ContainsComments(child):
-      return True
-  return False
+  return any(leaf.type == grammar_token.COMMENT
+             for leaf in pytree_utils.IterLeaves(node))
 
 
 def _SetMustSplitOnFirstLeaf(node):
   """Set the "must split" annotation on the first leaf node."""
 
-  def FindFirstLeaf(node):
-    if isinstance(node, pytree.Leaf):
-      return node
-    return FindFirstLeaf(node.children[0])
-
-  pytree_utils.SetNodeAnnotation(
-      FindFirstLeaf(node), pytree_utils.Annotation.MUST_SPLIT, True)
+  while not isinstance(node, pytree.Leaf):
+    node = node.children[0]
+  pytree_utils.SetNodeAnnotation(node, pytree_utils.Annotation.MUST_SPLIT, True)
@@ -22,15 +22,20 @@ the lib2to3 library.
   InsertNodeBefore(): insert a node before another in a pytree.
   InsertNodeAfter(): insert a node after another in a pytree.
   {Get,Set}NodeAnnotation(): manage custom annotations on pytree nodes.
+  GetNodeAnnotations(): the annotations of a pytree node, for direct access.
 """
 
 import ast
+import keyword
 
 from lib2to3 import pygram
 from lib2to3 import pytree
 from lib2to3.pgen2 import driver
 from lib2to3.pgen2 import parse
 from lib2to3.pgen2 import token
+from lib2to3.pgen2 import tokenize
+
+from yapf.yapflib import py3compat
 
 # TODO(eliben): We may want to get rid of this filtering at some point once we
 # have a better understanding of what information we need from the tree. Then,
@@ -69,55 +74,160 @@ def NodeName(node):
     return pygram.python_grammar.number2symbol[node.type]
 
 
-# lib2to3 thoughtfully provides pygram.python_grammar_no_print_statement for
-# parsing Python 3 code that wouldn't parse otherwise (when 'print' is used in a
-# context where a keyword is disallowed).
-# It forgets to do the same for 'exec' though. Luckily, Python is amenable to
-# monkey-patching.
-_GRAMMAR_FOR_PY3 = pygram.python_grammar_no_print_statement.copy()
-del _GRAMMAR_FOR_PY3.keywords['exec']
+def IterLeaves(node):
+  """Yield the leaves of the node's subtree, in order.
 
-_GRAMMAR_FOR_PY2 = pygram.python_grammar.copy()
-del _GRAMMAR_FOR_PY2.keywords['nonlocal']
+  Unlike pytree.Base.leaves(), this doesn't recurse, so it works on subtrees
+  that are nested too deeply for the recursion limit. Like it, the children are
+  read as the leaves are yielded.
 
+  Arguments:
+    node: a tree node
 
-def ParseCodeToTree(code):
+  Yields:
+    The leaves of the subtree, which is the node itself if it's a leaf.
+  """
+  if isinstance(node, pytree.Leaf):
+    yield node
+    return
+  stack = [iter(node.children)]
+  while stack:
+    child = next(stack[-1], None)
+    if child is None:
+      stack.pop()
+    elif isinstance(child, pytree.Leaf):
+      yield child
+    else:
+      stack.append(iter(child.children))
+
+
+def _CreateGrammarForPy3():
+  # lib2to3 thoughtfully provides pygram.python_grammar_no_print_statement for
+  # parsing Python 3 code that wouldn't parse otherwise (when 'print' is used in
+  # a context where a keyword is disallowed).
+  # It forgets to do the same for 'exec' though. Luckily, Python is amenable to
+  # monkey-patching.
+  grammar = pygram.python_grammar_no_print_statement.copy()
+  del grammar.keywords['exec']
+  return grammar
+
+
+def _CreateGrammarForPy2():
+  grammar = pygram.python_grammar.copy()
+  del grammar.keywords['nonlocal']
+  return grammar
+
+
+_PY3 = 'py3'
+_PY2 = 'py2'
+
+# The Python versions whose grammar code can be parsed with.
+TARGET_VERSIONS = (_PY2, _PY3)
+
+_GRAMMAR_FACTORIES = {
+    _PY3: _CreateGrammarForPy3,
+    _PY2: _CreateGrammarForPy2,
+}
+
+# The parser drivers, keyed by the Python version of their grammar. They're
+# created on first use and reused for the rest of the process: a driver keeps
+# no state between parses, so it can be shared by threads too.
+_DRIVERS = {}
+
+
+def _GetDriver(version):
+  """Return the parser driver for the grammar of the Python version."""
+  parser_driver = _DRIVERS.get(version)
+  if parser_driver is None:
+    parser_driver = driver.Driver(
+        _GRAMMAR_FACTORIES[version](), convert=pytree.convert)
+    _DRIVERS[version] = parser_driver
+  return parser_driver
+
+
+def ParseCodeToTree(code, target_version=None):
   """Parse the given code to a lib2to3 pytree.
 
   Arguments:
     code: a string with the code to parse.
+    target_version: (string) One of TARGET_VERSIONS, to parse the code with
+      the grammar of that Python version only. If None, the grammar is picked
+      by looking at the code's tokens, and the other one is tried if that
+      fails.
 
   Raises:
     SyntaxError if the code is invalid syntax.
     parse.ParseError if some other parsing failure.
+    ValueError if target_version isn't one of TARGET_VERSIONS.
 
   Returns:
     The root node of the parsed tree.
   """
   # This function is tiny, but the incantation for invoking the parser correctly
   # is sufficiently magical to be worth abstracting away.
-  try:
-    # Try to parse using a Python 3 grammar, which is more permissive (print and
-    # exec are not keywords).
-    parser_driver = driver.Driver(_GRAMMAR_FOR_PY3, convert=pytree.convert)
-    tree = parser_driver.parse_string(code, debug=False)
-  except parse.ParseError:
-    # Now try to parse using a Python 2 grammar; If this fails, then
-    # there's something else wrong with the code.
+  if target_version is not None and target_version not in TARGET_VERSIONS:
+    raise ValueError('unknown target version: %r' % target_version)
+
+  # The tokens don't depend on the grammar, so the code is tokenized only once
+  # however many grammars it's parsed with.
+  tokens = _Tokenize(code)
+  if target_version is not None:
+    versions = [target_version]
+  elif _HasPython2Statements(tokens):
+    versions = [_PY2, _PY3]
+  else:
+    # The Python 3 grammar is more permissive (print and exec are not
+    # keywords), so it's tried first.
+    versions = [_PY3, _PY2]
+
+  for version in versions:
     try:
-      parser_driver = driver.Driver(_GRAMMAR_FOR_PY2, convert=pytree.convert)
-      tree = parser_driver.parse_string(code, debug=False)
+      tree = _GetDriver(version).parse_tokens(iter(tokens), debug=False)
+      break
     except parse.ParseError:
-      # Raise a syntax error if the code is invalid python syntax.
-      try:
-        ast.parse(code)
-      except SyntaxError as e:
-        raise e
-      else:
-        raise
+      if version == versions[-1]:
+        # Raise a syntax error if the code is invalid python syntax.
+        try:
+          ast.parse(code)
+        except SyntaxError as e:
+          raise e
+        else:
+          raise
   return _WrapEndMarker(tree)
 
 
+def _Tokenize(code):
+  """Return the list of lib2to3 tokens of the code."""
+  lines = code.split('\n')
+  lines = iter([line + '\n' for line in lines[:-1]] + lines[-1:])
+  return list(tokenize.generate_tokens(lambda: next(lines, '')))
+
+
+def _HasPython2Statements(tokens):
+  """Whether the tokens contain print or exec statements.
+
+  With the Python 3 grammar, 'print' and 'exec' are names, and a name can't be
+  followed by a string, a number or another name that isn't a keyword. So when
+  that happens, the code only parses with the Python 2 grammar.
+
+  Arguments:
+    tokens: (list) The lib2to3 tokens of the code.
+
+  Returns:
+    True if the code should be parsed with the Python 2 grammar first.
+  """
+  for index in py3compat.range(len(tokens) - 1):
+    tok_type, value = tokens[index][:2]
+    if tok_type != token.NAME or value not in ('print', 'exec'):
+      continue
+    next_type, next_value = tokens[index + 1][:2]
+    if next_type in (token.STRING, token.NUMBER):
+      return True
+    if next_type == token.NAME and not keyword.iskeyword(next_value):
+      return True
+  return False
+
+
 def _WrapEndMarker(tree):
   """Wrap a single ENDMARKER token in a "file_input" node.
 
@@ -193,18 +303,85 @@ def _InsertNodeAt(new_node, target, after=False):
   for i, child in enumerate(parent_of_target.children):
     if child is target:
       insertion_index = i + 1 if after else i
-      parent_of_target.insert_child(insertion_index, new_node)
+      # Like pytree.Node.insert_child(), but without pytree.Base.changed(),
+      # which recurses up to the root to set a flag that yapf doesn't use.
+      new_node.parent = parent_of_target
+      parent_of_target.children.insert(insertion_index, new_node)
+      if hasattr(parent_of_target, 'invalidate_sibling_maps'):
+        # Some versions of lib2to3 cache the siblings.
+        parent_of_target.invalidate_sibling_maps()
       return
 
   raise RuntimeError('unable to find insertion point for target node',
                      (target,))
 
 
-# The following constant and functions implement a simple custom annotation
-# mechanism for pytree nodes. We attach new attributes to nodes. Each attribute
-# is prefixed with _NODE_ANNOTATION_PREFIX. These annotations should only be
-# managed through GetNodeAnnotation and SetNodeAnnotation.
-_NODE_ANNOTATION_PREFIX = '_yapf_annotation_'
+# The following class and functions implement a simple custom annotation
+# mechanism for pytree nodes. A node's annotations are kept in a NodeAnnotations
+# object, attached to the node as the attribute named by _NODE_ANNOTATIONS.
+# These annotations should only be managed through the functions below.
+_NODE_ANNOTATIONS = '_yapf_annotations'
+
+
+class NodeAnnotations(object):
+  """The annotations of a pytree node.
+
+  The annotations named in Annotation are fields, which are None until they're
+  set. Code that reads or writes them in a loop should get the node's
+  NodeAnnotations once with GetNodeAnnotations() and then use the fields.
+
+  Attributes:
+    child_indent: (unicode) The indentation of the node's children.
+    newlines: (int) The number of newlines required before the node.
+    must_split: (bool) True if the line must be split before the node.
+    split_penalty: (int) The penalty for splitting the line before the node.
+    subtype: (int) The format_token.Subtype flags of the node.
+  """
+
+  __slots__ = ('child_indent', 'newlines', 'must_split', 'split_penalty',
+               'subtype', '_other')
+
+  def __init__(self):
+    self.child_indent = None
+    self.newlines = None
+    self.must_split = None
+    self.split_penalty = None
+    self.subtype = None
+    self._other = None
+
+  def Get(self, annotation, default=None):
+    """Return the value of the named annotation, or default if it's unset."""
+    if annotation in _ANNOTATION_FIELDS:
+      value = getattr(self, annotation)
+    elif self._other:
+      value = self._other.get(annotation)
+    else:
+      value = None
+    return default if value is None else value
+
+  def Set(self, annotation, value):
+    """Set the value of the named annotation."""
+    if annotation in _ANNOTATION_FIELDS:
+      setattr(self, annotation, value)
+    else:
+      if self._other is None:
+        self._other = {}
+      self._other[annotation] = value
+
+
+_ANNOTATION_FIELDS = frozenset([
+    Annotation.CHILD_INDENT, Annotation.NEWLINES, Annotation.MUST_SPLIT,
+    Annotation.SPLIT_PENALTY, Annotation.SUBTYPE
+])
+
+
+def GetNodeAnnotations(node):
+  """Return the NodeAnnotations of a node, creating them if it has none."""
+  annotations = getattr(node, _NODE_ANNOTATIONS, None)
+  if annotations is None:
+    annotations = NodeAnnotations()
+    setattr(node, _NODE_ANNOTATIONS, annotations)
+  return annotations
 
 
 def GetNodeAnnotation(node, annotation, default=None):
@@ -219,7 +396,10 @@ def GetNodeAnnotation(node, annotation, default=None):
     Value of the annotation in the given node. If the node doesn't have this
     particular annotation name yet, returns default.
   """
-  return getattr(node, _NODE_ANNOTATION_PREFIX + annotation, default)
+  annotations = getattr(node, _NODE_ANNOTATIONS, None)
+  if annotations is None:
+    return default
+  return annotations.Get(annotation, default)
 
 
 def SetNodeAnnotation(node, annotation, value):
@@ -230,33 +410,30 @@ def SetNodeAnnotation(node, annotation, value):
     annotation: annotation name - a string.
     value: annotation value to set.
   """
-  setattr(node, _NODE_ANNOTATION_PREFIX + annotation, value)
+  GetNodeAnnotations(node).Set(annotation, value)
 
 
-def AppendNodeAnnotation(node, annotation, value):
-  """Appends an annotation value to a list of annotations on the node.
+def AppendSubtypeAnnotation(node, value):
+  """Adds a subtype flag to the subtype annotations on the node.
 
   Arguments:
     node: the node.
-    annotation: annotation name - a string.
-    value: annotation value to set.
+    value: the format_token.Subtype flag to add.
   """
-  attr = GetNodeAnnotation(node, annotation, set())
-  attr.add(value)
-  SetNodeAnnotation(node, annotation, attr)
+  annotations = GetNodeAnnotations(node)
+  annotations.subtype = (annotations.subtype or 0) | value
 
 
 def RemoveSubtypeAnnotation(node, value):
-  """Removes an annotation value from the subtype annotations on the node.
+  """Removes a subtype flag from the subtype annotations on the node.
 
   Arguments:
     node: the node.
-    value: annotation value to remove.
+    value: the format_token.Subtype flag to remove.
   """
-  attr = GetNodeAnnotation(node, Annotation.SUBTYPE)
-  if attr and value in attr:
-    attr.remove(value)
-    SetNodeAnnotation(node, Annotation.SUBTYPE, attr)
+  annotations = getattr(node, _NODE_ANNOTATIONS, None)
+  if annotations is not None and annotations.subtype:
+    annotations.subtype &= ~value
 
 
 def DumpNodeToString(node):
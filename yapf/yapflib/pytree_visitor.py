@@ -17,21 +17,68 @@ The lib2to3 parser produces a "pytree" - syntax tree consisting of Node
 and Leaf types. This module implements a visitor pattern for such trees.
 
 It also exports a basic "dumping" visitor that dumps a textual representation of
-a pytree into a stream.
+a pytree into a stream, and a framework for running several passes over a pytree
+in a shared walk.
 
   PyTreeVisitor: a generic visitor pattern fo pytrees.
+  PyTreePass: a pass that can share a walk of the tree with other passes.
+  RunPasses(): run passes over a pytree in as few walks as possible.
   PyTreeDumper: a configurable "dumper" for displaying pytrees.
   DumpPyTree(): a convenience function to dump a pytree.
 """
 
 import sys
+import types
 
-from lib2to3 import pytree
+from lib2to3 import pygram
+from lib2to3.pgen2 import token
 
 from yapf.yapflib import pytree_utils
 
+# The names of the node types, indexed by type. Types < 256 are tokens, and
+# types >= 256 are grammar symbols.
+_TYPE_NAMES = ([token.tok_name.get(node_type) for node_type in range(256)] + [
+    pygram.python_grammar.number2symbol.get(node_type)
+    for node_type in range(256,
+                           max(pygram.python_grammar.number2symbol) + 1)
+])
 
-class PyTreeVisitor(object):
+
+class _DispatchTableMeta(type):
+  """Builds the dispatch tables of a class when the class is created.
+
+  A class lists its tables in _DISPATCH_TABLES, as tuples of:
+
+    (table attribute, method prefix, default for leaves, default for nodes)
+
+  A table is a list, indexed by node type, of the functions of the methods named
+  after the types with the prefix, or else of the default methods. A default of
+  None leaves None in the table.
+
+  Since the tables are built once, methods set on a class after it's created
+  aren't dispatched to.
+  """
+
+  def __init__(cls, name, bases, namespace):
+    super(_DispatchTableMeta, cls).__init__(name, bases, namespace)
+    for table, prefix, leaf_default, node_default in cls._DISPATCH_TABLES:
+      functions = []
+      for node_type, type_name in enumerate(_TYPE_NAMES):
+        default = leaf_default if node_type < 256 else node_default
+        method = getattr(cls, prefix + str(type_name), None)
+        if method is None and default is not None:
+          method = getattr(cls, default)
+        # The functions of unbound methods are called with the instance.
+        functions.append(getattr(method, '__func__', method))
+      setattr(cls, table, functions)
+
+
+# The base of the classes with dispatch tables, compatible with Python 2 and 3.
+_WithDispatchTables = _DispatchTableMeta('_WithDispatchTables', (object,),
+                                         {'_DISPATCH_TABLES': ()})
+
+
+class PyTreeVisitor(_WithDispatchTables):
   """Visitor pattern for pytree trees.
 
   Methods named Visit_XXX will be invoked when a node with type XXX is
@@ -52,30 +99,41 @@ class PyTreeVisitor(object):
   For more complex behavior, the visit, DefaultNodeVisit and DefaultLeafVisit
   methods can be overridden. Don't forget to invoke DefaultNodeVisit for nodes
   that may have children - otherwise the children will not be visited.
+
+  The method for each node type is looked up once, when the class is created,
+  into a table indexed by the node type.
   """
 
+  _DISPATCH_TABLES = (('_visit_table', 'Visit_', 'DefaultLeafVisit',
+                       'DefaultNodeVisit'),)
+
   def Visit(self, node):
     """Visit a node."""
-    method = 'Visit_{0}'.format(pytree_utils.NodeName(node))
-    if hasattr(self, method):
-      # Found a specific visitor for this node
-      getattr(self, method)(node)
-    else:
-      if isinstance(node, pytree.Leaf):
-        self.DefaultLeafVisit(node)
-      else:
-        self.DefaultNodeVisit(node)
+    self._visit_table[node.type](self, node)
 
   def DefaultNodeVisit(self, node):
     """Default visitor for Node: visits the node's children depth-first.
 
     This method is invoked when no specific visitor for the node is defined.
 
+    The children are visited with an explicit stack of iterators while they
+    aren't visited by a method other than this one, so that deeply nested trees
+    don't exceed the recursion limit.
+
     Arguments:
       node: the node to visit
     """
-    for child in node.children:
-      self.Visit(child)
+    stack = [iter(node.children)]
+    while stack:
+      child = next(stack[-1], None)
+      if child is None:
+        stack.pop()
+        continue
+      visit = self._visit_table[child.type]
+      if visit is _DEFAULT_NODE_VISIT:
+        stack.append(iter(child.children))
+      else:
+        visit(self, child)
 
   def DefaultLeafVisit(self, leaf):
     """Default visitor for Leaf: no-op.
@@ -88,6 +146,190 @@ class PyTreeVisitor(object):
     pass
 
 
+class PyTreePass(_WithDispatchTables):
+  """A pass over a pytree that can share a walk of the tree with other passes.
+
+  A PyTreeVisitor drives the walk itself, so each visitor walks the whole tree
+  on its own. A pass only reacts to a walk: RunPasses() walks the tree once for
+  a group of passes and calls their hooks along the way.
+
+  Methods named Enter_XXX are invoked when a node with type XXX is entered,
+  before its children are walked. Methods named Leave_XXX are invoked when it's
+  left, after its children are walked. Nodes without such a method are handed
+  to DefaultNodeEnter and DefaultNodeLeave, and leaves to DefaultLeafEnter.
+  Leaves are only entered. Finish is invoked once the walk is over.
+
+  Passes can insert nodes into the tree and replace nodes, but only among the
+  children of nodes that were entered already. The children of a node are
+  walked as they are once every pass entered the node, so nodes inserted later
+  aren't walked.
+
+  The passes of a walk see each node in the order they were given to
+  RunPasses(). A pass declares the passes it depends on by their NAME:
+
+    RUNS_AFTER: passes that must have seen a node before this pass sees it.
+      This pass can share their walk.
+    RUNS_AFTER_WALK: passes that must be done with the whole tree before this
+      pass starts. This pass gets a walk after theirs.
+
+  The naming of the hooks follows PyTreeVisitor, so they need to be marked with
+  # pylint: disable=invalid-name as well. Like the methods of a PyTreeVisitor,
+  the hooks are looked up when the class is created.
+  """
+
+  _DISPATCH_TABLES = (
+      ('_enter_table', 'Enter_', 'DefaultLeafEnter', 'DefaultNodeEnter'),
+      ('_leave_table', 'Leave_', None, 'DefaultNodeLeave'),
+  )
+
+  NAME = None
+  RUNS_AFTER = ()
+  RUNS_AFTER_WALK = ()
+
+  # The ids of the nodes to skip. Nodes can't be hashed.
+  _skipped = None
+
+  def Skip(self, node):
+    """Don't walk the node and its subtree with this pass.
+
+    Arguments:
+      node: the node to skip. It must not have been entered yet.
+    """
+    if self._skipped is None:
+      self._skipped = set()
+    self._skipped.add(id(node))
+
+  def DefaultNodeEnter(self, node):
+    """Invoked when a node without an Enter_XXX method is entered."""
+    pass
+
+  def DefaultNodeLeave(self, node):
+    """Invoked when a node without a Leave_XXX method is left."""
+    pass
+
+  def DefaultLeafEnter(self, leaf):
+    """Invoked when a leaf without an Enter_XXX method is entered."""
+    pass
+
+  def Finish(self):
+    """Invoked when the walk is over."""
+    pass
+
+
+_DEFAULT_NODE_VISIT = getattr(PyTreeVisitor.DefaultNodeVisit, '__func__',
+                              PyTreeVisitor.DefaultNodeVisit)
+
+# The hooks that don't need to be invoked.
+_NO_OP_HOOKS = frozenset(
+    getattr(hook, '__func__', hook)
+    for hook in (PyTreePass.DefaultNodeEnter, PyTreePass.DefaultNodeLeave,
+                 PyTreePass.DefaultLeafEnter))
+
+
+def RunPasses(tree, passes):
+  """Run the passes over the tree in as few walks as possible.
+
+  Each pass is walked together with the passes before it, unless it must run
+  after a walk of one of them. The passes it depends on have to be given before
+  it. The ones that aren't given are assumed to have run already.
+
+  Arguments:
+    tree: the top-level pytree node to run the passes over.
+    passes: (list of PyTreePass) The passes, in the order they're run.
+
+  Raises:
+    ValueError: if a pass is given before a pass that it depends on.
+  """
+  walks = []
+  walk_of_pass = {}
+  names = [tree_pass.NAME for tree_pass in passes]
+  for index, tree_pass in enumerate(passes):
+    walk = 0
+    for name, offset in ([(name, 0) for name in tree_pass.RUNS_AFTER] +
+                         [(name, 1) for name in tree_pass.RUNS_AFTER_WALK]):
+      if name in names[index + 1:]:
+        raise ValueError('{0} must run after {1}'.format(tree_pass.NAME, name))
+      if name in walk_of_pass:
+        walk = max(walk, walk_of_pass[name] + offset)
+    walk_of_pass[tree_pass.NAME] = walk
+    if walk == len(walks):
+      walks.append([])
+    walks[walk].append(tree_pass)
+
+  for walk_passes in walks:
+    walk_passes = tuple(walk_passes)
+    _WalkPasses(tree, walk_passes, {walk_passes: {}})
+    for tree_pass in walk_passes:
+      tree_pass.Finish()
+      tree_pass._skipped = None  # pylint: disable=protected-access
+
+
+def _WalkPasses(tree, passes, hooks_by_passes):
+  """Walk the tree with the passes.
+
+  The walk keeps its own stack rather than recursing, so that deeply nested
+  trees don't exceed the recursion limit.
+
+  Arguments:
+    tree: the node to walk.
+    passes: (tuple of PyTreePass) The passes that walk the tree.
+    hooks_by_passes: (dict) The Enter and Leave hooks by node type of the tuples
+      of passes walked.
+  """
+  # The frames of the nodes being walked, as (node, leave_hooks, iterator over
+  # the children left to walk, passes, hooks_by_type).
+  stack = [(None, None, iter([tree]), passes, hooks_by_passes[passes])]
+  while stack:
+    frame = stack[-1]
+    node = next(frame[2], None)
+    if node is None:
+      stack.pop()
+      if frame[1]:
+        for hook in frame[1]:
+          hook(frame[0])
+      continue
+
+    passes = frame[3]
+    hooks_by_type = frame[4]
+    for tree_pass in passes:
+      skipped = tree_pass._skipped  # pylint: disable=protected-access
+      if skipped and id(node) in skipped:
+        skipped.remove(id(node))
+        passes = tuple(p for p in passes if p is not tree_pass)
+        hooks_by_type = hooks_by_passes.setdefault(passes, {})
+    if not passes:
+      continue
+
+    hooks = hooks_by_type.get(node.type)
+    if hooks is None:
+      hooks = hooks_by_type[node.type] = _GetHooks(node, passes)
+    enter_hooks, leave_hooks = hooks
+
+    for hook in enter_hooks:
+      hook(node)
+    if node.children:
+      stack.append((node, leave_hooks, iter(node.children[:]), passes,
+                    hooks_by_type))
+    else:
+      for hook in leave_hooks:
+        hook(node)
+
+
+def _GetHooks(node, passes):
+  """Return the Enter and Leave hooks of the passes for the node's type."""
+  # pylint: disable=protected-access
+  enter_hooks = []
+  leave_hooks = []
+  for tree_pass in passes:
+    enter = tree_pass._enter_table[node.type]
+    leave = tree_pass._leave_table[node.type]
+    if enter not in _NO_OP_HOOKS:
+      enter_hooks.append(types.MethodType(enter, tree_pass))
+    if leave is not None and leave not in _NO_OP_HOOKS:
+      leave_hooks.append(types.MethodType(leave, tree_pass))
+  return enter_hooks, leave_hooks
+
+
 def DumpPyTree(tree, target_stream=sys.stdout):
   """Convenience function for dumping a given pytree.
 
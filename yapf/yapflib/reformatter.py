@@ -21,9 +21,10 @@ as a string.
 """
 
 from __future__ import unicode_literals
+import bisect
 import collections
 import heapq
-import re
+import time
 
 from lib2to3 import pytree
 from lib2to3.pgen2 import token
@@ -36,7 +37,7 @@ from yapf.yapflib import style
 from yapf.yapflib import verifier
 
 
-def Reformat(uwlines, verify=False, lines=None):
+def Reformat(uwlines, verify=False, lines=None, logger=None, line_stats=None):
   """Reformat the unwrapped lines.
 
   Arguments:
@@ -44,6 +45,11 @@ def Reformat(uwlines, verify=False, lines=None):
     verify: (bool) True if reformatted code should be verified for syntax.
     lines: (set of int) The lines which can be modified or None if there is no
       line range restriction.
+    logger: (function) A function or lambda that takes a string and emits it.
+      It's told about lines whose formatting search was cut short, either by
+      the beam width or by a time limit.
+    line_stats: (list) If not None, a LineStats is appended to it for each line
+      whose formatting had to be searched for.
 
   Returns:
     A string representing the reformatted code.
@@ -51,6 +57,11 @@ def Reformat(uwlines, verify=False, lines=None):
   final_lines = []
   prev_uwline = None  # The previous line.
   indent_width = style.Get('INDENT_WIDTH')
+  line_time_limit = style.Get('SEARCH_LINE_TIME_LIMIT')
+  file_time_limit = style.Get('SEARCH_FILE_TIME_LIMIT')
+  file_deadline = None
+  if file_time_limit:
+    file_deadline = time.time() + file_time_limit
 
   for uwline in _SingleOrMergedLines(uwlines):
     first_token = uwline.first
@@ -84,7 +95,15 @@ def Reformat(uwlines, verify=False, lines=None):
       while state.next_token:
         state.AddTokenToState(newline=False, dry_run=False)
     else:
-      if not _AnalyzeSolutionSpace(state):
+      stats = None
+      if line_stats is not None:
+        stats = LineStats(uwline.first.lineno)
+        line_stats.append(stats)
+      start_time = time.time()
+      deadline = file_deadline
+      if line_time_limit:
+        deadline = _Min(file_deadline, start_time + line_time_limit)
+      if not _AnalyzeSolutionSpace(state, logger, stats, deadline):
         # Failsafe mode. If there isn't a solution to the line, then just emit
         # it as is.
         state = format_decision_state.FormatDecisionState(uwline, indent_amt)
@@ -92,12 +111,47 @@ def Reformat(uwlines, verify=False, lines=None):
         _RetainHorizontalSpacing(uwline)
         _RetainRequiredVerticalSpacing(uwline, prev_uwline, None)
         _EmitLineUnformatted(state)
+        if stats:
+          stats.fell_back = True
+      if stats:
+        stats.seconds = time.time() - start_time
 
     final_lines.append(uwline)
     prev_uwline = uwline
   return _FormatFinalLines(final_lines, verify)
 
 
+class LineStats(object):
+  """Counters of the formatting search for an unwrapped line.
+
+  Attributes:
+    lineno: (int) The line number of the line's first token.
+    pushed: (int) The number of states put on the queue.
+    popped: (int) The number of states taken off the queue.
+    seen_hits: (int) The number of states taken off the queue that had already
+      been considered.
+    peak_queue_size: (int) The largest number of states on the queue at once.
+    seconds: (float) The wall time spent on the line.
+    fell_back: (bool) True if no formatting was found and the line was emitted
+      as is.
+    timed_out: (bool) True if the search ran out of time and the line was
+      finished without it.
+  """
+
+  __slots__ = ('lineno', 'pushed', 'popped', 'seen_hits', 'peak_queue_size',
+               'seconds', 'fell_back', 'timed_out')
+
+  def __init__(self, lineno):
+    self.lineno = lineno
+    self.pushed = 0
+    self.popped = 0
+    self.seen_hits = 0
+    self.peak_queue_size = 0
+    self.seconds = 0.0
+    self.fell_back = False
+    self.timed_out = False
+
+
 def _RetainHorizontalSpacing(uwline):
   """Retain all horizontal spacing between tokens."""
   for tok in uwline.tokens:
@@ -203,18 +257,19 @@ def _LineContainsI18n(uwline):
   Returns:
     True if the line contains i18n comments or function calls. False otherwise.
   """
-  if style.Get('I18N_COMMENT'):
+  current_style = style.Current()
+  if current_style.i18n_comment_regex:
     for tok in uwline.tokens:
-      if tok.is_comment and re.match(style.Get('I18N_COMMENT'), tok.value):
+      if tok.is_comment and current_style.i18n_comment_regex.match(tok.value):
         # Contains an i18n comment.
         return True
 
-  if style.Get('I18N_FUNCTION_CALL'):
+  if current_style.i18n_function_calls:
     length = len(uwline.tokens)
     index = 0
     while index < length - 1:
       if (uwline.tokens[index + 1].value == '(' and
-          uwline.tokens[index].value in style.Get('I18N_FUNCTION_CALL')):
+          uwline.tokens[index].value in current_style.i18n_function_calls):
         return True
       index += 1
 
@@ -235,7 +290,8 @@ def _CanPlaceOnSingleLine(uwline):
   Returns:
     True if the line can or should be added to a single line. False otherwise.
   """
-  indent_amt = style.Get('INDENT_WIDTH') * uwline.depth
+  current_style = style.Current()
+  indent_amt = current_style.INDENT_WIDTH * uwline.depth
   last = uwline.last
   last_index = -1
   if last.is_pylint_comment:
@@ -243,7 +299,7 @@ def _CanPlaceOnSingleLine(uwline):
     last_index = -2
   if last is None:
     return True
-  return (last.total_length + indent_amt <= style.Get('COLUMN_LIMIT') and
+  return (last.total_length + indent_amt <= current_style.COLUMN_LIMIT and
           not any(tok.is_comment for tok in uwline.tokens[:last_index]))
 
 
@@ -293,19 +349,514 @@ class _StateNode(object):
         self.state, self.newline)
 
 
-# A tuple of (penalty, count) that is used to prioritize the BFS. In case of
-# equal penalties, we prefer states that were inserted first. During state
-# generation, we make sure that we insert states first that break the line as
-# late as possible.
-_OrderedPenalty = collections.namedtuple('OrderedPenalty', ['penalty', 'count'])
+# A tuple of (estimate, count) that is used to prioritize the BFS. The estimate
+# is the penalty of the path so far, plus a lower bound on the penalty of the
+# rest of the line once the search has grown large. In case of equal estimates,
+# we prefer states that were inserted first. During state generation, we make
+# sure that we insert states first that break the line as late as possible.
+_OrderedPenalty = collections.namedtuple('OrderedPenalty',
+                                         ['estimate', 'count'])
 
 # An item in the prioritized BFS search queue. The 'StateNode's 'state' has
-# the given '_OrderedPenalty'.
-_QueueItem = collections.namedtuple('QueueItem',
-                                    ['ordered_penalty', 'state_node'])
+# the given 'penalty'.
+_QueueItem = collections.namedtuple(
+    'QueueItem', ['ordered_penalty', 'penalty', 'state_node'])
+
+
+class _PenaltyLowerBound(object):
+  """A lower bound on the penalty of placing the rest of an unwrapped line.
+
+  The bound is the larger of two estimates computed from the tokens that follow
+  a format decision state.
+
+  The first one looks at the next splits:
+
+    - The tokens before the next token we can split at must be placed on the
+      current line, and they pay for any characters over the column limit.
+    - Each remaining token that must be split before pays at least its split
+      penalty.
+    - If there's no such token, then either a split is made somewhere, paying
+      at least the cheapest remaining split penalty, or the rest of the line
+      is placed on the current line, paying for its excess characters.
+
+  The second one looks at the number of lines needed: if the remaining tokens
+  don't fit in the rest of the current line, then every line beyond it either
+  costs a split or the excess characters have to be paid for. Splits that
+  MustSplit() may force are assumed to be free. If all other splits are in the
+  same bracket, each one also costs SPLIT_PENALTY_FOR_ADDED_LINE_SPLIT times
+  the number of splits in the bracket so far.
+
+  No path from a state to the end of the line is cheaper than the bound of that
+  state, and the bound drops by no more than the penalty of any step. So the
+  search, ordered by the penalty so far plus the bound, still finds the optimal
+  formatting.
+  """
+
+  def __init__(self, uwline):
+    tokens = uwline.tokens
+    current_style = style.Current()
+    self._column_limit = current_style.COLUMN_LIMIT
+    self._excess_character_penalty = (
+        current_style.SPLIT_PENALTY_EXCESS_CHARACTER)
+    self._added_line_split_penalty = (
+        current_style.SPLIT_PENALTY_FOR_ADDED_LINE_SPLIT)
+    self._enabled = (
+        self._column_limit > 0 and self._excess_character_penalty >= 0 and
+        self._added_line_split_penalty >= 0 and
+        current_style.SPLIT_PENALTY_COMPREHENSION >= 0 and
+        all(tok.split_penalty >= 0 for tok in tokens))
+    if not self._enabled:
+      return
+
+    num_tokens = len(tokens)
+    self._index = {}
+    self._cache = {}
+
+    # _widths[i] is the width of tokens[:i] if placed on one line, and
+    # _width_sums[i] is the sum of _widths[:i].
+    self._widths = [0]
+    self._width_sums = [0]
+
+    scopes, depths = _BracketScopes(tokens)
+    for index, tok in enumerate(tokens):
+      self._index[tok] = index
+      width = tok.spaces_required_before
+      if tok.is_string and '\n' in tok.value:
+        width += len(tok.value.split('\n')[0])
+      elif not tok.is_pseudo_paren:
+        width += len(tok.value)
+      self._width_sums.append(self._width_sums[-1] + self._widths[-1])
+      self._widths.append(self._widths[-1] + width)
+    self._width_sums.append(self._width_sums[-1] + self._widths[-1])
+
+    # For each token index:
+    #   - the end of the range of tokens whose excess characters are modeled,
+    #   - the index of the first token we can split before,
+    #   - the cheapest split penalty of the tokens we can split before,
+    #   - the sum of split penalties of the tokens that must be split before,
+    #     or None if there are no such tokens,
+    #   - the largest number of spaces required before a remaining token we
+    #     can split before, which are dropped when splitting,
+    #   - the cheapest split of the remaining tokens,
+    #   - the number of remaining tokens MustSplit() may split before,
+    #   - the cheapest split of the other remaining tokens, not counting the
+    #     SPLIT_PENALTY_FOR_ADDED_LINE_SPLIT part,
+    #   - the bracket all of those other tokens are in, or None if there's
+    #     more than one such bracket.
+    self._model_end = [num_tokens] * (num_tokens + 1)
+    self._first_split = [num_tokens] * (num_tokens + 1)
+    self._min_split_penalty = [None] * (num_tokens + 1)
+    self._must_split_penalty = [None] * (num_tokens + 1)
+    self._split_spaces = [0] * (num_tokens + 1)
+    self._min_split_cost = [None] * (num_tokens + 1)
+    self._num_forced_splits = [0] * (num_tokens + 1)
+    self._min_added_split_cost = [None] * (num_tokens + 1)
+    self._added_split_scope = [-1] * (num_tokens + 1)
+
+    for index in range(num_tokens - 1, -1, -1):
+      tok = tokens[index]
+      following = index + 1
+      if tok.is_pylint_comment:
+        self._model_end[index] = index
+      elif tok.is_comment or (tok.is_string and '\n' in tok.value):
+        # The column after these tokens isn't simply the sum of the widths.
+        self._model_end[index] = following
+      else:
+        self._model_end[index] = self._model_end[following]
+
+      self._first_split[index] = self._first_split[following]
+      self._min_split_penalty[index] = self._min_split_penalty[following]
+      self._must_split_penalty[index] = self._must_split_penalty[following]
+      self._split_spaces[index] = self._split_spaces[following]
+      self._min_split_cost[index] = self._min_split_cost[following]
+      self._num_forced_splits[index] = self._num_forced_splits[following]
+      self._min_added_split_cost[index] = self._min_added_split_cost[following]
+      self._added_split_scope[index] = self._added_split_scope[following]
+      if tok.is_pseudo_paren:
+        continue
+
+      if not tok.can_break_before:
+        continue
+
+      self._split_spaces[index] = max(self._split_spaces[index],
+                                      tok.spaces_required_before)
+
+      self._first_split[index] = index
+      self._min_split_penalty[index] = _Min(self._min_split_penalty[index],
+                                            tok.split_penalty)
+      if tok.must_break_before:
+        self._must_split_penalty[index] = (
+            (self._must_split_penalty[index] or 0) + tok.split_penalty)
+
+      if _MaySplitWithoutAddedPenalty(tok, current_style):
+        self._num_forced_splits[index] += 1
+        self._min_split_cost[index] = _Min(self._min_split_cost[index],
+                                           tok.split_penalty)
+      else:
+        # See FormatDecisionState._AddTokenOnNewline.
+        split_cost = tok.split_penalty + 10
+        self._min_split_cost[index] = _Min(
+            self._min_split_cost[index],
+            split_cost + self._added_line_split_penalty)
+        self._min_added_split_cost[index] = _Min(
+            self._min_added_split_cost[index], split_cost)
+        if self._min_added_split_cost[following] is None:
+          self._added_split_scope[index] = scopes[index]
+        elif self._added_split_scope[following] != scopes[index]:
+          self._added_split_scope[index] = None
+
+    self._scope_depths = dict(zip(scopes, depths))
+
+  def Get(self, state):
+    """Return the lower bound for the rest of the line after state.
+
+    Arguments:
+      state: (format_decision_state.FormatDecisionState) The state to compute
+        the bound for.
+
+    Returns:
+      A penalty no greater than that of any way of placing the remaining tokens.
+    """
+    if not self._enabled or not state.next_token:
+      return 0
+
+    index = self._index[state.next_token]
+    scope = self._added_split_scope[index]
+    num_line_splits = 0
+    if scope is not None and scope < index:
+      stack = state.stack
+      for _ in range(state.paren_level - self._scope_depths[scope]):
+        stack = stack.below
+      num_line_splits = stack.top.num_line_splits
+
+    # Many states differ only in ways that don't matter to the bound.
+    key = (index, state.column, num_line_splits)
+    bound = self._cache.get(key)
+    if bound is None:
+      bound = max(
+          self._SplitPenalty(index, state.column),
+          self._LinePenalty(index, state.column, num_line_splits))
+      self._cache[key] = bound
+    return bound
+
+  def _SplitPenalty(self, index, column):
+    """The bound from the splits around the next tokens."""
+    first_split = self._first_split[index]
+    bound = self._ExcessPenalty(index, column, first_split)
+    if self._must_split_penalty[index] is not None:
+      return bound + self._must_split_penalty[index]
+
+    unsplit_bound = self._ExcessPenalty(index, column, len(self._index))
+    if self._min_split_penalty[first_split] is None:
+      return unsplit_bound
+    return min(bound + self._min_split_penalty[first_split], unsplit_bound)
+
+  def _LinePenalty(self, index, column, num_line_splits):
+    """The bound from the number of lines the remaining tokens need."""
+    if self._model_end[index] != len(self._index):
+      # Comments and multiline strings move the column unpredictably.
+      return 0
+
+    # Once over the column limit, the excess has been paid for already. Each
+    # line beyond the current one holds at most a column limit's worth of
+    # characters, plus the spaces before its first token which aren't needed.
+    excess = (
+        min(column, self._column_limit) + self._widths[-1] -
+        self._widths[index] - self._column_limit)
+    if excess <= 0:
+      return 0
+    line_length = self._column_limit + self._split_spaces[index]
+
+    scope = self._added_split_scope[index]
+    if scope is None:
+      if self._min_split_cost[index] is None:
+        return self._excess_character_penalty
+      num_lines = (excess + line_length - 1) // line_length
+      return min(self._excess_character_penalty,
+                 num_lines * self._min_split_cost[index])
+
+    # The forced splits may take care of some of the lines for free.
+    excess -= self._num_forced_splits[index] * line_length
+    if excess <= 0:
+      return 0
+    split_cost = self._min_added_split_cost[index]
+    if split_cost is None:
+      return self._excess_character_penalty * excess
+
+    # The cost of k splits grows quadratically, while each split saves up to a
+    # line's worth of excess characters. Find the cheapest k.
+    num_lines = (excess + line_length - 1) // line_length
+    added = self._added_line_split_penalty
+    saving = self._excess_character_penalty * line_length
+    if added:
+      worthwhile = (saving - split_cost) // added - num_line_splits
+    else:
+      worthwhile = num_lines if split_cost <= saving else 0
+    best = max(0, min(num_lines - 1, worthwhile))
+
+    def Cost(k):
+      return (k * split_cost + added * (k * num_line_splits + k *
+                                        (k + 1) // 2) +
+              self._excess_character_penalty * max(0, excess - k * line_length))
+
+    return min(Cost(best), Cost(min(best + 1, num_lines)))
+
+  def _ExcessPenalty(self, start, column, end):
+    """The excess character penalty of placing tokens[start:end] at column."""
+    end = min(end, self._model_end[start])
+    if end <= start:
+      return 0
+
+    # The column after placing tokens[j] is 'offset + _widths[j + 1]'. Only the
+    # tokens from the first one ending past the column limit are penalized.
+    offset = column - self._widths[start]
+    first = bisect.bisect_right(self._widths, self._column_limit - offset,
+                                start + 1, end + 1)
+    num_over = end + 1 - first
+    excess = (
+        num_over * (offset - self._column_limit) + self._width_sums[end + 1] -
+        self._width_sums[first])
+    return self._excess_character_penalty * excess
+
+
+class _ResetPoints(object):
+  """The tokens where the search can forget how it got there.
+
+  A token that must be split before is a reset point: every layout of the line
+  starts a new line there. After that newline, the state of the bracket the
+  token is in doesn't depend on the layout of its earlier elements, except for
+  the number of line splits in the bracket. The brackets around it and the
+  line's column are the same too. Later penalties only grow with the number of
+  line splits, so of two such states the one with fewer splits and no higher
+  penalty is at least as good.
+
+  This splits the search into independent segments between reset points. Once
+  a state past a reset point has been considered, states that can only reach
+  the reset point in a state it dominates are dropped.
+  """
+
+  def __init__(self, uwline):
+    tokens = uwline.tokens
+    scopes, depths = _BracketScopes(tokens)
+    self._index = {}
+    self._reset_depth = {}
+    for index, tok in enumerate(tokens):
+      self._index[tok] = index
+      if (index and tok.must_break_before and tok.can_break_before and
+          not tok.is_pseudo_paren and not tok.is_comment and
+          not tok.ClosesScope()):
+        self._reset_depth[index] = depths[index]
+
+    # For each token index, the next reset point that a state about to place
+    # that token must pass with its bracket's state (except for the line
+    # splits) already settled, or None. The bracket's first element settles it.
+    self._next_reset = [None] * (len(tokens) + 1)
+    next_reset = None
+    for index in range(len(tokens) - 1, 0, -1):
+      if index in self._reset_depth:
+        next_reset = index
+      if next_reset is not None and (scopes[next_reset] < 0 or
+                                     scopes[next_reset] + 2 <= index):
+        self._next_reset[index] = next_reset
+
+    # For each reset point, the penalties and line splits of the states that
+    # have passed it, keyed by the rest of their state.
+    self._passed = collections.defaultdict(dict)
+
+  def IsDominated(self, state, newline, penalty):
+    """Return True if the state can't lead to a better layout than another one.
+
+    States past a reset point that aren't dominated are remembered.
+
+    Arguments:
+      state: (format_decision_state.FormatDecisionState) The state.
+      newline: (bool) Whether the state's last token was placed on a new line.
+      penalty: (int) The penalty of the path to the state.
+
+    Returns:
+      True if the state can be dropped from the search.
+    """
+    if not self._reset_depth or not state.next_token:
+      return False
+
+    index = self._index[state.next_token]
+    reset = index - 1
+    if newline and reset in self._reset_depth:
+      key, num_line_splits = self._Key(state, self._reset_depth[reset])
+      passed = self._passed[reset].setdefault(key, [])
+      if _Dominated(passed, penalty, num_line_splits):
+        return True
+      passed.append((penalty, num_line_splits))
+
+    reset = self._next_reset[index]
+    if reset is None or state.comp_stack or reset not in self._passed:
+      return False
+    # The state must reach the reset point on a new line. Nothing before it
+    # changes the state of the reset point's bracket, except for its line
+    # splits.
+    key, num_line_splits = self._Key(state, self._reset_depth[reset])
+    passed = self._passed[reset].get(key)
+    return bool(passed) and _Dominated(passed, penalty, num_line_splits)
+
+  def _Key(self, state, depth):
+    """Split the state of the bracket at depth into its key and line splits."""
+    stack = state.stack
+    for _ in range(state.paren_level - depth):
+      stack = stack.below
+    frame = stack.top
+    return (stack.below, frame.indent, frame.closing_scope_indent,
+            frame.split_before_closing_bracket,
+            state.comp_stack), frame.num_line_splits
+
+
+class _DominanceTable(object):
+  """The cheapest known states for each token and stack.
+
+  States at the same token with the same paren stack differ only in their
+  column. A state that's at a lower column, and was reached with no more
+  penalty, leaves more room for the rest of the line, so the other state is
+  usually redundant. It isn't always: some splits are required only when a
+  bracket's contents don't fit on the rest of the line, and a required split
+  costs less than the same split made by choice. So, like ignoring the stacks
+  in state comparisons, this is only used once the search has grown large. As
+  it can change the formatting of those lines, it's only used if the
+  SEARCH_DOMINANCE_PRUNING style setting is True.
+  """
+
+  def __init__(self):
+    self._frontier = {}
+
+  def Add(self, state, penalty):
+    """Record a state, unless it's dominated by one that's already recorded.
+
+    Arguments:
+      state: (format_decision_state.FormatDecisionState) The state.
+      penalty: (int) The penalty of the path to the state.
+
+    Returns:
+      False if the state is dominated and can be dropped, True otherwise.
+    """
+    frontier = self._frontier.setdefault(_DominanceKey(state), [])
+    column = state.column
+    for other_column, other_penalty in frontier:
+      if (other_column <= column and other_penalty <= penalty and
+          (other_column < column or other_penalty < penalty)):
+        return False
+    frontier[:] = [(other_column, other_penalty)
+                   for other_column, other_penalty in frontier
+                   if other_column < column or other_penalty < penalty]
+    frontier.append((column, penalty))
+    return True
+
+  def IsDominated(self, state, penalty):
+    """Return True if a recorded state dominates the state."""
+    column = state.column
+    for other_column, other_penalty in self._frontier.get(
+        _DominanceKey(state), ()):
+      if (other_column <= column and other_penalty <= penalty and
+          (other_column < column or other_penalty < penalty)):
+        return True
+    return False
+
+
+def _DominanceKey(state):
+  return (state.next_token, state.paren_level, state.lowest_level_on_line,
+          state.stack, state.comp_stack)
+
+
+def _Dominated(passed, penalty, num_line_splits):
+  """Return True if one of the passed states is at least as good."""
+  return any(other_penalty <= penalty and other_splits <= num_line_splits
+             for other_penalty, other_splits in passed)
+
+
+def _BracketScopes(tokens):
+  """Return the innermost bracket each token is in.
+
+  Arguments:
+    tokens: (list of format_token.FormatToken) The tokens of a line.
+
+  Returns:
+    A pair of lists with, for each token, the index of the opening bracket of
+    the innermost bracket it's in (-1 if none) and the number of brackets it's
+    in. A newline before a token counts towards that bracket.
+  """
+  scopes = []
+  depths = []
+  open_scopes = [-1]
+  for index, tok in enumerate(tokens):
+    # See FormatDecisionState.MoveStateToNextToken.
+    scopes.append(open_scopes[-1])
+    depths.append(len(open_scopes) - 1)
+    if tok.OpensScope():
+      open_scopes.append(index)
+    if len(open_scopes) > 1 and tok.ClosesScope():
+      open_scopes.pop()
+  return scopes, depths
+
 
+def _Min(value, other):
+  """The minimum of two values, where the first one may be None."""
+  return other if value is None else min(value, other)
 
-def _AnalyzeSolutionSpace(initial_state):
+
+def _MaySplitWithoutAddedPenalty(tok, current_style):
+  """Return True if a split before tok may not add a line split penalty.
+
+  A split doesn't add the SPLIT_PENALTY_FOR_ADDED_LINE_SPLIT penalty if it's
+  before an 'if' or 'for', or if FormatDecisionState.MustSplit() requires it.
+  This over-approximates the cases where the latter can happen.
+
+  Arguments:
+    tok: (format_token.FormatToken) The token to split before.
+    current_style: (style.Style) The style the line is formatted with.
+
+  Returns:
+    False if splitting before tok always adds the penalty.
+  """
+  if tok.must_break_before or tok.value in {'if', 'for'}:
+    return True
+  if tok.is_comment or tok.ClosesScope() or tok.value in '&|':
+    return True
+
+  previous = tok.previous_token
+  if previous is None or previous.OpensScope() or previous.is_pseudo_paren:
+    return True
+
+  subtypes = tok.subtypes
+  if subtypes & (format_token.Subtype.DICTIONARY_KEY
+                 | format_token.Subtype.DICTIONARY_VALUE
+                 | format_token.Subtype.DICT_SET_GENERATOR
+                 | format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN_ARG_LIST):
+    return True
+
+  if previous.value == ',':
+    if current_style.SPLIT_ARGUMENTS_WHEN_COMMA_TERMINATED:
+      return True
+    # Calls and string formatting in lists and argument lists.
+    if tok.is_name or tok.value in {'*', '**'}:
+      nxt = tok.next_token
+      while nxt and (nxt.is_name or nxt.value in {'.', '*', '**'}):
+        nxt = nxt.next_token
+      return bool(nxt and nxt.value == '(')
+    if tok.is_string:
+      nxt = tok.next_token
+      while nxt and nxt.is_string:
+        nxt = nxt.next_token
+      return bool(nxt and nxt.value == '%')
+
+  return False
+
+
+# The number of states the search takes off the queue for a line before it
+# sets up the bounds on the line's penalty and the other ways of cutting the
+# search short. Most lines are done well before that, and setting those up would
+# cost more than it saves.
+_LARGE_SEARCH = 1000
+
+
+def _AnalyzeSolutionSpace(initial_state, logger=None, stats=None,
+                          deadline=None):
   """Analyze the entire solution space starting from initial_state.
 
   This implements a variant of Dijkstra's algorithm on the graph that spans
@@ -313,9 +864,43 @@ def _AnalyzeSolutionSpace(initial_state):
   the shortest path (the one with the lowest penalty) from 'initial_state' to
   the state where all tokens are placed.
 
+  Once the search for a line has grown large (see _LARGE_SEARCH), the queue is
+  ordered by the penalty so far plus a lower bound on the penalty of the rest of
+  the line (see _PenaltyLowerBound), which turns the search into A*. States that
+  are cheap so far, but are bound to get expensive, are then left unexpanded.
+
+  At the same point, two cheap layouts are scored: a greedy first-fit one and
+  the original one from the source (see _IncumbentLayout). The cheaper one is
+  an upper bound on the penalty of the optimal layout, so states whose
+  estimated penalty exceeds it no longer make it into the queue. States that
+  can only reach a token that must be split before in a worse state than one
+  that has already passed it are dropped too (see _ResetPoints).
+
+  Once the search has grown larger still, states are compared without stacks.
+  If the SEARCH_DOMINANCE_PRUNING style setting is True, states that are
+  dominated by a state at a lower column that was reached with no more penalty
+  are dropped as well (see _DominanceTable). That can change the formatting of
+  such lines, so it's off by default.
+
+  If the SEARCH_BEAM_WIDTH style setting is non-zero, only that many states are
+  expanded for each token in the line. Because states are taken off the queue
+  in order of increasing estimated penalty, those are the most promising
+  states for the token. This bounds both the number of expanded states and the
+  size of the queue. If the beam loses every path to the end of the line, the
+  cheaper of the two layouts above is used instead, scoring them if the search
+  hasn't yet.
+
+  If the search is still running at the deadline, it stops. The most promising
+  partial path is then finished greedily, and the cheaper of that and the two
+  layouts above is used.
+
   Arguments:
     initial_state: (format_decision_state.FormatDecisionState) The initial state
       to start the search from.
+    logger: (function) A function or lambda that takes a string and emits it.
+    stats: (LineStats) If not None, the search's counters are recorded in it.
+    deadline: (float) If not None, the time.time() by which the search has to
+      stop.
 
   Returns:
     True if a formatting solution was found. False otherwise.
@@ -323,34 +908,113 @@ def _AnalyzeSolutionSpace(initial_state):
   count = 0
   seen = set()
   p_queue = []
+  num_popped = 0
+  num_seen_hits = 0
+  peak_queue_size = 1
+  beam_width = initial_state.style.SEARCH_BEAM_WIDTH
+  dominance_pruning = initial_state.style.SEARCH_DOMINANCE_PRUNING
+  num_expanded = collections.defaultdict(int)
+  beam_width_reached = False
+  timed_out = False
+  atom_runs = _AtomRuns(initial_state.line)
+  bound = None
+  resets = None
+  dominance = None
+  incumbent = None
+  upper_bound = None
 
   # Insert start element.
   node = _StateNode(initial_state, False, None)
-  heapq.heappush(p_queue, _QueueItem(_OrderedPenalty(0, count), node))
+  heapq.heappush(p_queue, _QueueItem(_OrderedPenalty(0, count), 0, node))
 
   count += 1
   while p_queue:
     item = p_queue[0]
-    penalty = item.ordered_penalty.penalty
+    penalty = item.penalty
     node = item.state_node
     if not node.state.next_token:
       break
+    if deadline is not None and time.time() > deadline:
+      timed_out = True
+      break
     heapq.heappop(p_queue)
+    num_popped += 1
+
+    if num_popped == _LARGE_SEARCH:
+      bound = _PenaltyLowerBound(initial_state.line)
+      resets = _ResetPoints(initial_state.line)
+      incumbent = _IncumbentLayout(initial_state)
+      upper_bound = incumbent.penalty if incumbent else None
+      _AddLowerBounds(p_queue, bound)
 
     if count > 10000:
       node.state.ignore_stack_for_comparison = True
+      if dominance is None and dominance_pruning:
+        dominance = _DominanceTable()
 
     if node.state in seen:
+      num_seen_hits += 1
       continue
 
     seen.add(node.state)
 
+    if resets is not None and resets.IsDominated(node.state, node.newline,
+                                                 penalty):
+      continue
+
+    if dominance is not None and dominance.IsDominated(node.state, penalty):
+      continue
+
+    if beam_width:
+      if num_expanded[node.state.next_token] >= beam_width:
+        beam_width_reached = True
+        continue
+      num_expanded[node.state.next_token] += 1
+
     # FIXME(morbo): Add a 'decision' element?
 
-    count = _AddNextStateToQueue(penalty, node, False, count, p_queue)
-    count = _AddNextStateToQueue(penalty, node, True, count, p_queue)
+    if node.state.next_token in atom_runs:
+      packed_count = _PackAtoms(penalty, node, atom_runs[node.state.next_token],
+                                count, p_queue, bound, upper_bound)
+      if packed_count is not None:
+        count = packed_count
+        continue
+
+    count = _AddNextStateToQueue(penalty, node, False, count, p_queue, bound,
+                                 upper_bound, dominance)
+    count = _AddNextStateToQueue(penalty, node, True, count, p_queue, bound,
+                                 upper_bound, dominance)
+    if stats and len(p_queue) > peak_queue_size:
+      peak_queue_size = len(p_queue)
+
+  if stats:
+    # Every state that was put on the queue was either taken off or is left.
+    stats.pushed = num_popped + len(p_queue)
+    stats.popped = num_popped
+    stats.seen_hits = num_seen_hits
+    stats.peak_queue_size = peak_queue_size
+
+  if beam_width_reached and logger:
+    logger('line %d: search beam width of %d reached; the formatting may not '
+           'be optimal' % (initial_state.line.first.lineno, beam_width))
+
+  if num_popped < _LARGE_SEARCH and (timed_out or not p_queue):
+    incumbent = _IncumbentLayout(initial_state)
+
+  if timed_out:
+    if stats:
+      stats.timed_out = True
+    if logger:
+      logger('line %d: search time limit reached; the formatting may not be '
+             'optimal' % initial_state.line.first.lineno)
+    return _FinishPartialPath(initial_state, item, incumbent)
 
   if not p_queue:
+    if incumbent:
+      # The beam lost the paths that the incumbent layout is on.
+      for newline in incumbent.newlines:
+        initial_state.AddTokenToState(newline=newline, dry_run=False)
+      return True
     # We weren't able to find a solution. Do nothing.
     return False
 
@@ -358,7 +1022,56 @@ def _AnalyzeSolutionSpace(initial_state):
   return True
 
 
-def _AddNextStateToQueue(penalty, previous_node, newline, count, p_queue):
+def _AddLowerBounds(p_queue, bound):
+  """Add the lower bounds of the queued states to their estimates.
+
+  The states taken off the queue so far were taken off in order of their
+  penalty, so they were reached by their cheapest paths. Ordering the queue by
+  the penalty plus the bound from now on keeps it that way.
+
+  Arguments:
+    p_queue: (heapq) The priority queue representing the solution space.
+    bound: (_PenaltyLowerBound) The lower bound on the penalty of the rest of
+      the line.
+  """
+  p_queue[:] = [
+      _QueueItem(
+          _OrderedPenalty(item.penalty + bound.Get(item.state_node.state),
+                          item.ordered_penalty.count), item.penalty,
+          item.state_node) for item in p_queue
+  ]
+  heapq.heapify(p_queue)
+
+
+def _FinishPartialPath(initial_state, item, incumbent):
+  """Finish the line from a partial path when the search has run out of time.
+
+  Arguments:
+    initial_state: (format_decision_state.FormatDecisionState) The initial state
+      the search started from.
+    item: (_QueueItem) The queue item with the most promising partial path.
+    incumbent: (_Layout) The cheaper of the greedy and the original layouts of
+      the line, or None.
+
+  Returns:
+    True if a formatting solution was found. False otherwise.
+  """
+  rest = _ScoreLayout(item.state_node.state, _GreedyNewline)
+  if rest and (incumbent is None or
+               item.penalty + rest.penalty < incumbent.penalty):
+    _ReconstructPath(initial_state, item.state_node)
+    for newline in rest.newlines:
+      initial_state.AddTokenToState(newline=newline, dry_run=False)
+    return True
+  if incumbent:
+    for newline in incumbent.newlines:
+      initial_state.AddTokenToState(newline=newline, dry_run=False)
+    return True
+  return False
+
+
+def _AddNextStateToQueue(penalty, previous_node, newline, count, p_queue, bound,
+                         upper_bound, dominance):
   """Add the following state to the analysis queue.
 
   Assume the current state is 'previous_node' and has been reached with a
@@ -371,6 +1084,11 @@ def _AddNextStateToQueue(penalty, previous_node, newline, count, p_queue):
     newline: (bool) Add a newline if True.
     count: (int) The number of elements in the queue.
     p_queue: (heapq) The priority queue representing the solution space.
+    bound: (_PenaltyLowerBound) The lower bound on the penalty of the rest of
+      the line, or None.
+    upper_bound: (int) The penalty of a known layout of the line, or None.
+    dominance: (_DominanceTable) The cheapest states that are known so far, or
+      None if states aren't compared by their columns.
 
   Returns:
     The updated number of elements in the queue.
@@ -386,10 +1104,201 @@ def _AddNextStateToQueue(penalty, previous_node, newline, count, p_queue):
   node = _StateNode(previous_node.state, newline, previous_node)
   penalty += node.state.AddTokenToState(
       newline=newline, dry_run=True, must_split=must_split)
-  heapq.heappush(p_queue, _QueueItem(_OrderedPenalty(penalty, count), node))
+  estimate = penalty if bound is None else penalty + bound.Get(node.state)
+  if ((upper_bound is None or estimate <= upper_bound) and
+      (dominance is None or dominance.Add(node.state, penalty))):
+    heapq.heappush(p_queue,
+                   _QueueItem(_OrderedPenalty(estimate, count), penalty, node))
+  # A discarded state still counts, so that the order in which the remaining
+  # states are considered doesn't change.
   return count + 1
 
 
+def _AtomRuns(uwline):
+  """Find the runs of atoms in the line's literals that can be packed.
+
+  A run is the elements of a bracketed literal or argument list that are all
+  single names, numbers or strings. The first and the last elements are left
+  to the search, since where they go depends on the brackets around them.
+
+  Arguments:
+    uwline: (unwrapped_line.UnwrappedLine) The line.
+
+  Returns:
+    A dict from the comma after the first element of each run to its last
+    element.
+  """
+  runs = {}
+  for tok in uwline.tokens:
+    if not tok.OpensScope() or not tok.matching_bracket:
+      continue
+    elements = []
+    current = tok.next_token
+    while current and current is not tok.matching_bracket:
+      if not _IsPackableAtom(current):
+        break
+      elements.append(current)
+      current = current.next_token
+      if current and current.value == ',':
+        current = current.next_token
+      elif current is not tok.matching_bracket:
+        break
+    if current is not tok.matching_bracket or len(elements) < 3:
+      continue
+    if elements[-1].next_token is not tok.matching_bracket:
+      continue  # There's a trailing comma.
+    split_penalty = elements[1].split_penalty
+    if any(elem.split_penalty != split_penalty or not elem.can_break_before or
+           elem.must_break_before for elem in elements[1:]):
+      continue
+    runs[elements[0].next_token] = elements[-1]
+  return runs
+
+
+def _IsPackableAtom(tok):
+  return (tok.is_name or tok.is_number or
+          (tok.is_string and not tok.is_multiline_string and
+           '\n' not in tok.value))
+
+
+def _PackAtoms(penalty, previous_node, last, count, p_queue, bound,
+               upper_bound):
+  """Pack the elements of a run of atoms onto as few lines as possible.
+
+  Each element of the run costs the same to split before, and the cost of a
+  split only grows with the number of splits in the bracket. So as long as a
+  character over the column limit costs more than any of the run's splits, the
+  cheapest layout fills each line up to the column limit before starting the
+  next one. That also leaves the least for the last line. This places the run's
+  tokens up to its last element in one go, instead of searching over every
+  combination of splits.
+
+  Arguments:
+    penalty: (int) The penalty associated with the path up to this point.
+    previous_node: (_StateNode) The node whose next token is the comma after
+      the first element of the run.
+    last: (format_token.FormatToken) The last element of the run.
+    count: (int) The number of elements in the queue.
+    p_queue: (heapq) The priority queue representing the solution space.
+    bound: (_PenaltyLowerBound) The lower bound on the penalty of the rest of
+      the line, or None.
+    upper_bound: (int) The penalty of a known layout of the line, or None.
+
+  Returns:
+    The updated number of elements in the queue, or None if the run can't be
+    packed and has to be searched.
+  """
+  node = previous_node
+  while node.state.next_token is not last:
+    must_split = node.state.MustSplit()
+    newline = _GreedyNewline(node.state, must_split)
+    if newline and not node.state.CanSplit(must_split):
+      return None
+    node = _StateNode(node.state, newline, node)
+    penalty += node.state.AddTokenToState(
+        newline=newline, dry_run=True, must_split=must_split)
+
+  current_style = node.state.style
+  num_line_splits = node.state.stack.top.num_line_splits
+  split_cost = (
+      last.split_penalty + 10 +
+      current_style.SPLIT_PENALTY_FOR_ADDED_LINE_SPLIT * num_line_splits)
+  if current_style.SPLIT_PENALTY_EXCESS_CHARACTER <= split_cost:
+    # Going over the column limit may be cheaper than another split.
+    return None
+
+  estimate = penalty if bound is None else penalty + bound.Get(node.state)
+  if upper_bound is None or estimate <= upper_bound:
+    heapq.heappush(p_queue,
+                   _QueueItem(_OrderedPenalty(estimate, count), penalty, node))
+  return count + 1
+
+
+# A complete layout of an unwrapped line: its penalty and, for each token after
+# the first one, whether it's placed on a new line.
+_Layout = collections.namedtuple('Layout', ['penalty', 'newlines'])
+
+
+def _IncumbentLayout(initial_state):
+  """Return the cheaper of the greedy and the original layouts of the line.
+
+  Arguments:
+    initial_state: (format_decision_state.FormatDecisionState) The initial state
+      of the line.
+
+  Returns:
+    A _Layout, or None if neither layout is valid.
+  """
+  incumbent = None
+  for decide in (_GreedyNewline, _OriginalNewline):
+    layout = _ScoreLayout(initial_state, decide)
+    if layout and (incumbent is None or layout.penalty < incumbent.penalty):
+      incumbent = layout
+  return incumbent
+
+
+def _ScoreLayout(initial_state, decide):
+  """Score the layout of the line that's given by the 'decide' function.
+
+  The same rules and penalties as in the search apply, so that the penalty of
+  the layout is comparable to the ones found by the search.
+
+  Arguments:
+    initial_state: (format_decision_state.FormatDecisionState) The initial state
+      of the line. It isn't modified.
+    decide: (function) Given a state and whether a split is required before its
+      next token, returns True if the token is placed on a new line.
+
+  Returns:
+    A _Layout, or None if the layout breaks the formatting rules.
+  """
+  state = initial_state.Clone()
+  penalty = 0
+  newlines = []
+  while state.next_token:
+    must_split = state.MustSplit()
+    newline = decide(state, must_split)
+    if newline and not state.CanSplit(must_split):
+      return None
+    if not newline and must_split:
+      return None
+    penalty += state.AddTokenToState(
+        newline=newline, dry_run=True, must_split=must_split)
+    newlines.append(newline)
+  return _Layout(penalty, newlines)
+
+
+def _GreedyNewline(state, must_split):
+  """Split only if required or if the tokens up to the next split don't fit."""
+  if must_split:
+    return True
+  if not state.CanSplit(must_split):
+    return False
+
+  current = state.next_token
+  width = 0
+  tok = current
+  while tok and (tok is current or not tok.can_break_before):
+    width += tok.spaces_required_before
+    if not tok.is_pseudo_paren:
+      width += len(tok.value)
+    tok = tok.next_token
+  return state.column + width > state.column_limit
+
+
+def _OriginalNewline(state, _):
+  """Split where the original source does. See _EmitLineUnformatted."""
+  current = state.next_token
+  previous = current.previous_token
+  if previous.is_continuation:
+    return False
+
+  previous_lineno = previous.lineno
+  if previous.is_multiline_string or previous.is_string:
+    previous_lineno += previous.value.count('\n')
+  return current.lineno > previous_lineno
+
+
 def _ReconstructPath(initial_state, current):
   """Reconstruct the path through the queue with lowest penalty.
 
@@ -464,8 +1373,7 @@ def _CalculateNumberOfNewlines(first_token, indent_depth, prev_uwline,
     # The first line in the file. Don't add blank lines.
     # FIXME(morbo): Is this correct?
     if first_token.newlines is not None:
-      pytree_utils.SetNodeAnnotation(first_token.node,
-                                     pytree_utils.Annotation.NEWLINES, None)
+      first_token.annotations.newlines = None
     return 0
 
   if first_token.is_docstring:
@@ -511,13 +1419,11 @@ def _CalculateNumberOfNewlines(first_token, indent_depth, prev_uwline,
           else:
             prev_last_token.AdjustNewlinesBefore(TWO_BLANK_LINES)
           if first_token.newlines is not None:
-            pytree_utils.SetNodeAnnotation(
-                first_token.node, pytree_utils.Annotation.NEWLINES, None)
+            first_token.annotations.newlines = None
           return NO_BLANK_LINES
     elif _IsClassOrDef(prev_uwline):
       if not style.Get('BLANK_LINE_BEFORE_NESTED_CLASS_OR_DEF'):
-        pytree_utils.SetNodeAnnotation(first_token.node,
-                                       pytree_utils.Annotation.NEWLINES, None)
+        first_token.annotations.newlines = None
         return NO_BLANK_LINES
 
   # Calculate how many newlines were between the original lines. We want to
@@ -53,28 +53,82 @@ def ComputeSplitPenalties(tree):
   Arguments:
     tree: the top-level pytree node to annotate with penalties.
   """
-  _SplitPenaltyAssigner().Visit(tree)
+  pytree_visitor.RunPasses(tree, [SplitPenaltyAssigner()])
 
 
-class _SplitPenaltyAssigner(pytree_visitor.PyTreeVisitor):
+class SplitPenaltyAssigner(pytree_visitor.PyTreePass):
   """Assigns split penalties to tokens, based on parse tree structure.
 
   Split penalties are attached as annotations to tokens.
+
+  Many hooks change the penalties of all the tokens below a node. Instead of
+  walking the tokens each time, which is quadratic in the nesting depth, the
+  changes are recorded on the nodes and handed down the tree:
+
+    - The minimum penalties set when a node is entered go down to the children
+      of each node as it's entered.
+    - The increases of an expression's penalties when it's left go down once a
+      hook reads or sets a penalty they apply to, or in Finish.
+
+  A hook that reads or sets the penalty of a token below its node's children
+  first takes what's pending on the way down to it, with _Settled().
   """
 
-  def Visit_import_as_names(self, node):  # pyline: disable=invalid-name
+  NAME = 'split_penalty'
+  # The subtype assigner inserts the pseudo parentheses of dictionary values
+  # when it leaves the dictionary. The penalties of the nodes around them are
+  # set when those are entered.
+  RUNS_AFTER_WALK = ('subtype_assigner',)
+
+  def __init__(self):
+    self._style = style.Current()
+    # The minimum penalties that are still to be handed down, as [node,
+    # penalty] by the id() of the node. Only nodes that were not entered yet
+    # have them.
+    self._maxes = {}
+    # The increases of the penalties that are still to be handed down, as
+    # [node, increase of the leaves but the first one, increase of the first
+    # leaf] by the id() of the node. Only nodes that were left have them.
+    self._increases = {}
+    # The nodes in the order their increases were recorded. A node comes after
+    # the nodes with pending increases in its subtree.
+    self._increased = []
+    # The number of power nodes that were entered but not left yet.
+    self._power_depth = 0
+
+  def Finish(self):
+    # Going from the last recorded nodes, every subtree is walked once.
+    for node in reversed(self._increased):
+      if id(node) in self._increases:
+        self._HandDown(node)
+    self._increased = []
+
+  def DefaultNodeEnter(self, node):
+    """Hand the minimum penalty of a node that's entered down to its children.
+
+    Arguments:
+      node: (pytree.Node) The node being entered.
+    """
+    if self._maxes:
+      pending = self._maxes.pop(id(node), None)
+      if pending:
+        for child in node.children:
+          self._AddPending(child, pending[1], 0, 0)
+
+  def Leave_import_as_names(self, node):  # pyline: disable=invalid-name
     # import_as_names ::= import_as_name (',' import_as_name)* [',']
-    self.DefaultNodeVisit(node)
     prev_child = None
     for child in node.children:
       if (prev_child and isinstance(prev_child, pytree.Leaf) and
           prev_child.value == ','):
-        _SetSplitPenalty(child, style.Get('SPLIT_PENALTY_IMPORT_NAMES'))
+        _SetSplitPenalty(
+            self._Settled(child, node), self._style.SPLIT_PENALTY_IMPORT_NAMES)
       prev_child = child
 
-  def Visit_classdef(self, node):  # pylint: disable=invalid-name
+  def Enter_classdef(self, node):  # pylint: disable=invalid-name
     # classdef ::= 'class' NAME ['(' [arglist] ')'] ':' suite
-    #
+    self.DefaultNodeEnter(node)
+
     # NAME
     _SetUnbreakable(node.children[1])
     if len(node.children) > 4:
@@ -82,105 +136,114 @@ class _SplitPenaltyAssigner(pytree_visitor.PyTreeVisitor):
       _SetUnbreakable(node.children[2])
     # ':'
     _SetUnbreakable(node.children[-2])
-    self.DefaultNodeVisit(node)
 
-  def Visit_funcdef(self, node):  # pylint: disable=invalid-name
+  def Enter_funcdef(self, node):  # pylint: disable=invalid-name
     # funcdef ::= 'def' NAME parameters ['->' test] ':' suite
     #
     # Can't break before the function name and before the colon. The parameters
     # are handled by child iteration.
+    self.DefaultNodeEnter(node)
     colon_idx = 1
     while pytree_utils.NodeName(node.children[colon_idx]) == 'simple_stmt':
       colon_idx += 1
     _SetUnbreakable(node.children[colon_idx])
-    arrow_idx = -1
     while colon_idx < len(node.children):
-      if isinstance(node.children[colon_idx], pytree.Leaf):
-        if node.children[colon_idx].value == ':':
-          break
-        if node.children[colon_idx].value == '->':
-          arrow_idx = colon_idx
+      if (isinstance(node.children[colon_idx], pytree.Leaf) and
+          node.children[colon_idx].value == ':'):
+        break
       colon_idx += 1
     _SetUnbreakable(node.children[colon_idx])
-    self.DefaultNodeVisit(node)
-    if arrow_idx > 0:
-      _SetSplitPenalty(_LastChildNode(node.children[arrow_idx - 1]), 0)
-      _SetUnbreakable(node.children[arrow_idx])
-      _SetStronglyConnected(node.children[arrow_idx + 1])
 
-  def Visit_lambdef(self, node):  # pylint: disable=invalid-name
+  def Leave_funcdef(self, node):  # pylint: disable=invalid-name
+    for arrow_idx, child in enumerate(node.children):
+      if isinstance(child, pytree.Leaf) and child.value == '->':
+        _SetSplitPenalty(
+            self._Settled(_LastChildNode(node.children[arrow_idx - 1]), node),
+            0)
+        _SetUnbreakable(self._Settled(child, node))
+        _SetStronglyConnected(self._Settled(node.children[arrow_idx + 1], node))
+
+  def Enter_lambdef(self, node):  # pylint: disable=invalid-name
     # lambdef ::= 'lambda' [varargslist] ':' test
+    self.DefaultNodeEnter(node)
+    if self._style.ALLOW_MULTILINE_LAMBDAS:
+      # The children aren't entered, so nothing can be left pending on them.
+      _SetStronglyConnected(self._Settled(node, node))
+      for child in node.children:
+        self.Skip(child)
+
+  def Leave_lambdef(self, node):  # pylint: disable=invalid-name
     # Loop over the lambda up to and including the colon.
-    if style.Get('ALLOW_MULTILINE_LAMBDAS'):
-      _SetStronglyConnected(node)
-    else:
-      self._SetUnbreakableOnChildren(node)
+    if not self._style.ALLOW_MULTILINE_LAMBDAS:
+      _SetUnbreakableOnChildren(self._Settled(node, node))
 
-  def Visit_parameters(self, node):  # pylint: disable=invalid-name
+  def Leave_parameters(self, node):  # pylint: disable=invalid-name
     # parameters ::= '(' [typedargslist] ')'
-    self.DefaultNodeVisit(node)
 
     # Can't break before the opening paren of a parameter list.
-    _SetUnbreakable(node.children[0])
-    if not style.Get('DEDENT_CLOSING_BRACKETS'):
-      _SetStronglyConnected(node.children[-1])
+    _SetUnbreakable(self._Settled(node.children[0], node))
+    if not self._style.DEDENT_CLOSING_BRACKETS:
+      _SetStronglyConnected(self._Settled(node.children[-1], node))
 
-  def Visit_arglist(self, node):  # pylint: disable=invalid-name
+  def Leave_arglist(self, node):  # pylint: disable=invalid-name
     # arglist ::= argument (',' argument)* [',']
-    self.DefaultNodeVisit(node)
     index = 1
     while index < len(node.children):
       child = node.children[index]
       if isinstance(child, pytree.Leaf) and child.value == ',':
-        _SetUnbreakable(child)
+        _SetUnbreakable(self._Settled(child, node))
       index += 1
     for child in node.children:
       if pytree_utils.NodeName(child) == 'atom':
-        _IncreasePenalty(child, CONNECTED)
+        self._DeferIncrease(child, CONNECTED)
 
-  def Visit_argument(self, node):  # pylint: disable=invalid-name
+  def Leave_argument(self, node):  # pylint: disable=invalid-name
     # argument ::= test [comp_for] | test '=' test  # Really [keyword '='] test
-    self.DefaultNodeVisit(node)
     index = 1
     while index < len(node.children) - 1:
       child = node.children[index]
       if isinstance(child, pytree.Leaf) and child.value == '=':
-        _SetSplitPenalty(_FirstChildNode(node.children[index]), NAMED_ASSIGN)
         _SetSplitPenalty(
-            _FirstChildNode(node.children[index + 1]), NAMED_ASSIGN)
+            self._Settled(_FirstChildNode(node.children[index]), node),
+            NAMED_ASSIGN)
+        _SetSplitPenalty(
+            self._Settled(_FirstChildNode(node.children[index + 1]), node),
+            NAMED_ASSIGN)
       index += 1
 
-  def Visit_tname(self, node):  # pylint: disable=invalid-name
+  def Leave_tname(self, node):  # pylint: disable=invalid-name
     # tname ::= NAME [':' test]
-    self.DefaultNodeVisit(node)
     index = 1
     while index < len(node.children) - 1:
       child = node.children[index]
       if isinstance(child, pytree.Leaf) and child.value == ':':
-        _SetSplitPenalty(_FirstChildNode(node.children[index]), NAMED_ASSIGN)
         _SetSplitPenalty(
-            _FirstChildNode(node.children[index + 1]), NAMED_ASSIGN)
+            self._Settled(_FirstChildNode(node.children[index]), node),
+            NAMED_ASSIGN)
+        _SetSplitPenalty(
+            self._Settled(_FirstChildNode(node.children[index + 1]), node),
+            NAMED_ASSIGN)
       index += 1
 
-  def Visit_dotted_name(self, node):  # pylint: disable=invalid-name
+  def Leave_dotted_name(self, node):  # pylint: disable=invalid-name
     # dotted_name ::= NAME ('.' NAME)*
-    self._SetUnbreakableOnChildren(node)
+    _SetUnbreakableOnChildren(self._Settled(node, node))
 
-  def Visit_dictsetmaker(self, node):  # pylint: disable=invalid-name
+  def Leave_dictsetmaker(self, node):  # pylint: disable=invalid-name
     # dictsetmaker ::= ( (test ':' test
     #                      (comp_for | (',' test ':' test)* [','])) |
     #                    (test (comp_for | (',' test)* [','])) )
     for child in node.children:
-      self.Visit(child)
       if pytree_utils.NodeName(child) == 'COLON':
         # This is a key to a dictionary. We don't want to split the key if at
         # all possible.
-        _SetStronglyConnected(child)
+        _SetStronglyConnected(self._Settled(child, node))
 
-  def Visit_trailer(self, node):  # pylint: disable=invalid-name
+  def Enter_trailer(self, node):  # pylint: disable=invalid-name
     # trailer ::= '(' [arglist] ')' | '[' subscriptlist ']' | '.' NAME
+    self.DefaultNodeEnter(node)
     if node.children[0].value == '.':
-      self._SetUnbreakableOnChildren(node)
+      _SetUnbreakableOnChildren(node)
       _SetSplitPenalty(node.children[1], DOTTED_NAME)
     elif len(node.children) == 2:
       # Don't split an empty argument list if at all possible.
@@ -189,29 +252,31 @@ class _SplitPenaltyAssigner(pytree_visitor.PyTreeVisitor):
       name = pytree_utils.NodeName(node.children[1])
       if name in {'argument', 'comparison'}:
         # Don't split an argument list with one element if at all possible.
-        _SetStronglyConnected(node.children[1])
+        self._DeferRecAnnotate(node.children[1], STRONGLY_CONNECTED, node)
+        first_child_leaf = self._Settled(
+            _FirstChildNode(node.children[1]), node)
         if (len(node.children[1].children) > 1 and
             pytree_utils.NodeName(node.children[1].children[1]) == 'comp_for'):
           # Don't penalize splitting before a comp_for expression.
-          _SetSplitPenalty(_FirstChildNode(node.children[1]), 0)
+          _SetSplitPenalty(first_child_leaf, 0)
         else:
-          _SetSplitPenalty(
-              _FirstChildNode(node.children[1]), ONE_ELEMENT_ARGUMENT)
+          _SetSplitPenalty(first_child_leaf, ONE_ELEMENT_ARGUMENT)
       elif (pytree_utils.NodeName(node.children[0]) == 'LSQB' and
             len(node.children[1].children) > 2 and
             (name.endswith('_test') or name.endswith('_expr'))):
-        _SetStronglyConnected(node.children[1].children[0])
-        _SetStronglyConnected(node.children[1].children[2])
+        elements = node.children[1].children
+        self._DeferRecAnnotate(elements[0], STRONGLY_CONNECTED, node)
+        self._DeferRecAnnotate(elements[2], STRONGLY_CONNECTED, node)
 
         # Still allow splitting around the operator.
         split_before = ((name.endswith('_test') and
-                         style.Get('SPLIT_BEFORE_LOGICAL_OPERATOR')) or
+                         self._style.SPLIT_BEFORE_LOGICAL_OPERATOR) or
                         (name.endswith('_expr') and
-                         style.Get('SPLIT_BEFORE_BITWISE_OPERATOR')))
+                         self._style.SPLIT_BEFORE_BITWISE_OPERATOR))
         if split_before:
-          _SetSplitPenalty(_LastChildNode(node.children[1].children[1]), 0)
+          _SetSplitPenalty(self._Settled(_LastChildNode(elements[1]), node), 0)
         else:
-          _SetSplitPenalty(_FirstChildNode(node.children[1].children[2]), 0)
+          _SetSplitPenalty(self._Settled(_FirstChildNode(elements[2]), node), 0)
 
         # Don't split the ending bracket of a subscript list.
         _SetVeryStronglyConnected(node.children[-1])
@@ -220,12 +285,15 @@ class _SplitPenaltyAssigner(pytree_visitor.PyTreeVisitor):
           'atom', 'power'
       }:
         # Don't split an argument list with one element if at all possible.
-        _SetStronglyConnected(node.children[1], node.children[2])
-    self.DefaultNodeVisit(node)
+        self._DeferRecAnnotate(node.children[1], STRONGLY_CONNECTED, node)
+        self._DeferRecAnnotate(node.children[2], STRONGLY_CONNECTED, node)
+
+  def Enter_power(self, node):  # pylint: disable=invalid-name
+    self.DefaultNodeEnter(node)
+    self._power_depth += 1
 
-  def Visit_power(self, node):  # pylint: disable=invalid-name,missing-docstring
+  def Leave_power(self, node):  # pylint: disable=invalid-name,missing-docstring
     # power ::= atom trailer* ['**' factor]
-    self.DefaultNodeVisit(node)
 
     # When atom is followed by a trailer, we can not break between them.
     # E.g. arr[idx] - no break allowed between 'arr' and '['.
@@ -233,7 +301,7 @@ class _SplitPenaltyAssigner(pytree_visitor.PyTreeVisitor):
         pytree_utils.NodeName(node.children[1]) == 'trailer'):
       # children[1] itself is a whole trailer: we don't want to
       # mark all of it as unbreakable, only its first token: (, [ or .
-      _SetUnbreakable(node.children[1].children[0])
+      _SetUnbreakable(self._Settled(node.children[1].children[0], node))
 
       # A special case when there are more trailers in the sequence. Given:
       #   atom tr1 tr2
@@ -253,8 +321,9 @@ class _SplitPenaltyAssigner(pytree_visitor.PyTreeVisitor):
             #   atom tr1() tr2
             # It may be necessary (though undesirable) to split up a previous
             # function call's parentheses to the next line.
-            _SetStronglyConnected(prev_trailer.children[-1])
-          _SetStronglyConnected(cur_trailer.children[0])
+            _SetStronglyConnected(
+                self._Settled(prev_trailer.children[-1], node))
+          _SetStronglyConnected(self._Settled(cur_trailer.children[0], node))
           prev_trailer_idx = cur_trailer_idx
         else:
           break
@@ -269,15 +338,17 @@ class _SplitPenaltyAssigner(pytree_visitor.PyTreeVisitor):
       if trailer.children[0].value in '([':
         if len(trailer.children) > 2:
           subtypes = pytree_utils.GetNodeAnnotation(
-              trailer.children[0], pytree_utils.Annotation.SUBTYPE)
-          if subtypes and format_token.Subtype.SUBSCRIPT_BRACKET in subtypes:
-            _SetStronglyConnected(_FirstChildNode(trailer.children[1]))
+              trailer.children[0], pytree_utils.Annotation.SUBTYPE, 0)
+          if subtypes & format_token.Subtype.SUBSCRIPT_BRACKET:
+            _SetStronglyConnected(
+                self._Settled(_FirstChildNode(trailer.children[1]), node))
 
           last_child_node = _LastChildNode(trailer)
           if last_child_node.value.strip().startswith('#'):
             last_child_node = last_child_node.prev_sibling
-          if not style.Get('DEDENT_CLOSING_BRACKETS'):
+          if not self._style.DEDENT_CLOSING_BRACKETS:
             if _LastChildNode(last_child_node.prev_sibling).value != ',':
+              self._Settled(last_child_node, node)
               if last_child_node.value == ']':
                 _SetUnbreakable(last_child_node)
               else:
@@ -286,252 +357,409 @@ class _SplitPenaltyAssigner(pytree_visitor.PyTreeVisitor):
           # If the trailer's children are '()', then make it a strongly
           # connected region.  It's sometimes necessary, though undesirable, to
           # split the two.
-          _SetStronglyConnected(trailer.children[-1])
+          _SetStronglyConnected(self._Settled(trailer.children[-1], node))
 
     # If the original source has a "builder" style calls, then we should allow
-    # the reformatter to retain that.
-    _AllowBuilderStyleCalls(node)
-
-  def Visit_subscript(self, node):  # pylint: disable=invalid-name
+    # the reformatter to retain that. The calls in the powers nested in this
+    # one are looked at again here, and whatever happened to them in between
+    # is overwritten. So only the outermost power needs to look at them.
+    self._power_depth -= 1
+    if not self._power_depth:
+      self._AllowBuilderStyleCalls(node)
+
+  def Enter_subscript(self, node):  # pylint: disable=invalid-name
     # subscript ::= test | [test] ':' [test] [sliceop]
-    _SetStronglyConnected(*node.children)
-    self.DefaultNodeVisit(node)
+    self.DefaultNodeEnter(node)
+    for child in node.children:
+      self._DeferRecAnnotate(child, STRONGLY_CONNECTED, node)
 
-  def Visit_comp_for(self, node):  # pylint: disable=invalid-name
+  def Enter_comp_for(self, node):  # pylint: disable=invalid-name
     # comp_for ::= 'for' exprlist 'in' testlist_safe [comp_iter]
-    _SetSplitPenalty(_FirstChildNode(node), 0)
-    _SetStronglyConnected(*node.children[1:])
-    self.DefaultNodeVisit(node)
+    self.DefaultNodeEnter(node)
+    _SetSplitPenalty(self._Settled(_FirstChildNode(node), node), 0)
+    for child in node.children[1:]:
+      self._DeferRecAnnotate(child, STRONGLY_CONNECTED, node)
 
-  def Visit_comp_if(self, node):  # pylint: disable=invalid-name
+  def Enter_comp_if(self, node):  # pylint: disable=invalid-name
     # comp_if ::= 'if' old_test [comp_iter]
-    _SetSplitPenalty(node.children[0],
-                     style.Get('SPLIT_PENALTY_BEFORE_IF_EXPR'))
-    _SetStronglyConnected(*node.children[1:])
-    self.DefaultNodeVisit(node)
+    self.DefaultNodeEnter(node)
+    _SetSplitPenalty(node.children[0], self._style.SPLIT_PENALTY_BEFORE_IF_EXPR)
+    for child in node.children[1:]:
+      self._DeferRecAnnotate(child, STRONGLY_CONNECTED, node)
 
-  def Visit_or_test(self, node):  # pylint: disable=invalid-name
+  def Leave_or_test(self, node):  # pylint: disable=invalid-name
     # or_test ::= and_test ('or' and_test)*
-    self.DefaultNodeVisit(node)
-    _IncreasePenalty(node, OR_TEST)
+    self._DeferIncrease(node, OR_TEST)
     index = 1
     while index + 1 < len(node.children):
-      if style.Get('SPLIT_BEFORE_LOGICAL_OPERATOR'):
-        _DecrementSplitPenalty(_FirstChildNode(node.children[index]), OR_TEST)
+      if self._style.SPLIT_BEFORE_LOGICAL_OPERATOR:
+        _DecrementSplitPenalty(
+            self._Settled(_FirstChildNode(node.children[index]), node), OR_TEST)
       else:
         _DecrementSplitPenalty(
-            _FirstChildNode(node.children[index + 1]), OR_TEST)
+            self._Settled(_FirstChildNode(node.children[index + 1]), node),
+            OR_TEST)
       index += 2
 
-  def Visit_and_test(self, node):  # pylint: disable=invalid-name
+  def Leave_and_test(self, node):  # pylint: disable=invalid-name
     # and_test ::= not_test ('and' not_test)*
-    self.DefaultNodeVisit(node)
-    _IncreasePenalty(node, AND_TEST)
+    self._DeferIncrease(node, AND_TEST)
     index = 1
     while index + 1 < len(node.children):
-      if style.Get('SPLIT_BEFORE_LOGICAL_OPERATOR'):
-        _DecrementSplitPenalty(_FirstChildNode(node.children[index]), AND_TEST)
+      if self._style.SPLIT_BEFORE_LOGICAL_OPERATOR:
+        _DecrementSplitPenalty(
+            self._Settled(_FirstChildNode(node.children[index]), node),
+            AND_TEST)
       else:
         _DecrementSplitPenalty(
-            _FirstChildNode(node.children[index + 1]), AND_TEST)
+            self._Settled(_FirstChildNode(node.children[index + 1]), node),
+            AND_TEST)
       index += 2
 
-  def Visit_not_test(self, node):  # pylint: disable=invalid-name
+  def Leave_not_test(self, node):  # pylint: disable=invalid-name
     # not_test ::= 'not' not_test | comparison
-    self.DefaultNodeVisit(node)
-    _IncreasePenalty(node, NOT_TEST)
+    self._DeferIncrease(node, NOT_TEST)
 
-  def Visit_comparison(self, node):  # pylint: disable=invalid-name
+  def Leave_comparison(self, node):  # pylint: disable=invalid-name
     # comparison ::= expr (comp_op expr)*
-    self.DefaultNodeVisit(node)
     if len(node.children) == 3 and _StronglyConnectedCompOp(node):
-      _SetSplitPenalty(_FirstChildNode(node.children[1]), STRONGLY_CONNECTED)
-      _SetSplitPenalty(_FirstChildNode(node.children[2]), STRONGLY_CONNECTED)
+      _SetSplitPenalty(
+          self._Settled(_FirstChildNode(node.children[1]), node),
+          STRONGLY_CONNECTED)
+      _SetSplitPenalty(
+          self._Settled(_FirstChildNode(node.children[2]), node),
+          STRONGLY_CONNECTED)
     else:
-      _IncreasePenalty(node, COMPARISON)
+      self._DeferIncrease(node, COMPARISON)
 
-  def Visit_star_expr(self, node):  # pylint: disable=invalid-name
+  def Leave_star_expr(self, node):  # pylint: disable=invalid-name
     # star_expr ::= '*' expr
-    self.DefaultNodeVisit(node)
-    _IncreasePenalty(node, STAR_EXPR)
+    self._DeferIncrease(node, STAR_EXPR)
 
-  def Visit_expr(self, node):  # pylint: disable=invalid-name
+  def Leave_expr(self, node):  # pylint: disable=invalid-name
     # expr ::= xor_expr ('|' xor_expr)*
-    self.DefaultNodeVisit(node)
-    _IncreasePenalty(node, EXPR)
+    self._DeferIncrease(node, EXPR)
     index = 1
     while index < len(node.children) - 1:
       child = node.children[index]
       if isinstance(child, pytree.Leaf) and child.value == '|':
-        if style.Get('SPLIT_BEFORE_BITWISE_OPERATOR'):
-          _SetSplitPenalty(child, style.Get('SPLIT_PENALTY_BITWISE_OPERATOR'))
+        if self._style.SPLIT_BEFORE_BITWISE_OPERATOR:
+          _SetSplitPenalty(
+              self._Settled(child, node),
+              self._style.SPLIT_PENALTY_BITWISE_OPERATOR)
         else:
           _SetSplitPenalty(
-              _FirstChildNode(node.children[index + 1]),
-              style.Get('SPLIT_PENALTY_BITWISE_OPERATOR'))
+              self._Settled(_FirstChildNode(node.children[index + 1]), node),
+              self._style.SPLIT_PENALTY_BITWISE_OPERATOR)
       index += 1
 
-  def Visit_xor_expr(self, node):  # pylint: disable=invalid-name
+  def Leave_xor_expr(self, node):  # pylint: disable=invalid-name
     # xor_expr ::= and_expr ('^' and_expr)*
-    self.DefaultNodeVisit(node)
-    _IncreasePenalty(node, XOR_EXPR)
+    self._DeferIncrease(node, XOR_EXPR)
 
-  def Visit_and_expr(self, node):  # pylint: disable=invalid-name
+  def Leave_and_expr(self, node):  # pylint: disable=invalid-name
     # and_expr ::= shift_expr ('&' shift_expr)*
-    self.DefaultNodeVisit(node)
-    _IncreasePenalty(node, AND_EXPR)
+    self._DeferIncrease(node, AND_EXPR)
 
-  def Visit_shift_expr(self, node):  # pylint: disable=invalid-name
+  def Leave_shift_expr(self, node):  # pylint: disable=invalid-name
     # shift_expr ::= arith_expr (('<<'|'>>') arith_expr)*
-    self.DefaultNodeVisit(node)
-    _IncreasePenalty(node, SHIFT_EXPR)
+    self._DeferIncrease(node, SHIFT_EXPR)
 
-  def Visit_arith_expr(self, node):  # pylint: disable=invalid-name
+  def Leave_arith_expr(self, node):  # pylint: disable=invalid-name
     # arith_expr ::= term (('+'|'-') term)*
-    self.DefaultNodeVisit(node)
-    _IncreasePenalty(node, ARITH_EXPR)
+    self._DeferIncrease(node, ARITH_EXPR)
 
     index = 1
     while index < len(node.children) - 1:
       child = node.children[index]
       if isinstance(child, pytree.Leaf) and child.value in '+-':
-        next_node = _FirstChildNode(node.children[index + 1])
-        _SetSplitPenalty(
-            next_node,
-            pytree_utils.GetNodeAnnotation(
-                next_node, pytree_utils.Annotation.SPLIT_PENALTY, default=0) -
-            100)
+        next_node = self._Settled(
+            _FirstChildNode(node.children[index + 1]), node)
+        _SetSplitPenalty(next_node, _GetSplitPenalty(next_node, 0) - 100)
       index += 1
 
-  def Visit_term(self, node):  # pylint: disable=invalid-name
+  def Enter_term(self, node):  # pylint: disable=invalid-name
     # term ::= factor (('*'|'@'|'/'|'%'|'//') factor)*
-    _IncreasePenalty(node, TERM)
-    self.DefaultNodeVisit(node)
+    #
+    # Nothing in the term was left yet, so the increase can't be deferred.
+    self.DefaultNodeEnter(node)
+    _IncreasePenalty(self._Settled(node, node), TERM)
 
-  def Visit_factor(self, node):  # pyline: disable=invalid-name
+  def Leave_factor(self, node):  # pyline: disable=invalid-name
     # factor ::= ('+'|'-'|'~') factor | power
-    self.DefaultNodeVisit(node)
-    _IncreasePenalty(node, FACTOR)
+    self._DeferIncrease(node, FACTOR)
 
-  def Visit_atom(self, node):  # pylint: disable=invalid-name
+  def Leave_atom(self, node):  # pylint: disable=invalid-name
     # atom ::= ('(' [yield_expr|testlist_gexp] ')'
     #           '[' [listmaker] ']' |
     #           '{' [dictsetmaker] '}')
-    self.DefaultNodeVisit(node)
     if node.children[0].value == '(':
       if node.children[-1].value == ')':
         if pytree_utils.NodeName(node.parent) == 'if_stmt':
-          _SetSplitPenalty(node.children[-1], STRONGLY_CONNECTED)
+          _SetSplitPenalty(
+              self._Settled(node.children[-1], node), STRONGLY_CONNECTED)
         else:
           if len(node.children) > 2:
-            _SetSplitPenalty(_FirstChildNode(node.children[1]), EXPR)
-          _SetSplitPenalty(node.children[-1], ATOM)
+            _SetSplitPenalty(
+                self._Settled(_FirstChildNode(node.children[1]), node), EXPR)
+          _SetSplitPenalty(self._Settled(node.children[-1], node), ATOM)
     elif node.children[0].value in '[{' and len(node.children) == 2:
       # Keep empty containers together if we can.
-      _SetUnbreakable(node.children[-1])
+      _SetUnbreakable(self._Settled(node.children[-1], node))
 
-  def Visit_testlist_gexp(self, node):  # pylint: disable=invalid-name
-    self.DefaultNodeVisit(node)
+  def Leave_testlist_gexp(self, node):  # pylint: disable=invalid-name
     prev_was_comma = False
     for child in node.children:
       if isinstance(child, pytree.Leaf) and child.value == ',':
-        _SetUnbreakable(child)
+        _SetUnbreakable(self._Settled(child, node))
         prev_was_comma = True
       else:
         if prev_was_comma:
-          _SetSplitPenalty(_FirstChildNode(child), 0)
+          _SetSplitPenalty(self._Settled(_FirstChildNode(child), node), 0)
         prev_was_comma = False
 
-  ############################################################################
-  # Helper methods that set the annotations.
+  def _AllowBuilderStyleCalls(self, node):
+    """Allow splitting before '.' if it's a builder style function call."""
+    prev_child = None
+    for child in pytree_utils.IterLeaves(node):
+      if child.value == '.':
+        if prev_child.lineno != child.lineno:
+          _SetSplitPenalty(self._Settled(child, node), 0)
+      prev_child = child
 
-  def _SetUnbreakableOnChildren(self, node):
-    """Set an UNBREAKABLE penalty annotation on children of node."""
-    for child in node.children:
-      self.Visit(child)
-    start = 2 if hasattr(node.children[0], 'is_pseudo') else 1
-    for i in py3compat.range(start, len(node.children)):
-      _SetUnbreakable(node.children[i])
+  def _DeferRecAnnotate(self, tree, penalty, scope):
+    """Set a minimum penalty on the leaves of a subtree that wasn't entered.
+
+    The penalty is recorded on the subtree. It's handed down to the leaves as
+    the nodes below are entered.
+
+    Arguments:
+      tree: the subtree, below the node that's being entered.
+      penalty: the split penalty.
+      scope: the node that's being entered.
+    """
+    # There are no increases pending on the way to a subtree that wasn't
+    # entered.
+    penalty = max(penalty, self._TakePendingAbove(tree, scope)[0])
+    self._AddPending(tree, penalty, 0, 0)
+
+  def _DeferIncrease(self, node, amt):
+    """Increase the penalties of the leaves of a node, but the first one.
+
+    The increase is recorded on the node. It's handed down to the leaves by
+    _Settled() and Finish().
+
+    Arguments:
+      node: the node that's being left.
+      amt: the amount to increase the penalties by.
+    """
+    if isinstance(node, pytree.Leaf):
+      # The only leaf is the first one.
+      return
+    self._AddPending(node, 0, amt, 0)
+
+  def _AddPending(self, node, penalty, amt, first_amt):
+    """Record changes of the penalties of the leaves of a node.
+
+    Arguments:
+      node: the node or leaf. The changes of a leaf are made right away.
+      penalty: the minimum penalty of the leaves, or 0.
+      amt: the increase of the leaves but the first one.
+      first_amt: the increase of the first leaf.
+    """
+    if isinstance(node, pytree.Leaf):
+      if penalty:
+        _RaiseLeafPenalty(node, penalty)
+      if first_amt:
+        _IncreaseLeafPenalty(node, first_amt)
+      return
+    if penalty:
+      pending = self._maxes.get(id(node))
+      if pending is None:
+        self._maxes[id(node)] = [node, penalty]
+      elif pending[1] < penalty:
+        pending[1] = penalty
+    if amt or first_amt:
+      increase = self._increases.get(id(node))
+      if increase is None:
+        self._increases[id(node)] = [node, amt, first_amt]
+        self._increased.append(node)
+      else:
+        increase[1] += amt
+        increase[2] += first_amt
+
+  def _Settled(self, node, scope):
+    """Hand down the pending changes that apply to the leaves of a node.
+
+    Arguments:
+      node: the node or leaf whose penalties are about to be read or set.
+      scope: the node the running hook was invoked for, which is node or one of
+        its ancestors.
+
+    Returns:
+      The node.
+    """
+    if self._maxes or self._increases:
+      penalty, amt, first_amt = self._TakePendingAbove(node, scope)
+      if not isinstance(node, pytree.Leaf):
+        self._HandDown(node, penalty, amt, first_amt)
+      elif penalty or first_amt:
+        self._AddPending(node, penalty, amt, first_amt)
+    return node
+
+  def _TakePendingAbove(self, node, scope):
+    """Take the changes pending on the way from scope down to a node.
+
+    The changes that apply to the other children of the nodes on the way are
+    recorded on those.
+
+    Arguments:
+      node: the node or leaf.
+      scope: the node the running hook was invoked for, which is node or one of
+        its ancestors. Nothing is pending above it: the changes of the nodes
+        that were entered were handed down already, and the nodes above it
+        were not left yet.
+
+    Returns:
+      The minimum penalty, the increase of the leaves but the first one and the
+      increase of the first leaf that apply to the node.
+    """
+    maxes = self._maxes
+    increases = self._increases
+    parent = node
+    while parent is not scope:
+      parent = parent.parent
+      if parent is None:
+        # The continuation markers aren't linked to their parents, so hand
+        # down all that's pending below the scope instead.
+        self._HandDown(scope)
+        return 0, 0, 0
+      if id(parent) in increases or id(parent) in maxes:
+        break
+    else:
+      # Usually there's nothing pending on the way.
+      return 0, 0, 0
+
+    path = []
+    parent = node
+    while parent is not scope:
+      path.append(parent)
+      parent = parent.parent
+
+    penalty = amt = first_amt = 0
+    for child in reversed(path):
+      pending = maxes.pop(id(parent), None)
+      if pending and pending[1] > penalty:
+        penalty = pending[1]
+      increase = increases.pop(id(parent), None)
+      if increase:
+        amt += increase[1]
+        first_amt += increase[2]
+      if penalty or amt or first_amt:
+        siblings = parent.children
+        if child is not siblings[0]:
+          self._AddPending(siblings[0], penalty, amt, first_amt)
+          first_amt = amt
+        for sibling in siblings[1:]:
+          if sibling is not child:
+            self._AddPending(sibling, penalty, amt, amt)
+      parent = child
+    return penalty, amt, first_amt
+
+  def _HandDown(self, node, penalty=0, amt=0, first_amt=0):
+    """Apply the pending changes in the subtree of a node to its leaves.
+
+    The minimum penalties are set before the increases, since the hooks that
+    set them run before the ones that increase the same penalties.
+
+    Arguments:
+      node: the node or leaf.
+      penalty: the minimum penalty of the leaves from above the node.
+      amt: the increase of the leaves but the first one from above the node.
+      first_amt: the increase of the first leaf from above the node.
+    """
+    stack = [(node, penalty, amt, first_amt)]
+    while stack:
+      node, penalty, amt, first_amt = stack.pop()
+      if self._maxes:
+        pending = self._maxes.pop(id(node), None)
+        if pending and pending[1] > penalty:
+          penalty = pending[1]
+      increase = self._increases.pop(id(node), None)
+      if increase:
+        amt += increase[1]
+        first_amt += increase[2]
+      if isinstance(node, pytree.Leaf):
+        if penalty:
+          _RaiseLeafPenalty(node, penalty)
+        if first_amt:
+          _IncreaseLeafPenalty(node, first_amt)
+      elif node.children:
+        children = node.children
+        stack.append((children[0], penalty, amt, first_amt))
+        stack.extend([(child, penalty, amt, amt) for child in children[1:]])
+
+
+def _SetUnbreakableOnChildren(node):
+  """Set an UNBREAKABLE penalty annotation on children of node."""
+  start = 2 if hasattr(node.children[0], 'is_pseudo') else 1
+  for i in py3compat.range(start, len(node.children)):
+    _SetUnbreakable(node.children[i])
 
 
 def _SetUnbreakable(node):
   """Set an UNBREAKABLE penalty annotation for the given node."""
-  _RecAnnotate(node, pytree_utils.Annotation.SPLIT_PENALTY, UNBREAKABLE)
+  _RecAnnotate(node, UNBREAKABLE)
 
 
 def _SetStronglyConnected(*nodes):
   """Set a STRONGLY_CONNECTED penalty annotation for the given nodes."""
   for node in nodes:
-    _RecAnnotate(node, pytree_utils.Annotation.SPLIT_PENALTY,
-                 STRONGLY_CONNECTED)
+    _RecAnnotate(node, STRONGLY_CONNECTED)
 
 
 def _SetVeryStronglyConnected(*nodes):
   """Set a VERY_STRONGLY_CONNECTED penalty annotation for the given nodes."""
   for node in nodes:
-    _RecAnnotate(node, pytree_utils.Annotation.SPLIT_PENALTY,
-                 VERY_STRONGLY_CONNECTED)
-
-
-def _SetExpressionPenalty(node, penalty):
-  """Set a penalty annotation on children nodes."""
-
-  def RecExpression(node, first_child_leaf):
-    if node is first_child_leaf:
-      return
-
-    if isinstance(node, pytree.Leaf):
-      if node.value in {'(', 'for', 'if'}:
-        return
-      penalty_annotation = pytree_utils.GetNodeAnnotation(
-          node, pytree_utils.Annotation.SPLIT_PENALTY, default=0)
-      if penalty_annotation < penalty:
-        _SetSplitPenalty(node, penalty)
-    else:
-      for child in node.children:
-        RecExpression(child, first_child_leaf)
-
-  RecExpression(node, _FirstChildNode(node))
+    _RecAnnotate(node, VERY_STRONGLY_CONNECTED)
 
 
 def _IncreasePenalty(node, amt):
   """Increase a penalty annotation on children nodes."""
+  first_child_leaf = _FirstChildNode(node)
+  for leaf in pytree_utils.IterLeaves(node):
+    if leaf is not first_child_leaf:
+      _IncreaseLeafPenalty(leaf, amt)
 
-  def RecExpression(node, first_child_leaf):
-    if node is first_child_leaf:
-      return
 
-    if isinstance(node, pytree.Leaf):
-      if node.value in {'(', 'for', 'if'}:
-        return
-      penalty = pytree_utils.GetNodeAnnotation(
-          node, pytree_utils.Annotation.SPLIT_PENALTY, default=0)
-      _SetSplitPenalty(node, penalty + amt)
-    else:
-      for child in node.children:
-        RecExpression(child, first_child_leaf)
-
-  RecExpression(node, _FirstChildNode(node))
+def _IncreaseLeafPenalty(leaf, amt):
+  """Increase the penalty annotation of a leaf, unless it's never increased."""
+  if amt and leaf.value not in {'(', 'for', 'if'}:
+    _SetSplitPenalty(leaf, _GetSplitPenalty(leaf, 0) + amt)
 
 
-def _RecAnnotate(tree, annotate_name, annotate_value):
-  """Recursively set the given annotation on all leafs of the subtree.
+def _RecAnnotate(tree, penalty):
+  """Set the given split penalty on all leafs of the subtree.
 
   Takes care to only increase the penalty. If the node already has a higher
   or equal penalty associated with it, this is a no-op.
 
   Args:
     tree: subtree to annotate
-    annotate_name: name of the annotation to set
-    annotate_value: value of the annotation to set
+    penalty: split penalty to set
   """
-  for child in tree.children:
-    _RecAnnotate(child, annotate_name, annotate_value)
-  if isinstance(tree, pytree.Leaf):
-    cur_annotate = pytree_utils.GetNodeAnnotation(
-        tree, annotate_name, default=0)
-    if cur_annotate < annotate_value:
-      pytree_utils.SetNodeAnnotation(tree, annotate_name, annotate_value)
+  for leaf in pytree_utils.IterLeaves(tree):
+    annotations = pytree_utils.GetNodeAnnotations(leaf)
+    if (annotations.split_penalty or 0) < penalty:
+      annotations.split_penalty = penalty
+
+
+def _RaiseLeafPenalty(leaf, penalty):
+  """Set the penalty annotation of a leaf if it has a lower one."""
+  if penalty:
+    annotations = pytree_utils.GetNodeAnnotations(leaf)
+    if (annotations.split_penalty or 0) < penalty:
+      annotations.split_penalty = penalty
 
 
 def _StronglyConnectedCompOp(op):
@@ -547,44 +775,27 @@ def _StronglyConnectedCompOp(op):
 
 
 def _DecrementSplitPenalty(node, amt):
-  penalty = pytree_utils.GetNodeAnnotation(
-      node, pytree_utils.Annotation.SPLIT_PENALTY, default=amt)
+  penalty = _GetSplitPenalty(node, amt)
   penalty = penalty - amt if amt < penalty else 0
   _SetSplitPenalty(node, penalty)
 
 
-def _SetSplitPenalty(node, penalty):
-  pytree_utils.SetNodeAnnotation(node, pytree_utils.Annotation.SPLIT_PENALTY,
-                                 penalty)
-
+def _GetSplitPenalty(node, default):
+  penalty = pytree_utils.GetNodeAnnotations(node).split_penalty
+  return default if penalty is None else penalty
 
-def _AllowBuilderStyleCalls(node):
-  """Allow splitting before '.' if it's a builder style function call."""
-
-  def RecGetLeaves(node):
-    if isinstance(node, pytree.Leaf):
-      return [node]
-    children = []
-    for child in node.children:
-      children += RecGetLeaves(child)
-    return children
 
-  list_of_children = RecGetLeaves(node)
-  prev_child = None
-  for child in list_of_children:
-    if child.value == '.':
-      if prev_child.lineno != child.lineno:
-        _SetSplitPenalty(child, 0)
-    prev_child = child
+def _SetSplitPenalty(node, penalty):
+  pytree_utils.GetNodeAnnotations(node).split_penalty = penalty
 
 
 def _FirstChildNode(node):
-  if isinstance(node, pytree.Leaf):
-    return node
-  return _FirstChildNode(node.children[0])
+  while not isinstance(node, pytree.Leaf):
+    node = node.children[0]
+  return node
 
 
 def _LastChildNode(node):
-  if isinstance(node, pytree.Leaf):
-    return node
-  return _LastChildNode(node.children[-1])
+  while not isinstance(node, pytree.Leaf):
+    node = node.children[-1]
+  return node
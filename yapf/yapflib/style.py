@@ -13,9 +13,11 @@
 # limitations under the License.
 """Python formatting style settings."""
 
+import contextlib
 import os
 import re
 import textwrap
+import threading
 
 from yapf.yapflib import errors
 from yapf.yapflib import py3compat
@@ -28,7 +30,41 @@ class StyleConfigError(errors.YapfError):
 
 def Get(setting_name):
   """Get a style setting."""
-  return _style[setting_name]
+  return getattr(Current(), setting_name)
+
+
+def Current():
+  """Return the Style currently in effect.
+
+  That's the style the current thread is formatting with (see UseStyle()), or
+  else the global style.
+
+  Code that looks up style settings in a loop should bind this to a local
+  rather than calling Get() for every setting.
+  """
+  style = _thread_style.style
+  return _style if style is None else style
+
+
+@contextlib.contextmanager
+def UseStyle(style):
+  """Format with the style in the current thread until the block exits.
+
+  Other threads, and the global style, are unaffected. So threads can format
+  with different styles at the same time.
+
+  Arguments:
+    style: (dict or Style) The style to use.
+
+  Yields:
+    The Style in effect in the block.
+  """
+  previous = _thread_style.style
+  _thread_style.style = style if isinstance(style, Style) else Style(style)
+  try:
+    yield _thread_style.style
+  finally:
+    _thread_style.style = previous
 
 
 def Help():
@@ -37,13 +73,17 @@ def Help():
 
 
 def SetGlobalStyle(style):
-  """Set a style dict."""
+  """Set the global style from a style dict or Style.
+
+  The global style is used by the threads that aren't formatting with a style
+  of their own (see UseStyle()).
+  """
   global _style
   global _GLOBAL_STYLE_FACTORY
   factory = _GetStyleFactory(style)
   if factory:
     _GLOBAL_STYLE_FACTORY = factory
-  _style = style
+  _style = style if isinstance(style, Style) else Style(style)
 
 
 _STYLE_HELP = dict(
@@ -143,6 +183,25 @@ _STYLE_HELP = dict(
         1 + 2*3 - 4/5
 
       """),
+    SEARCH_BEAM_WIDTH=textwrap.dedent("""\
+      The maximum number of formatting states considered for each token of a
+      line. Only the cheapest states are kept, which bounds the time spent on
+      very long lines at the expense of possibly missing the optimal
+      formatting. A value of 0 searches the whole solution space."""),
+    SEARCH_DOMINANCE_PRUNING=textwrap.dedent("""\
+      Once the formatting search of a line has grown large, drop the states
+      that are at a higher column than another state at the same token that
+      was reached with no more penalty. This speeds up very long lines, but
+      may change their formatting from the one the full search finds."""),
+    SEARCH_FILE_TIME_LIMIT=textwrap.dedent("""\
+      The number of seconds the formatting searches of all the lines of a file
+      may take together. Once they're used up, the remaining lines are
+      formatted greedily. A value of 0 means no limit."""),
+    SEARCH_LINE_TIME_LIMIT=textwrap.dedent("""\
+      The number of seconds the formatting search of a line may take. When the
+      time is up, the line is finished greedily from the most promising layout
+      found so far, or keeps its original layout if that's cheaper. A value of
+      0 means no limit."""),
     SPACE_BETWEEN_ENDING_COMMA_AND_CLOSING_BRACKET=textwrap.dedent("""\
       Insert a space between the ending comma and closing bracket of a list,
       etc."""),
@@ -253,9 +312,13 @@ def CreatePEP8Style():
       INDENT_DICTIONARY_VALUE=False,
       INDENT_WIDTH=4,
       JOIN_MULTIPLE_LINES=True,
+      NO_SPACES_AROUND_SELECTED_BINARY_OPERATORS=set(),
+      SEARCH_BEAM_WIDTH=0,
+      SEARCH_DOMINANCE_PRUNING=False,
+      SEARCH_FILE_TIME_LIMIT=0,
+      SEARCH_LINE_TIME_LIMIT=0,
       SPACE_BETWEEN_ENDING_COMMA_AND_CLOSING_BRACKET=True,
       SPACES_AROUND_POWER_OPERATOR=False,
-      NO_SPACES_AROUND_SELECTED_BINARY_OPERATORS=set(),
       SPACES_AROUND_DEFAULT_OR_NAMED_ASSIGN=False,
       SPACES_BEFORE_COMMENT=2,
       SPLIT_ARGUMENTS_WHEN_COMMA_TERMINATED=False,
@@ -385,6 +448,10 @@ _STYLE_OPTION_VALUE_CONVERTER = dict(
     INDENT_WIDTH=int,
     JOIN_MULTIPLE_LINES=_BoolConverter,
     NO_SPACES_AROUND_SELECTED_BINARY_OPERATORS=_StringSetConverter,
+    SEARCH_BEAM_WIDTH=int,
+    SEARCH_DOMINANCE_PRUNING=_BoolConverter,
+    SEARCH_FILE_TIME_LIMIT=float,
+    SEARCH_LINE_TIME_LIMIT=float,
     SPACE_BETWEEN_ENDING_COMMA_AND_CLOSING_BRACKET=_BoolConverter,
     SPACES_AROUND_POWER_OPERATOR=_BoolConverter,
     SPACES_AROUND_DEFAULT_OR_NAMED_ASSIGN=_BoolConverter,
@@ -411,18 +478,109 @@ _STYLE_OPTION_VALUE_CONVERTER = dict(
 )
 
 
+class Style(object):
+  """A compiled, immutable style.
+
+  Styles are written as dicts of option names to values, like those returned by
+  CreatePEP8Style(). A Style holds the options of such a dict as attributes, so
+  that they're cheap to look up while formatting, and works out the values the
+  formatter derives from them once.
+
+  A Style can also be read like a dict (style['COLUMN_LIMIT']) and compares
+  equal to a dict with the same options. Use AsDict() to get a dict to derive
+  a new style from.
+
+  Attributes:
+    i18n_comment_regex: The compiled I18N_COMMENT regex, or None if there's no
+      I18N_COMMENT.
+    i18n_function_calls: A frozenset of the I18N_FUNCTION_CALL names.
+  """
+
+  __slots__ = tuple(sorted(_STYLE_OPTION_VALUE_CONVERTER)) + (
+      'i18n_comment_regex', 'i18n_function_calls')
+
+  def __init__(self, options):
+    """Initializer.
+
+    Arguments:
+      options: (dict) The style options.
+
+    Raises:
+      StyleConfigError: if an unknown style option was encountered.
+    """
+    for option, value in options.items():
+      if option not in _STYLE_OPTION_VALUE_CONVERTER:
+        raise StyleConfigError('Unknown style option "{0}"'.format(option))
+      object.__setattr__(self, option, value)
+
+    i18n_comment = options.get('I18N_COMMENT')
+    object.__setattr__(self, 'i18n_comment_regex',
+                       re.compile(i18n_comment) if i18n_comment else None)
+    i18n_function_calls = options.get('I18N_FUNCTION_CALL') or []
+    if isinstance(i18n_function_calls, py3compat.basestring):
+      i18n_function_calls = _StringListConverter(i18n_function_calls)
+    object.__setattr__(self, 'i18n_function_calls',
+                       frozenset(i18n_function_calls))
+
+  def __setattr__(self, name, value):
+    raise AttributeError('A Style is immutable')
+
+  def __delattr__(self, name):
+    raise AttributeError('A Style is immutable')
+
+  def AsDict(self):
+    """Return the style's options as a new dict."""
+    return dict(self.items())
+
+  def keys(self):  # pylint: disable=invalid-name
+    return [
+        name for name in Style.__slots__
+        if name in _STYLE_OPTION_VALUE_CONVERTER and hasattr(self, name)
+    ]
+
+  def items(self):  # pylint: disable=invalid-name
+    return [(name, getattr(self, name)) for name in self.keys()]
+
+  def __getitem__(self, option):
+    if option not in _STYLE_OPTION_VALUE_CONVERTER or not hasattr(self, option):
+      raise KeyError(option)
+    return getattr(self, option)
+
+  def __contains__(self, option):
+    return option in _STYLE_OPTION_VALUE_CONVERTER and hasattr(self, option)
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def __len__(self):
+    return len(self.keys())
+
+  def __eq__(self, other):
+    if isinstance(other, Style):
+      other = other.AsDict()
+    return self.AsDict() == other
+
+  def __ne__(self, other):
+    return not self == other
+
+  __hash__ = None
+
+  def __repr__(self):
+    return 'Style(%r)' % self.AsDict()
+
+
 def CreateStyleFromConfig(style_config):
-  """Create a style dict from the given config.
+  """Create a Style from the given config.
 
   Arguments:
-    style_config: either a style name or a file name. The file is expected to
-      contain settings. It can have a special BASED_ON_STYLE setting naming the
-      style which it derives from. If no such setting is found, it derives from
-      the default style. When style_config is None, the _GLOBAL_STYLE_FACTORY
-      config is created.
+    style_config: either a style name, a file name, a dict of settings or a
+      Style. The file is expected to contain settings. It can have a special
+      BASED_ON_STYLE setting naming the style which it derives from. If no such
+      setting is found, it derives from the default style. When style_config is
+      None, the _GLOBAL_STYLE_FACTORY config is created.
 
   Returns:
-    A style dict.
+    A Style.
 
   Raises:
     StyleConfigError: if an unknown style option was encountered.
@@ -440,20 +598,22 @@ def CreateStyleFromConfig(style_config):
         break
     if not def_style:
       return _style
-    return _GLOBAL_STYLE_FACTORY()
+    return Style(_GLOBAL_STYLE_FACTORY())
+  if isinstance(style_config, Style):
+    return style_config
   if isinstance(style_config, dict):
     config = _CreateConfigParserFromConfigDict(style_config)
   elif isinstance(style_config, py3compat.basestring):
     style_factory = _STYLE_NAME_TO_FACTORY.get(style_config.lower())
     if style_factory is not None:
-      return style_factory()
+      return Style(style_factory())
     if style_config.startswith('{'):
       # Most likely a style specification from the command line.
       config = _CreateConfigParserFromConfigString(style_config)
     else:
       # Unknown config name: assume it's a file name then.
       config = _CreateConfigParserFromConfigFile(style_config)
-  return _CreateStyleFromConfigParser(config)
+  return Style(_CreateStyleFromConfigParser(config))
 
 
 def _CreateConfigParserFromConfigDict(config_dict):
@@ -560,8 +720,14 @@ LOCAL_STYLE = '.style.yapf'
 # specified in the '[yapf]' section.
 SETUP_CONFIG = 'setup.cfg'
 
-# TODO(eliben): For now we're preserving the global presence of a style dict.
-# Refactor this so that the style is passed around through yapf rather than
-# being global.
+
+class _ThreadStyle(threading.local):
+  """The style a thread is formatting with, or None to use the global style."""
+  style = None
+
+
+_thread_style = _ThreadStyle()
+
+# The global style, used when a thread isn't formatting with a style of its own.
 _style = None
 SetGlobalStyle(_GLOBAL_STYLE_FACTORY())
@@ -19,6 +19,7 @@ identifier. For instance, it can specify if a node in the tree is part of a
 subscript.
 
   AssignSubtypes(): the main function exported by this module.
+  SubtypeAssigner: the pass that AssignSubtypes() runs.
 
 Annotations:
   subtype: The subtype of a pytree token. See 'format_token' module for a list
@@ -41,8 +42,7 @@ def AssignSubtypes(tree):
   Arguments:
     tree: the top-level pytree node to annotate with subtypes.
   """
-  subtype_assigner = _SubtypeAssigner()
-  subtype_assigner.Visit(tree)
+  pytree_visitor.RunPasses(tree, [SubtypeAssigner()])
 
 
 # Map tokens in argument lists to their respective subtype.
@@ -54,19 +54,22 @@ _ARGLIST_TOKEN_TO_SUBTYPE = {
 }
 
 
-class _SubtypeAssigner(pytree_visitor.PyTreeVisitor):
-  """_SubtypeAssigner - see file-level docstring for detailed description.
+class SubtypeAssigner(pytree_visitor.PyTreePass):
+  """SubtypeAssigner - see file-level docstring for detailed description.
 
   The subtype is added as an annotation to the pytree token.
   """
 
-  def Visit_dictsetmaker(self, node):  # pylint: disable=invalid-name
+  NAME = 'subtype_assigner'
+  # Comments can be spliced into nodes that were left already, and the pseudo
+  # parentheses around dictionary values take the comments in them into
+  # account.
+  RUNS_AFTER_WALK = ('comment_splicer',)
+
+  def Leave_dictsetmaker(self, node):  # pylint: disable=invalid-name
     # dictsetmaker ::= (test ':' test (comp_for |
     #                                   (',' test ':' test)* [','])) |
     #                  (test (comp_for | (',' test)* [',']))
-    for child in node.children:
-      self.Visit(child)
-
     comp_for = False
     dict_maker = False
 
@@ -106,40 +109,35 @@ class _SubtypeAssigner(pytree_visitor.PyTreeVisitor):
         elif last_was_colon:
           unpacking = False
 
-  def Visit_expr_stmt(self, node):  # pylint: disable=invalid-name
+  def Leave_expr_stmt(self, node):  # pylint: disable=invalid-name
     # expr_stmt ::= testlist_star_expr (augassign (yield_expr|testlist)
     #               | ('=' (yield_expr|testlist_star_expr))*)
     for child in node.children:
-      self.Visit(child)
       if isinstance(child, pytree.Leaf) and child.value == '=':
         _AppendTokenSubtype(child, format_token.Subtype.ASSIGN_OPERATOR)
 
-  def Visit_or_test(self, node):  # pylint: disable=invalid-name
+  def Leave_or_test(self, node):  # pylint: disable=invalid-name
     # or_test ::= and_test ('or' and_test)*
     for child in node.children:
-      self.Visit(child)
       if isinstance(child, pytree.Leaf) and child.value == 'or':
         _AppendTokenSubtype(child, format_token.Subtype.BINARY_OPERATOR)
 
-  def Visit_and_test(self, node):  # pylint: disable=invalid-name
+  def Leave_and_test(self, node):  # pylint: disable=invalid-name
     # and_test ::= not_test ('and' not_test)*
     for child in node.children:
-      self.Visit(child)
       if isinstance(child, pytree.Leaf) and child.value == 'and':
         _AppendTokenSubtype(child, format_token.Subtype.BINARY_OPERATOR)
 
-  def Visit_not_test(self, node):  # pylint: disable=invalid-name
+  def Leave_not_test(self, node):  # pylint: disable=invalid-name
     # not_test ::= 'not' not_test | comparison
     for child in node.children:
-      self.Visit(child)
       if isinstance(child, pytree.Leaf) and child.value == 'not':
         _AppendTokenSubtype(child, format_token.Subtype.UNARY_OPERATOR)
 
-  def Visit_comparison(self, node):  # pylint: disable=invalid-name
+  def Leave_comparison(self, node):  # pylint: disable=invalid-name
     # comparison ::= expr (comp_op expr)*
     # comp_op ::= '<'|'>'|'=='|'>='|'<='|'<>'|'!='|'in'|'not in'|'is'|'is not'
     for child in node.children:
-      self.Visit(child)
       if (isinstance(child, pytree.Leaf) and
           child.value in {'<', '>', '==', '>=', '<=', '<>', '!=', 'in', 'is'}):
         _AppendTokenSubtype(child, format_token.Subtype.BINARY_OPERATOR)
@@ -147,135 +145,120 @@ class _SubtypeAssigner(pytree_visitor.PyTreeVisitor):
         for grandchild in child.children:
           _AppendTokenSubtype(grandchild, format_token.Subtype.BINARY_OPERATOR)
 
-  def Visit_star_expr(self, node):  # pylint: disable=invalid-name
+  def Leave_star_expr(self, node):  # pylint: disable=invalid-name
     # star_expr ::= '*' expr
     for child in node.children:
-      self.Visit(child)
       if isinstance(child, pytree.Leaf) and child.value == '*':
         _AppendTokenSubtype(child, format_token.Subtype.UNARY_OPERATOR)
         _AppendTokenSubtype(child, format_token.Subtype.VARARGS_STAR)
 
-  def Visit_expr(self, node):  # pylint: disable=invalid-name
+  def Leave_expr(self, node):  # pylint: disable=invalid-name
     # expr ::= xor_expr ('|' xor_expr)*
     for child in node.children:
-      self.Visit(child)
       if isinstance(child, pytree.Leaf) and child.value == '|':
         _AppendTokenSubtype(child, format_token.Subtype.BINARY_OPERATOR)
 
-  def Visit_xor_expr(self, node):  # pylint: disable=invalid-name
+  def Leave_xor_expr(self, node):  # pylint: disable=invalid-name
     # xor_expr ::= and_expr ('^' and_expr)*
     for child in node.children:
-      self.Visit(child)
       if isinstance(child, pytree.Leaf) and child.value == '^':
         _AppendTokenSubtype(child, format_token.Subtype.BINARY_OPERATOR)
 
-  def Visit_and_expr(self, node):  # pylint: disable=invalid-name
+  def Leave_and_expr(self, node):  # pylint: disable=invalid-name
     # and_expr ::= shift_expr ('&' shift_expr)*
     for child in node.children:
-      self.Visit(child)
       if isinstance(child, pytree.Leaf) and child.value == '&':
         _AppendTokenSubtype(child, format_token.Subtype.BINARY_OPERATOR)
 
-  def Visit_shift_expr(self, node):  # pylint: disable=invalid-name
+  def Leave_shift_expr(self, node):  # pylint: disable=invalid-name
     # shift_expr ::= arith_expr (('<<'|'>>') arith_expr)*
     for child in node.children:
-      self.Visit(child)
       if isinstance(child, pytree.Leaf) and child.value in {'<<', '>>'}:
         _AppendTokenSubtype(child, format_token.Subtype.BINARY_OPERATOR)
 
-  def Visit_arith_expr(self, node):  # pylint: disable=invalid-name
+  def Leave_arith_expr(self, node):  # pylint: disable=invalid-name
     # arith_expr ::= term (('+'|'-') term)*
     for child in node.children:
-      self.Visit(child)
       if isinstance(child, pytree.Leaf) and child.value in '+-':
         _AppendTokenSubtype(child, format_token.Subtype.BINARY_OPERATOR)
 
-  def Visit_term(self, node):  # pylint: disable=invalid-name
+  def Leave_term(self, node):  # pylint: disable=invalid-name
     # term ::= factor (('*'|'/'|'%'|'//') factor)*
     for child in node.children:
-      self.Visit(child)
       if (isinstance(child, pytree.Leaf) and
           child.value in {'*', '/', '%', '//'}):
         _AppendTokenSubtype(child, format_token.Subtype.BINARY_OPERATOR)
 
-  def Visit_factor(self, node):  # pylint: disable=invalid-name
+  def Leave_factor(self, node):  # pylint: disable=invalid-name
     # factor ::= ('+'|'-'|'~') factor | power
     for child in node.children:
-      self.Visit(child)
       if isinstance(child, pytree.Leaf) and child.value in '+-~':
         _AppendTokenSubtype(child, format_token.Subtype.UNARY_OPERATOR)
 
-  def Visit_power(self, node):  # pylint: disable=invalid-name
+  def Leave_power(self, node):  # pylint: disable=invalid-name
     # power ::= atom trailer* ['**' factor]
     for child in node.children:
-      self.Visit(child)
       if isinstance(child, pytree.Leaf) and child.value == '**':
         _AppendTokenSubtype(child, format_token.Subtype.BINARY_OPERATOR)
 
-  def Visit_trailer(self, node):  # pylint: disable=invalid-name
+  def Leave_trailer(self, node):  # pylint: disable=invalid-name
     for child in node.children:
-      self.Visit(child)
       if isinstance(child, pytree.Leaf) and child.value in '[]':
         _AppendTokenSubtype(child, format_token.Subtype.SUBSCRIPT_BRACKET)
 
-  def Visit_subscript(self, node):  # pylint: disable=invalid-name
+  def Leave_subscript(self, node):  # pylint: disable=invalid-name
     # subscript ::= test | [test] ':' [test] [sliceop]
     for child in node.children:
-      self.Visit(child)
       if isinstance(child, pytree.Leaf) and child.value == ':':
         _AppendTokenSubtype(child, format_token.Subtype.SUBSCRIPT_COLON)
 
-  def Visit_sliceop(self, node):  # pylint: disable=invalid-name
+  def Leave_sliceop(self, node):  # pylint: disable=invalid-name
     # sliceop ::= ':' [test]
     for child in node.children:
-      self.Visit(child)
       if isinstance(child, pytree.Leaf) and child.value == ':':
         _AppendTokenSubtype(child, format_token.Subtype.SUBSCRIPT_COLON)
 
-  def Visit_argument(self, node):  # pylint: disable=invalid-name
+  def Leave_argument(self, node):  # pylint: disable=invalid-name
     # argument ::=
     #     test [comp_for] | test '=' test
-    self._ProcessArgLists(node)
+    _ProcessArgLists(node)
 
-  def Visit_arglist(self, node):  # pylint: disable=invalid-name
+  def Leave_arglist(self, node):  # pylint: disable=invalid-name
     # arglist ::=
     #     (argument ',')* (argument [',']
     #                     | '*' test (',' argument)* [',' '**' test]
     #                     | '**' test)
-    self._ProcessArgLists(node)
+    _ProcessArgLists(node)
     _SetArgListSubtype(node, format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN,
                        format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN_ARG_LIST)
 
-  def Visit_tname(self, node):  # pylint: disable=invalid-name
-    self._ProcessArgLists(node)
+  def Leave_tname(self, node):  # pylint: disable=invalid-name
+    _ProcessArgLists(node)
     _SetArgListSubtype(node, format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN,
                        format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN_ARG_LIST)
 
-  def Visit_decorator(self, node):  # pylint: disable=invalid-name
+  def Enter_decorator(self, node):  # pylint: disable=invalid-name
     # decorator ::=
     #     '@' dotted_name [ '(' [arglist] ')' ] NEWLINE
     for child in node.children:
       if isinstance(child, pytree.Leaf) and child.value == '@':
         _AppendTokenSubtype(child, subtype=format_token.Subtype.DECORATOR)
-      self.Visit(child)
 
-  def Visit_funcdef(self, node):  # pylint: disable=invalid-name
+  def Enter_funcdef(self, node):  # pylint: disable=invalid-name
     # funcdef ::=
     #     'def' NAME parameters ['->' test] ':' suite
     for child in node.children:
       if pytree_utils.NodeName(child) == 'NAME' and child.value != 'def':
         _AppendTokenSubtype(child, format_token.Subtype.FUNC_DEF)
         break
-    for child in node.children:
-      self.Visit(child)
 
-  def Visit_typedargslist(self, node):  # pylint: disable=invalid-name
+  def Leave_typedargslist(self, node):  # pylint: disable=invalid-name
     # typedargslist ::=
     #     ((tfpdef ['=' test] ',')*
     #          ('*' [tname] (',' tname ['=' test])* [',' '**' tname]
     #           | '**' tname)
     #     | tfpdef ['=' test] (',' tfpdef ['=' test])* [','])
-    self._ProcessArgLists(node)
+    _ProcessArgLists(node)
     _SetArgListSubtype(node, format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN,
                        format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN_ARG_LIST)
     tname = False
@@ -292,43 +275,40 @@ class _SubtypeAssigner(pytree_visitor.PyTreeVisitor):
         _AppendTokenSubtype(child, subtype=format_token.Subtype.TYPED_NAME)
         tname = False
 
-  def Visit_varargslist(self, node):  # pylint: disable=invalid-name
+  def Leave_varargslist(self, node):  # pylint: disable=invalid-name
     # varargslist ::=
     #     ((vfpdef ['=' test] ',')*
     #          ('*' [vname] (',' vname ['=' test])*  [',' '**' vname]
     #           | '**' vname)
     #      | vfpdef ['=' test] (',' vfpdef ['=' test])* [','])
-    self._ProcessArgLists(node)
+    _ProcessArgLists(node)
     for child in node.children:
-      self.Visit(child)
       if isinstance(child, pytree.Leaf) and child.value == '=':
         _AppendTokenSubtype(child, format_token.Subtype.VARARGS_LIST)
 
-  def Visit_comp_for(self, node):  # pylint: disable=invalid-name
+  def Enter_comp_for(self, node):  # pylint: disable=invalid-name
     # comp_for ::= 'for' exprlist 'in' testlist_safe [comp_iter]
     _AppendSubtypeRec(node, format_token.Subtype.COMP_FOR)
     # Mark the previous node as COMP_EXPR unless this is a nested comprehension
     # as these will have the outer comprehension as their previous node.
     attr = pytree_utils.GetNodeAnnotation(node.parent,
-                                          pytree_utils.Annotation.SUBTYPE)
-    if not attr or format_token.Subtype.COMP_FOR not in attr:
+                                          pytree_utils.Annotation.SUBTYPE, 0)
+    if not attr & format_token.Subtype.COMP_FOR:
       _AppendSubtypeRec(node.parent.children[0], format_token.Subtype.COMP_EXPR)
-    self.DefaultNodeVisit(node)
 
-  def Visit_comp_if(self, node):  # pylint: disable=invalid-name
+  def Enter_comp_if(self, node):  # pylint: disable=invalid-name
     # comp_if ::= 'if' old_test [comp_iter]
     _AppendSubtypeRec(node, format_token.Subtype.COMP_IF)
-    self.DefaultNodeVisit(node)
 
-  def _ProcessArgLists(self, node):
-    """Common method for processing argument lists."""
-    for child in node.children:
-      self.Visit(child)
-      if isinstance(child, pytree.Leaf):
-        _AppendTokenSubtype(
-            child,
-            subtype=_ARGLIST_TOKEN_TO_SUBTYPE.get(child.value,
-                                                  format_token.Subtype.NONE))
+
+def _ProcessArgLists(node):
+  """Process the argument lists below the node."""
+  for child in node.children:
+    if isinstance(child, pytree.Leaf):
+      _AppendTokenSubtype(
+          child,
+          subtype=_ARGLIST_TOKEN_TO_SUBTYPE.get(child.value,
+                                                format_token.Subtype.NONE))
 
 
 def _SetArgListSubtype(node, node_subtype, list_subtype):
@@ -336,16 +316,20 @@ def _SetArgListSubtype(node, node_subtype, list_subtype):
 
   def HasSubtype(node):
     """Return True if the arg list has a named assign subtype."""
-    if isinstance(node, pytree.Leaf):
-      if node_subtype in pytree_utils.GetNodeAnnotation(
-          node, pytree_utils.Annotation.SUBTYPE, set()):
-        return True
-      return False
-    has_subtype = False
-    for child in node.children:
-      if pytree_utils.NodeName(child) != 'arglist':
-        has_subtype |= HasSubtype(child)
-    return has_subtype
+    # Look for the subtype on the leaves, skipping the nested arg lists.
+    stack = [node]
+    while stack:
+      node = stack.pop()
+      if isinstance(node, pytree.Leaf):
+        subtypes = pytree_utils.GetNodeAnnotation(
+            node, pytree_utils.Annotation.SUBTYPE, 0)
+        if subtypes & node_subtype:
+          return True
+      else:
+        stack.extend(
+            child for child in node.children
+            if pytree_utils.NodeName(child) != 'arglist')
+    return False
 
   if HasSubtype(node):
     for child in node.children:
@@ -355,25 +339,18 @@ def _SetArgListSubtype(node, node_subtype, list_subtype):
 
 def _AppendTokenSubtype(node, subtype):
   """Append the token's subtype only if it's not already set."""
-  pytree_utils.AppendNodeAnnotation(node, pytree_utils.Annotation.SUBTYPE,
-                                    subtype)
+  pytree_utils.AppendSubtypeAnnotation(node, subtype)
 
 
 def _AppendFirstLeafTokenSubtype(node, subtype):
   """Append the first leaf token's subtypes."""
-  if isinstance(node, pytree.Leaf):
-    _AppendTokenSubtype(node, subtype)
-    return
-  _AppendFirstLeafTokenSubtype(node.children[0], subtype)
+  _AppendTokenSubtype(_GetFirstLeafNode(node), subtype)
 
 
 def _AppendSubtypeRec(node, subtype, force=True):
   """Append the leafs in the node to the given subtype."""
-  if isinstance(node, pytree.Leaf):
-    _AppendTokenSubtype(node, subtype)
-    return
-  for child in node.children:
-    _AppendSubtypeRec(child, subtype, force=force)
+  for leaf in pytree_utils.IterLeaves(node):
+    _AppendTokenSubtype(leaf, subtype)
 
 
 def _InsertPseudoParentheses(node):
@@ -429,12 +406,12 @@ def _InsertPseudoParentheses(node):
 
 
 def _GetFirstLeafNode(node):
-  if isinstance(node, pytree.Leaf):
-    return node
-  return _GetFirstLeafNode(node.children[0])
+  while not isinstance(node, pytree.Leaf):
+    node = node.children[0]
+  return node
 
 
 def _GetLastLeafNode(node):
-  if isinstance(node, pytree.Leaf):
-    return node
-  return _GetLastLeafNode(node.children[-1])
+  while not isinstance(node, pytree.Leaf):
+    node = node.children[-1]
+  return node
@@ -0,0 +1,114 @@
+# Copyright 2026 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""On-disk cache of annotated pytrees.
+
+Parsing the code and running the passes that don't depend on the style (the
+comment splicer, the continuation splicer and the subtype assigner) yields the
+same tree every time the same code is formatted. This module stores those trees
+in a directory, so that formatting the code again can start from the stored
+tree.
+
+An entry is keyed by a hash of the code, the versions of yapf and Python, the
+grammar the code was parsed with and the few style settings that the passes
+read. So entries never go stale: changing any of those just misses the cache.
+Entries are pickled, so the directory must only be writable by trusted users.
+
+  Load(): return the tree stored for some code, or None.
+  Store(): store the tree for some code.
+"""
+
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+import zlib
+
+from yapf.yapflib import style
+
+# The style settings the cached passes depend on.
+_STYLE_SETTINGS = ('INDENT_DICTIONARY_VALUE',)
+
+_SUFFIX = '.tree'
+
+# The version of the format of the entries. Bump it whenever what's stored on
+# the tree's nodes changes.
+_FORMAT_VERSION = 4
+
+
+def Load(cache_dir, code, target_version=None):
+  """Return the tree stored for the code, or None if there isn't one.
+
+  Arguments:
+    cache_dir: (unicode) The directory of the cache.
+    code: (unicode) The code.
+    target_version: (string) The target_version the code is parsed with. See
+      pytree_utils.ParseCodeToTree().
+
+  Returns:
+    The root node of the annotated tree, or None. An unreadable entry counts as
+    a miss.
+  """
+  try:
+    with open(_EntryPath(cache_dir, code, target_version), 'rb') as fd:
+      return pickle.loads(zlib.decompress(fd.read()))
+  except Exception:  # pylint: disable=broad-except
+    return None
+
+
+def Store(cache_dir, code, tree, target_version=None):
+  """Store the tree for the code.
+
+  The entry is written to a temporary file first and then renamed, so that a
+  concurrent Load() never sees a partial entry. Failures are ignored, since the
+  cache is only an optimization.
+
+  Arguments:
+    cache_dir: (unicode) The directory of the cache. It's created if needed.
+    code: (unicode) The code.
+    tree: (pytree.Node) The root node of the annotated tree.
+    target_version: (string) The target_version the code is parsed with.
+  """
+  try:
+    data = zlib.compress(pickle.dumps(tree, pickle.HIGHEST_PROTOCOL))
+  except (RuntimeError, pickle.PicklingError):
+    # The tree is nested too deeply to be pickled.
+    return
+
+  try:
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    fd, temp_path = tempfile.mkstemp(suffix=_SUFFIX, dir=cache_dir)
+    with os.fdopen(fd, 'wb') as temp_file:
+      temp_file.write(data)
+    path = _EntryPath(cache_dir, code, target_version)
+    if os.path.exists(path):
+      os.remove(temp_path)
+    else:
+      os.rename(temp_path, path)
+  except (IOError, OSError):
+    pass
+
+
+def _EntryPath(cache_dir, code, target_version):
+  """Return the path of the entry of the code in the cache."""
+  import yapf  # pylint: disable=g-import-not-at-top
+
+  settings = [style.Get(name) for name in _STYLE_SETTINGS]
+  key = hashlib.sha256()
+  key.update(
+      repr((_FORMAT_VERSION, yapf.__version__, sys.version_info[:3],
+            target_version, settings)).encode())
+  key.update(code.encode('utf-8'))
+  return os.path.join(cache_dir, key.hexdigest() + _SUFFIX)
@@ -65,11 +65,12 @@ class UnwrappedLine(object):
     self.first.spaces_required_before = 1
     self.first.total_length = len(self.first.value)
 
+    current_style = style.Current()
     prev_token = self.first
     prev_length = self.first.total_length
     for token in self._tokens[1:]:
       if (token.spaces_required_before == 0 and
-          _SpaceRequiredBetween(prev_token, token)):
+          _SpaceRequiredBetween(prev_token, token, current_style)):
         token.spaces_required_before = 1
 
       tok_len = len(token.value) if not token.is_pseudo_paren else 0
@@ -77,7 +78,7 @@ class UnwrappedLine(object):
 
       # The split penalty has to be computed before {must|can}_break_before,
       # because these may use it for their decision.
-      token.split_penalty += _SplitPenalty(prev_token, token)
+      token.split_penalty += _SplitPenalty(prev_token, token, current_style)
       token.must_break_before = _MustBreakBefore(prev_token, token)
       token.can_break_before = (
           token.must_break_before or _CanBreakBefore(prev_token, token))
@@ -103,8 +104,7 @@ class UnwrappedLine(object):
       uwlines.append(uwline)
 
     for uwline in uwlines:
-      pytree_utils.SetNodeAnnotation(uwline.first.node,
-                                     pytree_utils.Annotation.MUST_SPLIT, True)
+      uwline.first.annotations.must_split = True
       uwline.first.previous_token = None
       uwline.last.next_token = None
 
@@ -211,10 +211,10 @@ def _IsIdNumberStringToken(tok):
 
 
 def _IsUnaryOperator(tok):
-  return format_token.Subtype.UNARY_OPERATOR in tok.subtypes
+  return bool(tok.subtypes & format_token.Subtype.UNARY_OPERATOR)
 
 
-def _SpaceRequiredBetween(left, right):
+def _SpaceRequiredBetween(left, right, current_style):
   """Return True if a space is required between the left and right token."""
   lval = left.value
   rval = right.value
@@ -245,7 +245,7 @@ def _SpaceRequiredBetween(left, right):
     return False
   if lval == ',' and rval in ']})':
     # Add a space between ending ',' and closing bracket if requested.
-    return style.Get('SPACE_BETWEEN_ENDING_COMMA_AND_CLOSING_BRACKET')
+    return current_style.SPACE_BETWEEN_ENDING_COMMA_AND_CLOSING_BRACKET
   if lval == ',':
     # We want a space after a comma.
     return True
@@ -262,18 +262,17 @@ def _SpaceRequiredBetween(left, right):
       (left.is_keyword or left.is_name)):
     # Don't merge two keywords/identifiers.
     return True
-  if (format_token.Subtype.SUBSCRIPT_COLON in left.subtypes or
-      format_token.Subtype.SUBSCRIPT_COLON in right.subtypes):
+  if (left.subtypes & format_token.Subtype.SUBSCRIPT_COLON or
+      right.subtypes & format_token.Subtype.SUBSCRIPT_COLON):
     # A subscript shouldn't have spaces separating its colons.
     return False
-  if (format_token.Subtype.TYPED_NAME in left.subtypes or
-      format_token.Subtype.TYPED_NAME in right.subtypes):
+  if (left.subtypes & format_token.Subtype.TYPED_NAME or
+      right.subtypes & format_token.Subtype.TYPED_NAME):
     # A typed argument should have a space after the colon.
     return True
   if left.is_string:
     if (rval == '=' and
-        format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN_ARG_LIST in right.subtypes
-       ):
+        right.subtypes & format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN_ARG_LIST):
       # If there is a type hint, then we don't want to add a space between the
       # equal sign and the hint.
       return False
@@ -293,27 +292,27 @@ def _SpaceRequiredBetween(left, right):
   if left.is_binary_op or right.is_binary_op:
     if lval == '**' or rval == '**':
       # Space around the "power" operator.
-      return style.Get('SPACES_AROUND_POWER_OPERATOR')
+      return current_style.SPACES_AROUND_POWER_OPERATOR
     # Enforce spaces around binary operators except the blacklisted ones.
-    blacklist = style.Get('NO_SPACES_AROUND_SELECTED_BINARY_OPERATORS')
+    blacklist = current_style.NO_SPACES_AROUND_SELECTED_BINARY_OPERATORS
     return lval not in blacklist and rval not in blacklist
   if (_IsUnaryOperator(left) and lval != 'not' and
       (right.is_name or right.is_number or rval == '(')):
     # The previous token was a unary op. No space is desired between it and
     # the current token.
     return False
-  if (format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN in left.subtypes or
-      format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN in right.subtypes):
+  if (left.subtypes & format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN or
+      right.subtypes & format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN):
     # A named argument or default parameter shouldn't have spaces around it.
-    return style.Get('SPACES_AROUND_DEFAULT_OR_NAMED_ASSIGN')
-  if (format_token.Subtype.VARARGS_LIST in left.subtypes or
-      format_token.Subtype.VARARGS_LIST in right.subtypes):
+    return current_style.SPACES_AROUND_DEFAULT_OR_NAMED_ASSIGN
+  if (left.subtypes & format_token.Subtype.VARARGS_LIST or
+      right.subtypes & format_token.Subtype.VARARGS_LIST):
     return False
-  if (format_token.Subtype.VARARGS_STAR in left.subtypes or
-      format_token.Subtype.KWARGS_STAR_STAR in left.subtypes):
+  if left.subtypes & (format_token.Subtype.VARARGS_STAR
+                      | format_token.Subtype.KWARGS_STAR_STAR):
     # Don't add a space after a vararg's star or a keyword's star-star.
     return False
-  if lval == '@' and format_token.Subtype.DECORATOR in left.subtypes:
+  if lval == '@' and left.subtypes & format_token.Subtype.DECORATOR:
     # Decorators shouldn't be separated from the 'at' sign.
     return False
   if left.is_keyword and rval == '.' or lval == '.' and right.is_keyword:
@@ -355,8 +354,8 @@ def _SpaceRequiredBetween(left, right):
     # Don't separate a unary operator from the opening bracket.
     return False
   if (lval in pytree_utils.OPENING_BRACKETS and
-      (format_token.Subtype.VARARGS_STAR in right.subtypes or
-       format_token.Subtype.KWARGS_STAR_STAR in right.subtypes)):
+      right.subtypes & (format_token.Subtype.VARARGS_STAR
+                        | format_token.Subtype.KWARGS_STAR_STAR)):
     # Don't separate a '*' or '**' from the opening bracket.
     return False
   if rval == ';':
@@ -382,8 +381,7 @@ def _MustBreakBefore(prev_token, cur_token):
     # reasonable assumption, because otherwise they should have written them
     # all on the same line, or with a '+'.
     return True
-  return pytree_utils.GetNodeAnnotation(
-      cur_token.node, pytree_utils.Annotation.MUST_SPLIT, default=False)
+  return cur_token.must_split or False
 
 
 def _CanBreakBefore(prev_token, cur_token):
@@ -420,7 +418,7 @@ def _CanBreakBefore(prev_token, cur_token):
   if cur_token.is_comment and prev_token.lineno == cur_token.lineno:
     # Don't break a comment at the end of the line.
     return False
-  if format_token.Subtype.UNARY_OPERATOR in prev_token.subtypes:
+  if prev_token.subtypes & format_token.Subtype.UNARY_OPERATOR:
     # Don't break after a unary token.
     return False
   return True
@@ -462,7 +460,7 @@ _BITWISE_OPERATORS = frozenset({'&', '|', '^'})
 _TERM_OPERATORS = frozenset({'*', '/', '%', '//'})
 
 
-def _SplitPenalty(prev_token, cur_token):
+def _SplitPenalty(prev_token, cur_token, current_style):
   """Return the penalty for breaking the line before the current token."""
   pval = prev_token.value
   cval = cur_token.value
@@ -472,10 +470,10 @@ def _SplitPenalty(prev_token, cur_token):
   if cur_token.node_split_penalty > 0:
     return cur_token.node_split_penalty
 
-  if style.Get('SPLIT_BEFORE_LOGICAL_OPERATOR'):
+  if current_style.SPLIT_BEFORE_LOGICAL_OPERATOR:
     # Prefer to split before 'and' and 'or'.
     if pval in _LOGICAL_OPERATORS:
-      return style.Get('SPLIT_PENALTY_LOGICAL_OPERATOR')
+      return current_style.SPLIT_PENALTY_LOGICAL_OPERATOR
     if cval in _LOGICAL_OPERATORS:
       return 0
   else:
@@ -483,12 +481,12 @@ def _SplitPenalty(prev_token, cur_token):
     if pval in _LOGICAL_OPERATORS:
       return 0
     if cval in _LOGICAL_OPERATORS:
-      return style.Get('SPLIT_PENALTY_LOGICAL_OPERATOR')
+      return current_style.SPLIT_PENALTY_LOGICAL_OPERATOR
 
-  if style.Get('SPLIT_BEFORE_BITWISE_OPERATOR'):
+  if current_style.SPLIT_BEFORE_BITWISE_OPERATOR:
     # Prefer to split before '&', '|', and '^'.
     if pval in _BITWISE_OPERATORS:
-      return style.Get('SPLIT_PENALTY_BITWISE_OPERATOR')
+      return current_style.SPLIT_PENALTY_BITWISE_OPERATOR
     if cval in _BITWISE_OPERATORS:
       return 0
   else:
@@ -496,36 +494,36 @@ def _SplitPenalty(prev_token, cur_token):
     if pval in _BITWISE_OPERATORS:
       return 0
     if cval in _BITWISE_OPERATORS:
-      return style.Get('SPLIT_PENALTY_BITWISE_OPERATOR')
+      return current_style.SPLIT_PENALTY_BITWISE_OPERATOR
 
-  if (format_token.Subtype.COMP_FOR in cur_token.subtypes or
-      format_token.Subtype.COMP_IF in cur_token.subtypes):
+  if cur_token.subtypes & (format_token.Subtype.COMP_FOR
+                           | format_token.Subtype.COMP_IF):
     # We don't mind breaking before the 'for' or 'if' of a list comprehension.
     return 0
-  if format_token.Subtype.UNARY_OPERATOR in prev_token.subtypes:
+  if prev_token.subtypes & format_token.Subtype.UNARY_OPERATOR:
     # Try not to break after a unary operator.
-    return style.Get('SPLIT_PENALTY_AFTER_UNARY_OPERATOR')
+    return current_style.SPLIT_PENALTY_AFTER_UNARY_OPERATOR
   if pval == ',':
     # Breaking after a comma is fine, if need be.
     return 0
   if prev_token.is_binary_op:
     # We would rather not split after an equality operator.
     return 20
-  if (format_token.Subtype.VARARGS_STAR in prev_token.subtypes or
-      format_token.Subtype.KWARGS_STAR_STAR in prev_token.subtypes):
+  if prev_token.subtypes & (format_token.Subtype.VARARGS_STAR
+                            | format_token.Subtype.KWARGS_STAR_STAR):
     # Don't split after a varargs * or kwargs **.
     return split_penalty.UNBREAKABLE
   if prev_token.OpensScope() and cval != '(':
     # Slightly prefer
-    return style.Get('SPLIT_PENALTY_AFTER_OPENING_BRACKET')
+    return current_style.SPLIT_PENALTY_AFTER_OPENING_BRACKET
   if cval == ':':
     # Don't split before a colon.
     return split_penalty.UNBREAKABLE
   if cval == '=':
     # Don't split before an assignment.
     return split_penalty.UNBREAKABLE
-  if (format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN in prev_token.subtypes or
-      format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN in cur_token.subtypes):
+  if (prev_token.subtypes & format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN or
+      cur_token.subtypes & format_token.Subtype.DEFAULT_OR_NAMED_ASSIGN):
     # Don't break before or after an default or named assignment.
     return split_penalty.UNBREAKABLE
   if cval == '==':
@@ -17,6 +17,8 @@ The main APIs that YAPF exposes to drive the reformatting.
 
   FormatFile(): reformat a file.
   FormatCode(): reformat a string of code.
+  FormatCodeConcurrent(): reformat many strings of code on a pool of threads
+    (Python 3 only, or Python 2.7 with the 'futures' backport).
 
 These APIs have some common arguments:
 
@@ -26,17 +28,37 @@ These APIs have some common arguments:
   lines: (list of tuples of integers) A list of tuples of lines, [start, end],
     that we want to format. The lines are 1-based indexed. It can be used by
     third-party code (e.g., IDEs) when reformatting a snippet of code rather
-    than a whole file.
+    than a whole file. Only the top-level statements the lines are in are
+    reformatted. The rest of the code is left as is.
   print_diff: (bool) Instead of returning the reformatted source, return a
     diff that turns the formatted source into reformatter source.
   verify: (bool) True if reformatted code should be verified for syntax.
+  search_beam_width: (int) If not None, overrides the SEARCH_BEAM_WIDTH setting
+    of the style.
+  logger: (function) A function or lambda that takes a string and emits it.
+  collect_line_stats: (bool) If True, the line_stats of the result hold a
+    reformatter.LineStats with the counters of the formatting search for each
+    line that needed one.
+  line_time_limit: (float) If not None, overrides the SEARCH_LINE_TIME_LIMIT
+    setting of the style.
+  file_time_limit: (float) If not None, overrides the SEARCH_FILE_TIME_LIMIT
+    setting of the style.
+  target_version: (string) If not None, one of pytree_utils.TARGET_VERSIONS.
+    The code is parsed with the grammar of that Python version only, instead
+    of the one its tokens suggest.
+  cache_dir: (unicode) If not None, a directory where the parsed and annotated
+    trees of the code are cached (see tree_cache), so that formatting the same
+    code again skips parsing it.
 """
 
+import collections
 import difflib
 import re
 import sys
 
+from lib2to3 import pytree
 from lib2to3.pgen2 import parse
+from lib2to3.pgen2 import token
 
 from yapf.yapflib import blank_line_calculator
 from yapf.yapflib import comment_splicer
@@ -45,10 +67,59 @@ from yapf.yapflib import file_resources
 from yapf.yapflib import py3compat
 from yapf.yapflib import pytree_unwrapper
 from yapf.yapflib import pytree_utils
+from yapf.yapflib import pytree_visitor
 from yapf.yapflib import reformatter
 from yapf.yapflib import split_penalty
 from yapf.yapflib import style
 from yapf.yapflib import subtype_assigner
+from yapf.yapflib import tree_cache
+
+
+class FormatCodeResult(
+    collections.namedtuple('FormatCodeResult',
+                           ['reformatted_source', 'changed'])):
+  """The result of FormatCode().
+
+  It unpacks into (reformatted_source, changed), like a tuple.
+
+  Attributes:
+    reformatted_source: (unicode) The reformatted code, or a diff if print_diff
+      was True.
+    changed: (bool) True if the source changed.
+    line_stats: (list of reformatter.LineStats) The counters of the formatting
+      search for each line that needed one, or None if collect_line_stats was
+      False.
+  """
+
+  def __new__(cls, reformatted_source, changed, line_stats=None):
+    result = super(FormatCodeResult, cls).__new__(cls, reformatted_source,
+                                                  changed)
+    result.line_stats = line_stats
+    return result
+
+
+class FormatFileResult(
+    collections.namedtuple('FormatFileResult',
+                           ['reformatted_source', 'encoding', 'changed'])):
+  """The result of FormatFile().
+
+  It unpacks into (reformatted_source, encoding, changed), like a tuple.
+
+  Attributes:
+    reformatted_source: (unicode) The reformatted code, a diff if print_diff
+      was True, or None if the file was written to (in_place was True).
+    encoding: (unicode) The encoding of the file.
+    changed: (bool) True if the source changed.
+    line_stats: (list of reformatter.LineStats) The counters of the formatting
+      search for each line that needed one, or None if collect_line_stats was
+      False.
+  """
+
+  def __new__(cls, reformatted_source, encoding, changed, line_stats=None):
+    result = super(FormatFileResult, cls).__new__(cls, reformatted_source,
+                                                  encoding, changed)
+    result.line_stats = line_stats
+    return result
 
 
 def FormatFile(filename,
@@ -57,19 +128,24 @@ def FormatFile(filename,
                print_diff=False,
                verify=False,
                in_place=False,
-               logger=None):
+               search_beam_width=None,
+               logger=None,
+               collect_line_stats=False,
+               line_time_limit=None,
+               file_time_limit=None,
+               target_version=None,
+               cache_dir=None):
   """Format a single Python file and return the formatted code.
 
   Arguments:
     filename: (unicode) The file to reformat.
     in_place: (bool) If True, write the reformatted code back to the file.
-    logger: (io streamer) A stream to output logging.
     remaining arguments: see comment at the top of this module.
 
   Returns:
-    Tuple of (reformatted_code, encoding, changed). reformatted_code is None if
-    the file is successfully written to (having used in_place). reformatted_code
-    is a diff if print_diff is True.
+    A FormatFileResult: (reformatted_code, encoding, changed). reformatted_code
+    is None if the file is successfully written to (having used in_place).
+    reformatted_code is a diff if print_diff is True.
 
   Raises:
     IOError: raised if there was an error reading the file.
@@ -81,13 +157,21 @@ def FormatFile(filename,
     raise ValueError('Cannot pass both in_place and print_diff.')
 
   original_source, newline, encoding = ReadFile(filename, logger)
-  reformatted_source, changed = FormatCode(
+  result = FormatCode(
       original_source,
       style_config=style_config,
       filename=filename,
       lines=lines,
       print_diff=print_diff,
-      verify=verify)
+      verify=verify,
+      search_beam_width=search_beam_width,
+      logger=logger,
+      collect_line_stats=collect_line_stats,
+      line_time_limit=line_time_limit,
+      file_time_limit=file_time_limit,
+      target_version=target_version,
+      cache_dir=cache_dir)
+  reformatted_source, changed = result
   if reformatted_source.rstrip('\n'):
     lines = reformatted_source.rstrip('\n').split('\n')
     reformatted_source = newline.join(line for line in lines) + newline
@@ -95,9 +179,10 @@ def FormatFile(filename,
     if original_source and original_source != reformatted_source:
       file_resources.WriteReformattedCode(filename, reformatted_source,
                                           encoding, in_place)
-    return None, encoding, changed
+    return FormatFileResult(None, encoding, changed, result.line_stats)
 
-  return reformatted_source, encoding, changed
+  return FormatFileResult(reformatted_source, encoding, changed,
+                          result.line_stats)
 
 
 def FormatCode(unformatted_source,
@@ -105,7 +190,14 @@ def FormatCode(unformatted_source,
                style_config=None,
                lines=None,
                print_diff=False,
-               verify=False):
+               verify=False,
+               search_beam_width=None,
+               logger=None,
+               collect_line_stats=False,
+               line_time_limit=None,
+               file_time_limit=None,
+               target_version=None,
+               cache_dir=None):
   """Format a string of Python code.
 
   This provides an alternative entry point to YAPF.
@@ -116,34 +208,136 @@ def FormatCode(unformatted_source,
     remaining arguments: see comment at the top of this module.
 
   Returns:
-    Tuple of (reformatted_source, changed). reformatted_source conforms to the
-    desired formatting style. changed is True if the source changed.
+    A FormatCodeResult: (reformatted_source, changed). reformatted_source
+    conforms to the desired formatting style. changed is True if the source
+    changed.
   """
   _CheckPythonVersion()
-  style.SetGlobalStyle(style.CreateStyleFromConfig(style_config))
-  if not unformatted_source.endswith('\n'):
-    unformatted_source += '\n'
+  style_config = style.CreateStyleFromConfig(style_config)
+  overrides = {}
+  if search_beam_width is not None:
+    overrides['SEARCH_BEAM_WIDTH'] = search_beam_width
+  if line_time_limit is not None:
+    overrides['SEARCH_LINE_TIME_LIMIT'] = line_time_limit
+  if file_time_limit is not None:
+    overrides['SEARCH_FILE_TIME_LIMIT'] = file_time_limit
+  if overrides:
+    style_config = style.Style(dict(style_config.AsDict(), **overrides))
+  line_stats = [] if collect_line_stats else None
+  with style.UseStyle(style_config):
+    reformatted_source, changed = _FormatCode(
+        unformatted_source, filename, lines, print_diff, verify, logger,
+        line_stats, target_version, cache_dir)
+  return FormatCodeResult(reformatted_source, changed, line_stats)
+
+
+def FormatCodeConcurrent(unformatted_sources,
+                         filenames=None,
+                         style_config=None,
+                         lines=None,
+                         print_diff=False,
+                         verify=False,
+                         search_beam_width=None,
+                         logger=None,
+                         collect_line_stats=False,
+                         max_workers=None,
+                         line_time_limit=None,
+                         file_time_limit=None,
+                         target_version=None,
+                         cache_dir=None):
+  """Format strings of Python code on a pool of threads.
+
+  Each thread formats with its own copy of the style, so this is safe to call
+  while other threads are formatting with FormatCode().
+
+  This needs the concurrent.futures module, which Python 2.7 only has with the
+  'futures' backport installed.
 
-  try:
-    tree = pytree_utils.ParseCodeToTree(unformatted_source)
-  except parse.ParseError as e:
-    raise parse.ParseError(filename + ': ' + e.message)
+  Arguments:
+    unformatted_sources: (list of unicode) The code to format.
+    filenames: (list of unicode) The names of the files being reformatted, in
+      the same order as the sources. Defaults to '<unknown>' for each.
+    lines: (list) The line ranges to format in each source (see the comment at
+      the top of this module), in the same order as the sources. Defaults to
+      None for each, which formats all of the lines.
+    max_workers: (int) The number of threads. Defaults to the number of CPUs.
+    remaining arguments: see comment at the top of this module.
 
-  # Run passes on the tree, modifying it in place.
-  comment_splicer.SpliceComments(tree)
-  continuation_splicer.SpliceContinuations(tree)
-  subtype_assigner.AssignSubtypes(tree)
-  split_penalty.ComputeSplitPenalties(tree)
-  blank_line_calculator.CalculateBlankLines(tree)
+  Returns:
+    A list of FormatCodeResults in the order of the sources, as returned by
+    FormatCode().
 
-  uwlines = pytree_unwrapper.UnwrapPyTree(tree)
-  for uwl in uwlines:
-    uwl.CalculateFormattingInformation()
+  Raises:
+    RuntimeError: if the concurrent.futures module isn't available.
+    The first exception raised while formatting any of the sources.
+  """
+  import multiprocessing  # pylint: disable=g-import-not-at-top
+  try:
+    import concurrent.futures  # pylint: disable=g-import-not-at-top
+  except ImportError:
+    raise RuntimeError('FormatCodeConcurrent needs the concurrent.futures '
+                       "module; on Python 2.7, install the 'futures' package")
+
+  # Read the style configuration only once, in this thread.
+  style_config = style.CreateStyleFromConfig(style_config)
+  if filenames is None:
+    filenames = ['<unknown>'] * len(unformatted_sources)
+  if lines is None:
+    lines = [None] * len(unformatted_sources)
+
+  def Format(source_filename_and_lines):
+    source, filename, source_lines = source_filename_and_lines
+    return FormatCode(
+        source,
+        filename=filename,
+        style_config=style_config,
+        lines=source_lines,
+        print_diff=print_diff,
+        verify=verify,
+        search_beam_width=search_beam_width,
+        logger=logger,
+        collect_line_stats=collect_line_stats,
+        line_time_limit=line_time_limit,
+        file_time_limit=file_time_limit,
+        target_version=target_version,
+        cache_dir=cache_dir)
+
+  workers = max_workers or multiprocessing.cpu_count()
+  with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+    return list(
+        executor.map(Format, zip(unformatted_sources, filenames, lines)))
+
+
+def _FormatCode(unformatted_source, filename, lines, print_diff, verify, logger,
+                line_stats, target_version, cache_dir):
+  """Format a string of Python code with the style in effect."""
+  if not unformatted_source.endswith('\n'):
+    unformatted_source += '\n'
+
+  if logger:
+    line_logger = lambda msg: logger('{0}: {1}'.format(filename, msg))
+  else:
+    line_logger = None
 
   lines = _LineRangesToSet(lines)
-  _MarkLinesToFormat(uwlines, lines)
-  reformatted_source = reformatter.Reformat(
-      _SplitSemicolons(uwlines), verify, lines)
+  # Disabled regions may span statements, and the statements outside the
+  # ranges can't be copied through if their line endings are to be changed, so
+  # those are formatted as a whole.
+  if (lines and '\r' not in unformatted_source and
+      not _DISABLE_COMMENT.search(unformatted_source)):
+    reformatted_source = _FormatLineRanges(unformatted_source, filename, lines,
+                                           verify, line_logger, line_stats,
+                                           target_version)
+  else:
+    tree = None
+    if cache_dir:
+      tree = tree_cache.Load(cache_dir, unformatted_source, target_version)
+    if tree is None:
+      tree = _ParseCode(unformatted_source, filename, target_version)
+      _RunStyleIndependentPasses(tree)
+      if cache_dir:
+        tree_cache.Store(cache_dir, unformatted_source, tree, target_version)
+    reformatted_source = _Reformat(tree, lines, verify, line_logger, line_stats)
 
   if unformatted_source == reformatted_source:
     return '' if print_diff else reformatted_source, False
@@ -157,6 +351,129 @@ def FormatCode(unformatted_source,
   return reformatted_source, True
 
 
+def _ParseCode(unformatted_source, filename, target_version):
+  try:
+    return pytree_utils.ParseCodeToTree(unformatted_source, target_version)
+  except parse.ParseError as e:
+    raise parse.ParseError(filename + ': ' + e.message)
+
+
+def _RunStyleIndependentPasses(tree):
+  # Run passes on the tree, modifying it in place.
+  pytree_visitor.RunPasses(tree, [
+      comment_splicer.CommentSplicer(),
+      continuation_splicer.ContinuationSplicer(),
+      subtype_assigner.SubtypeAssigner(),
+  ])
+
+
+def _Reformat(tree, lines, verify, logger, line_stats):
+  """Run the remaining passes on the tree and reformat its lines."""
+  unwrapper = pytree_unwrapper.PyTreeUnwrapper()
+  pytree_visitor.RunPasses(tree, [
+      split_penalty.SplitPenaltyAssigner(),
+      blank_line_calculator.BlankLineCalculator(),
+      unwrapper,
+  ])
+
+  uwlines = unwrapper.GetUnwrappedLines()
+  for uwl in uwlines:
+    uwl.CalculateFormattingInformation()
+
+  _MarkLinesToFormat(uwlines, lines)
+  return reformatter.Reformat(
+      _SplitSemicolons(uwlines),
+      verify,
+      lines,
+      logger=logger,
+      line_stats=line_stats)
+
+
+def _FormatLineRanges(unformatted_source, filename, lines, verify, logger,
+                      line_stats, target_version):
+  """Format only the top-level statements that the lines are in.
+
+  The statements that the lines are in are detached from the parsed tree, along
+  with the statements before and after them, which decide the blank lines
+  around them. Only those go through the passes and the reformatter, and only
+  the lines of the statements in the ranges and the blank lines around them are
+  taken from its output. The rest of the source is copied through as is.
+
+  Arguments:
+    unformatted_source: (unicode) The code to format. It ends in a newline.
+    filename: (unicode) The name of the file being reformatted.
+    lines: (set of int) The lines to format.
+    verify: (bool) True if reformatted code should be verified for syntax.
+    logger: (function) A function or lambda that takes a string and emits it.
+    line_stats: (list) If not None, the reformatter's LineStats are appended.
+    target_version: (string) See pytree_utils.ParseCodeToTree().
+
+  Returns:
+    The reformatted source.
+  """
+  tree = _ParseCode(unformatted_source, filename, target_version)
+  statements = tree.children
+  # The first line of each statement, including the comments before it and the
+  # blank lines around it, and the line after the last statement.
+  starts = [1]
+  for stmt in statements:
+    starts.append(starts[-1] + str(stmt).count('\n'))
+
+  selected = []
+  for index in py3compat.range(len(statements)):
+    if any(starts[index] <= line < starts[index + 1] for line in lines):
+      selected.append(index)
+  if not selected:
+    return unformatted_source
+  first = max(selected[0] - 1, 0)
+  last = min(selected[-1] + 1, len(statements) - 1)
+
+  source_lines = unformatted_source.split('\n')
+  prefix = []
+  suffix = ['']
+  num_leading_lines = num_trailing_lines = 0
+  if first < selected[0]:
+    # The statement before the ones in the ranges isn't output, and so its own
+    # leading blank lines and comments are left out.
+    statements[first].prefix = ''
+    start, end = _NonBlankLines(source_lines, statements[first].get_lineno(),
+                                starts[first + 1])
+    prefix = source_lines[:end]
+    num_leading_lines = end - start + 1
+  if last > selected[-1]:
+    content = _NonBlankLines(source_lines, starts[last], starts[last + 1])
+    if content:
+      start, end = content
+      suffix = source_lines[start - 1:]
+      num_trailing_lines = end - start + 1
+
+  chunk = statements[first:last + 1]
+  for stmt in chunk:
+    stmt.remove()
+  if chunk[-1].type != token.ENDMARKER:
+    chunk.append(pytree.Leaf(token.ENDMARKER, ''))
+  chunk_tree = pytree.Node(tree.type, chunk)
+
+  _RunStyleIndependentPasses(chunk_tree)
+  formatted_chunk = _Reformat(chunk_tree, lines, verify, logger, line_stats)
+
+  formatted_lines = formatted_chunk.split('\n')[:-1]
+  stop = len(formatted_lines) - num_trailing_lines
+  formatted_lines = formatted_lines[num_leading_lines:stop]
+  return '\n'.join(prefix + formatted_lines + suffix)
+
+
+def _NonBlankLines(source_lines, start, end):
+  """Return the first and last non-blank lines in [start, end), or None."""
+  content = [
+      lineno for lineno in py3compat.range(start, end)
+      if source_lines[lineno - 1].strip()
+  ]
+  if not content:
+    return None
+  return content[0], content[-1]
+
+
 def _CheckPythonVersion():  # pragma: no cover
   errmsg = 'yapf is only supported for Python 2.7 or 3.4+'
   if sys.version_info[0] == 2:
@@ -211,6 +528,9 @@ def _SplitSemicolons(uwlines):
 DISABLE_PATTERN = r'^#.*\byapf:\s*disable\b'
 ENABLE_PATTERN = r'^#.*\byapf:\s*enable\b'
 
+# Any comment that may disable formatting. See _MarkLinesToFormat().
+_DISABLE_COMMENT = re.compile(r'#.*\byapf:\s*disable\b', re.IGNORECASE)
+
 
 def _LineRangesToSet(line_ranges):
   """Return a set of lines in the range."""
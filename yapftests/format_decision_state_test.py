@@ -132,6 +132,60 @@ class FormatDecisionStateTest(yapf_test_helper.YAPFTest):
     clone = state.Clone()
     self.assertEqual(repr(state), repr(clone))
 
+  def testCloneSharesStackFrames(self):
+    code = textwrap.dedent(r"""
+      def f(a, b):
+        pass
+      """)
+    uwlines = yapf_test_helper.ParseAndUnwrap(code)
+    uwline = unwrapped_line.UnwrappedLine(0, _FilterLine(uwlines[0]))
+    uwline.CalculateFormattingInformation()
+
+    state = format_decision_state.FormatDecisionState(uwline, 0)
+    state.MoveStateToNextToken()
+    state.AddTokenToState(False, True)  # Add: 'f'
+    state.AddTokenToState(False, True)  # Add: '('
+    self.assertEqual('a', state.next_token.value)
+
+    clone = state.Clone()
+    self.assertIs(state.stack, clone.stack)
+    self.assertEqual(state, clone)
+    self.assertEqual(hash(state), hash(clone))
+
+    # Modifying the clone must leave the original state untouched, but still
+    # share the frames below the top of the stack.
+    original_stack = repr(state)
+    clone.AddTokenToState(True, True)  # Add: 'a'
+    self.assertEqual(original_stack, repr(state))
+    self.assertIsNot(state.stack, clone.stack)
+    self.assertIsNot(state.stack.top, clone.stack.top)
+    self.assertIs(state.stack.below, clone.stack.below)
+    self.assertNotEqual(state, clone)
+
+  def testSplitTableIsSharedByClones(self):
+    code = textwrap.dedent(r"""
+      a = [bbbbbbbbbbbbbbbbbbbb, cccccccccccccccccccc]
+      """)
+    uwlines = yapf_test_helper.ParseAndUnwrap(code)
+    uwline = unwrapped_line.UnwrappedLine(0, _FilterLine(uwlines[0]))
+    uwline.CalculateFormattingInformation()
+
+    state = format_decision_state.FormatDecisionState(uwline, 0)
+    state.MoveStateToNextToken()
+    state.AddTokenToState(False, True)  # Add: '='
+    state.AddTokenToState(False, True)  # Add: '['
+    self.assertEqual('bbbbbbbbbbbbbbbbbbbb', state.next_token.value)
+
+    clone = state.Clone()
+    self.assertIs(state.split_table, clone.split_table)
+
+    # Whether the list must be split after the '[' still depends on where the
+    # list starts.
+    self.assertFalse(state.MustSplit())
+    clone.column = 40
+    self.assertTrue(clone.MustSplit())
+    self.assertFalse(state.MustSplit())
+
 
 def _FilterLine(uwline):
   """Filter out nonsemantic tokens from the UnwrappedLines."""
@@ -286,6 +286,17 @@ class PytreeUnwrapperTest(yapf_test_helper.YAPFTest):
         'a', '=', '[', "'a'", ',', "'b'", ',', "'c'", ',', '# hello world', ']'
     ])])
 
+  def testContinuationMarkers(self):
+    code = textwrap.dedent(r"""
+      x = (1 + \
+           2 + \
+           3)
+      """)
+    uwlines = yapf_test_helper.ParseAndUnwrap(code)
+    self._CheckUnwrappedLines(uwlines, [
+        (0, ['x', '=', '(', '1', '+', ' \\', '2', '+', ' \\', '3', ')']),
+    ])
+
 
 class MatchBracketsTest(yapf_test_helper.YAPFTest):
 
@@ -351,6 +362,27 @@ class MatchBracketsTest(yapf_test_helper.YAPFTest):
         [],
     ])
 
+  def testBracketScopes(self):
+    code = textwrap.dedent("""\
+        x = f(a, (b,), {c: [d, e]},  # comment
+              g)
+        """)
+    uwlines = yapf_test_helper.ParseAndUnwrap(code)
+    tokens = dict((tok.value, tok) for tok in uwlines[0].tokens)
+
+    call = tokens['f'].next_token.bracket_scope
+    self.assertEqual(3, call.num_commas)
+    self.assertTrue(call.has_comment)
+    self.assertIs(tokens['{'], call.first_brace)
+
+    single_element_tuple = tokens['b'].previous_token.bracket_scope
+    self.assertEqual(1, single_element_tuple.num_commas)
+    self.assertFalse(single_element_tuple.has_comment)
+    self.assertIsNone(single_element_tuple.first_brace)
+
+    self.assertEqual(1, tokens['['].bracket_scope.num_commas)
+    self.assertIsNone(tokens[']'].bracket_scope)
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -13,12 +13,14 @@
 # limitations under the License.
 """Tests for yapf.pytree_utils."""
 
+import sys
 import unittest
 
 from lib2to3 import pygram
 from lib2to3 import pytree
 from lib2to3.pgen2 import token
 
+from yapf.yapflib import format_token
 from yapf.yapflib import pytree_utils
 
 # More direct access to the symbol->number mapping living within the grammar
@@ -74,6 +76,58 @@ class ParseCodeToTreeTest(unittest.TestCase):
     self.assertEqual(2, len(tree.children))
     self.assertEqual('classdef', pytree_utils.NodeName(tree.children[0]))
 
+  def testGrammarIsPickedFromTokens(self):
+    tree = pytree_utils.ParseCodeToTree('print x\n')
+    self.assertEqual('print_stmt',
+                     pytree_utils.NodeName(tree.children[0].children[0]))
+
+    # 'print >>f, x' is also a valid Python 3 expression, which is preferred.
+    tree = pytree_utils.ParseCodeToTree('print >>f, x\n')
+    self.assertEqual('testlist_star_expr',
+                     pytree_utils.NodeName(tree.children[0].children[0]))
+
+  def testTargetVersion(self):
+    tree = pytree_utils.ParseCodeToTree('exec(code)\n', target_version='py2')
+    self.assertEqual('exec_stmt',
+                     pytree_utils.NodeName(tree.children[0].children[0]))
+    tree = pytree_utils.ParseCodeToTree('exec(code)\n', target_version='py3')
+    self.assertEqual('power',
+                     pytree_utils.NodeName(tree.children[0].children[0]))
+
+    with self.assertRaises(SyntaxError):
+      pytree_utils.ParseCodeToTree('print x\n', target_version='py3')
+    with self.assertRaises(ValueError):
+      pytree_utils.ParseCodeToTree('x = 1\n', target_version='py1')
+
+  def testDriversAreReused(self):
+    pytree_utils.ParseCodeToTree('print "hello world"\n')
+    py3_driver = pytree_utils._DRIVERS[pytree_utils._PY3]
+    py2_driver = pytree_utils._DRIVERS[pytree_utils._PY2]
+    pytree_utils.ParseCodeToTree('print "hello world"\n')
+    self.assertIs(py3_driver, pytree_utils._DRIVERS[pytree_utils._PY3])
+    self.assertIs(py2_driver, pytree_utils._DRIVERS[pytree_utils._PY2])
+    self.assertNotIn('exec', py3_driver.grammar.keywords)
+    self.assertNotIn('nonlocal', py2_driver.grammar.keywords)
+
+
+class IterLeavesTest(unittest.TestCase):
+
+  def testIterLeaves(self):
+    tree = pytree_utils.ParseCodeToTree('foo = bar(1, baz)\n')
+    self.assertEqual([leaf.value for leaf in tree.leaves()],
+                     [leaf.value for leaf in pytree_utils.IterLeaves(tree)])
+
+  def testIterLeavesOfLeaf(self):
+    leaf = pytree.Leaf(token.NAME, 'foo')
+    self.assertEqual([leaf], list(pytree_utils.IterLeaves(leaf)))
+
+  def testIterLeavesOfDeepTree(self):
+    depth = sys.getrecursionlimit()
+    tree = pytree_utils.ParseCodeToTree('x = ' + '-' * depth + '1\n')
+    leaves = list(pytree_utils.IterLeaves(tree))
+    self.assertEqual(depth + 5, len(leaves))
+    self.assertEqual('1', leaves[-3].value)
+
 
 class InsertNodesBeforeAfterTest(unittest.TestCase):
 
@@ -183,23 +237,45 @@ class AnnotationsTest(unittest.TestCase):
     self.assertEqual(pytree_utils.GetNodeAnnotation(self._leaf, _FOO5), 5)
 
   def testSubtype(self):
-    pytree_utils.AppendNodeAnnotation(self._leaf,
-                                      pytree_utils.Annotation.SUBTYPE, _FOO)
+    pytree_utils.AppendSubtypeAnnotation(self._leaf,
+                                         format_token.Subtype.COMP_FOR)
+    pytree_utils.AppendSubtypeAnnotation(self._leaf,
+                                         format_token.Subtype.COMP_IF)
 
-    self.assertSetEqual(
+    self.assertEqual(
         pytree_utils.GetNodeAnnotation(self._leaf,
-                                       pytree_utils.Annotation.SUBTYPE), {_FOO})
+                                       pytree_utils.Annotation.SUBTYPE),
+        format_token.Subtype.COMP_FOR | format_token.Subtype.COMP_IF)
 
-    pytree_utils.RemoveSubtypeAnnotation(self._leaf, _FOO)
+    pytree_utils.RemoveSubtypeAnnotation(self._leaf,
+                                         format_token.Subtype.COMP_FOR)
 
-    self.assertSetEqual(
+    self.assertEqual(
         pytree_utils.GetNodeAnnotation(self._leaf,
-                                       pytree_utils.Annotation.SUBTYPE), set())
+                                       pytree_utils.Annotation.SUBTYPE),
+        format_token.Subtype.COMP_IF)
 
   def testSetOnNode(self):
     pytree_utils.SetNodeAnnotation(self._node, _FOO, 20)
     self.assertEqual(pytree_utils.GetNodeAnnotation(self._node, _FOO), 20)
 
+  def testFields(self):
+    annotations = pytree_utils.GetNodeAnnotations(self._leaf)
+    self.assertIs(annotations, pytree_utils.GetNodeAnnotations(self._leaf))
+    self.assertIsNone(annotations.split_penalty)
+    self.assertEqual(
+        7,
+        pytree_utils.GetNodeAnnotation(
+            self._leaf, pytree_utils.Annotation.SPLIT_PENALTY, default=7))
+
+    pytree_utils.SetNodeAnnotation(self._leaf,
+                                   pytree_utils.Annotation.SPLIT_PENALTY, 42)
+    self.assertEqual(42, annotations.split_penalty)
+    annotations.must_split = True
+    self.assertTrue(
+        pytree_utils.GetNodeAnnotation(self._leaf,
+                                       pytree_utils.Annotation.MUST_SPLIT))
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -46,6 +46,32 @@ class _NodeNameCollector(pytree_visitor.PyTreeVisitor):
     self.DefaultLeafVisit(leaf)
 
 
+class _HookRecorder(pytree_visitor.PyTreePass):
+  """A tree pass that records the hooks invoked on expr_stmt nodes and NAMEs.
+
+  Attributes:
+    log: the shared list the hooks are recorded into.
+  """
+
+  def __init__(self, name, log, runs_after=(), runs_after_walk=()):
+    self.NAME = name
+    self.RUNS_AFTER = runs_after
+    self.RUNS_AFTER_WALK = runs_after_walk
+    self.log = log
+
+  def Enter_expr_stmt(self, node):  # pylint: disable=invalid-name
+    self.log.append((self.NAME, 'enter', str(node).strip()))
+
+  def Leave_expr_stmt(self, node):  # pylint: disable=invalid-name
+    self.log.append((self.NAME, 'leave', str(node).strip()))
+
+  def Enter_NAME(self, leaf):  # pylint: disable=invalid-name
+    self.log.append((self.NAME, 'enter', leaf.value))
+
+  def Finish(self):
+    self.log.append((self.NAME, 'finish'))
+
+
 _VISITOR_TEST_SIMPLE_CODE = r"""
 foo = bar
 baz = x
@@ -92,6 +118,25 @@ class PytreeVisitorTest(unittest.TestCase):
     expected_name_node_values = ['if', 'x', 'if', 'y', 'return', 'z']
     self.assertEqual(expected_name_node_values, collector.name_node_values)
 
+  def testSubclassDispatchTable(self):
+
+    class _ExprStmtSkipper(_NodeNameCollector):
+
+      def Visit_expr_stmt(self, node):  # pylint: disable=invalid-name
+        self.all_node_names.append('skipped')
+
+    tree = pytree_utils.ParseCodeToTree(_VISITOR_TEST_SIMPLE_CODE)
+    collector = _ExprStmtSkipper()
+    collector.Visit(tree)
+    expected_names = [
+        'file_input',
+        'simple_stmt', 'skipped', 'NEWLINE',
+        'simple_stmt', 'skipped', 'NEWLINE',
+        'ENDMARKER',
+    ]  # yapf: disable
+    self.assertEqual(expected_names, collector.all_node_names)
+    self.assertEqual([], collector.name_node_values)
+
   def testDumper(self):
     # PyTreeDumper is mainly a debugging utility, so only do basic sanity
     # checking.
@@ -116,5 +161,75 @@ class PytreeVisitorTest(unittest.TestCase):
     self.assertIn("EQUAL(Leaf(EQUAL, '='))", dump_output)
 
 
+class RunPassesTest(unittest.TestCase):
+
+  def testPassesShareWalk(self):
+    tree = pytree_utils.ParseCodeToTree('foo = bar\n')
+    log = []
+    pytree_visitor.RunPasses(tree, [
+        _HookRecorder('first', log),
+        _HookRecorder('second', log, runs_after=('first',)),
+    ])
+    self.assertEqual([
+        ('first', 'enter', 'foo = bar'),
+        ('second', 'enter', 'foo = bar'),
+        ('first', 'enter', 'foo'),
+        ('second', 'enter', 'foo'),
+        ('first', 'enter', 'bar'),
+        ('second', 'enter', 'bar'),
+        ('first', 'leave', 'foo = bar'),
+        ('second', 'leave', 'foo = bar'),
+        ('first', 'finish'),
+        ('second', 'finish'),
+    ], log)
+
+  def testPassRunsAfterWalk(self):
+    tree = pytree_utils.ParseCodeToTree('foo = bar\n')
+    log = []
+    pytree_visitor.RunPasses(tree, [
+        _HookRecorder('first', log),
+        _HookRecorder('second', log, runs_after_walk=('first',)),
+        _HookRecorder('third', log, runs_after=('first',)),
+    ])
+    self.assertEqual([
+        ('first', 'enter', 'foo = bar'),
+        ('third', 'enter', 'foo = bar'),
+        ('first', 'enter', 'foo'),
+        ('third', 'enter', 'foo'),
+        ('first', 'enter', 'bar'),
+        ('third', 'enter', 'bar'),
+        ('first', 'leave', 'foo = bar'),
+        ('third', 'leave', 'foo = bar'),
+        ('first', 'finish'),
+        ('third', 'finish'),
+        ('second', 'enter', 'foo = bar'),
+        ('second', 'enter', 'foo'),
+        ('second', 'enter', 'bar'),
+        ('second', 'leave', 'foo = bar'),
+        ('second', 'finish'),
+    ], log)
+
+  def testSkip(self):
+    tree = pytree_utils.ParseCodeToTree('foo = bar\nbaz = x\n')
+    log = []
+    skipper = _HookRecorder('skipper', log)
+    skipper.Skip(tree.children[0])
+    pytree_visitor.RunPasses(tree, [skipper, _HookRecorder('other', log)])
+    self.assertEqual(
+        ['baz = x', 'baz', 'x'],
+        [entry[2] for entry in log if entry[:2] == ('skipper', 'enter')])
+    self.assertEqual(
+        ['foo = bar', 'foo', 'bar', 'baz = x', 'baz', 'x'],
+        [entry[2] for entry in log if entry[:2] == ('other', 'enter')])
+
+  def testPassGivenBeforeItsDependency(self):
+    tree = pytree_utils.ParseCodeToTree('foo = bar\n')
+    with self.assertRaises(ValueError):
+      pytree_visitor.RunPasses(tree, [
+          _HookRecorder('second', [], runs_after=('first',)),
+          _HookRecorder('first', []),
+      ])
+
+
 if __name__ == '__main__':
   unittest.main()
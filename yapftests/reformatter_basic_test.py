@@ -3896,6 +3896,13 @@ s = 'foo \\
     uwlines = yapf_test_helper.ParseAndUnwrap(code)
     self.assertCodeEqual(code, reformatter.Reformat(uwlines))
 
+  def testDictionaryInLambdaDefault(self):
+    code = textwrap.dedent("""\
+        f = lambda x={'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa': 1, 'bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb': 2}: x
+        """)
+    uwlines = yapf_test_helper.ParseAndUnwrap(code)
+    self.assertCodeEqual(code, reformatter.Reformat(uwlines))
+
   def testNotInParams(self):
     unformatted_code = textwrap.dedent("""\
         list("a long line to break the line. a long line to break the brk a long lin", not True)
@@ -4184,6 +4191,115 @@ s = 'foo \\
     finally:
       style.SetGlobalStyle(style.CreateChromiumStyle())
 
+  def testLongListOfNumbers(self):
+    unformatted_code = textwrap.dedent("""\
+        def f():
+          return [0, 37, 74, 111, 148, 185, 222, 259, 296, 333, 370, 407, 444, 481, 518, 555, 592, 629, 666, 703, 740, 777, 814, 851, 888, 925, 962, 999, 36, 73, 110, 147, 184, 221, 258, 295, 332, 369, 406, 443, 480, 517, 554, 591, 628, 665, 702, 739, 776, 813, 850, 887, 924, 961, 998, 35, 72, 109, 146, 183, 220, 257, 294, 331, 368, 405, 442, 479, 516, 553]
+        """)
+    expected_formatted_code = textwrap.dedent("""\
+        def f():
+          return [
+              0, 37, 74, 111, 148, 185, 222, 259, 296, 333, 370, 407, 444, 481, 518,
+              555, 592, 629, 666, 703, 740, 777, 814, 851, 888, 925, 962, 999, 36, 73,
+              110, 147, 184, 221, 258, 295, 332, 369, 406, 443, 480, 517, 554, 591, 628,
+              665, 702, 739, 776, 813, 850, 887, 924, 961, 998, 35, 72, 109, 146, 183,
+              220, 257, 294, 331, 368, 405, 442, 479, 516, 553
+          ]
+        """)
+    uwlines = yapf_test_helper.ParseAndUnwrap(unformatted_code)
+    self.assertCodeEqual(expected_formatted_code, reformatter.Reformat(uwlines))
+
+  def testLongDictWithSplitEntries(self):
+    unformatted_code = textwrap.dedent("""\
+        x = {
+            'key_0': some_function_name(argument_0, other_argument, third_argument, fourth),
+            'key_1': some_function_name(argument_1, other_argument, third_argument, fourth),
+            'key_2': some_function_name(argument_2, other_argument, third_argument, fourth),
+            'key_3': some_function_name(argument_3, other_argument, third_argument, fourth),
+        }
+        """)
+    expected_formatted_code = textwrap.dedent("""\
+        x = {
+            'key_0':
+                some_function_name(argument_0, other_argument, third_argument, fourth),
+            'key_1':
+                some_function_name(argument_1, other_argument, third_argument, fourth),
+            'key_2':
+                some_function_name(argument_2, other_argument, third_argument, fourth),
+            'key_3':
+                some_function_name(argument_3, other_argument, third_argument, fourth),
+        }
+        """)
+    uwlines = yapf_test_helper.ParseAndUnwrap(unformatted_code)
+    self.assertCodeEqual(expected_formatted_code, reformatter.Reformat(uwlines))
+
+  def testSearchDominancePruning(self):
+    # The search for this line grows large enough that states could be
+    # compared by their columns (see reformatter._DominanceTable).
+    unformatted_code = 'y = %s\n' % ' + '.join(
+        'f(a%d) * g(b%d)' % (i, i) for i in range(50))
+
+    dominance_table = reformatter._DominanceTable
+    tables = []
+
+    def DominanceTable():
+      tables.append(dominance_table())
+      return tables[-1]
+
+    reformatter._DominanceTable = DominanceTable
+    try:
+      results = {}
+      for pruning in (False, True):
+        del tables[:]
+        google_style = style.CreateGoogleStyle()
+        google_style['SEARCH_DOMINANCE_PRUNING'] = pruning
+        style.SetGlobalStyle(google_style)
+        uwlines = yapf_test_helper.ParseAndUnwrap(unformatted_code)
+        line_stats = []
+        formatted_code = reformatter.Reformat(uwlines, line_stats=line_stats)
+        self.assertEqual(1 if pruning else 0, len(tables))
+        results[pruning] = formatted_code, line_stats[0].popped
+    finally:
+      reformatter._DominanceTable = dominance_table
+      style.SetGlobalStyle(style.CreateChromiumStyle())
+
+    # Pruning drops states, and with them the layout the full search finds.
+    self.assertLess(results[True][1], results[False][1])
+    self.assertNotEqual(results[True][0], results[False][0])
+    for formatted_code, _ in results.values():
+      compile(formatted_code, '<string>', 'exec')
+
+  def testIncumbentLayoutOnlyForLargeSearches(self):
+    small_code = textwrap.dedent("""\
+        y = [f(a), g(b), h(c), f(a), g(b), h(c), f(a), g(b), h(c), f(a), g(b), h(c), f(a), g(b)]
+        """)
+    large_code = 'x = {\n%s}\n' % ''.join(
+        "    'key_%d': some_function_name(argument_%d, other_argument, "
+        "third_argument, fourth),\n" % (i, i) for i in range(80))
+    expected_large_code = 'x = {\n%s}\n' % ''.join(
+        "    'key_%d':\n"
+        "        some_function_name(argument_%d, other_argument, third_argument, "
+        "fourth),\n" % (i, i) for i in range(80))
+
+    incumbent_layout = reformatter._IncumbentLayout
+    scored_lines = []
+
+    def IncumbentLayout(initial_state):
+      scored_lines.append(initial_state.line.first.lineno)
+      return incumbent_layout(initial_state)
+
+    reformatter._IncumbentLayout = IncumbentLayout
+    try:
+      uwlines = yapf_test_helper.ParseAndUnwrap(small_code)
+      reformatter.Reformat(uwlines)
+      self.assertEqual([], scored_lines)
+
+      uwlines = yapf_test_helper.ParseAndUnwrap(large_code)
+      self.assertCodeEqual(expected_large_code, reformatter.Reformat(uwlines))
+      self.assertEqual([1], scored_lines)
+    finally:
+      reformatter._IncumbentLayout = incumbent_layout
+
 
 if __name__ == '__main__':
   unittest.main()
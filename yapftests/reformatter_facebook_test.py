@@ -427,6 +427,26 @@ if (
     uwlines = yapf_test_helper.ParseAndUnwrap(unformatted_code)
     self.assertCodeEqual(expected_formatted_code, reformatter.Reformat(uwlines))
 
+  def testPackedListOfStrings(self):
+    unformatted_code = textwrap.dedent("""\
+        def f():
+            return foo.bar(['string0', 'string1', 'string2', 'string3', 'string4', 'string5', 'string6', 'string7', 'string8', 'string9', 'string10', 'string11', 'string12', 'string13', 'string14', 'string15', 'string16', 'string17', 'string18', 'string19', 'string20', 'string21', 'string22', 'string23'])
+        """)
+    expected_formatted_code = textwrap.dedent("""\
+        def f():
+            return foo.bar(
+                [
+                    'string0', 'string1', 'string2', 'string3', 'string4', 'string5',
+                    'string6', 'string7', 'string8', 'string9', 'string10', 'string11',
+                    'string12', 'string13', 'string14', 'string15', 'string16',
+                    'string17', 'string18', 'string19', 'string20', 'string21',
+                    'string22', 'string23'
+                ]
+            )
+        """)
+    uwlines = yapf_test_helper.ParseAndUnwrap(unformatted_code)
+    self.assertCodeEqual(expected_formatted_code, reformatter.Reformat(uwlines))
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -254,6 +254,51 @@ class SplitPenaltyTest(unittest.TestCase):
         (')', VERY_STRONGLY_CONNECTED),
     ])
 
+  def testNestedIncreases(self):
+    # The increases to the tokens of an or_test inside a trailer inside a
+    # subscript add up the same no matter in which order they're applied.
+    code = 'x[f(a or b).c or d[e and g]]\n'
+    tree = self._ParseAndComputePenalties(code)
+    self._CheckPenalties(tree, [
+        ('x', None),
+        ('[', UNBREAKABLE),
+        ('f', 3000),
+        ('(', UNBREAKABLE),
+        ('a', 4000),
+        ('or', 4000),
+        ('b', 5000),
+        (')', 4500),
+        ('.', 4000),
+        ('c', 5000),
+        ('or', 0),
+        ('d', 4000),
+        ('[', 1001000),
+        ('e', 4000),
+        ('and', 1000),
+        ('g', 5100),
+        (']', 1001000),
+        (']', UNBREAKABLE),
+    ])
+
+    code = 'x[a or b[c(d or e)]]\n'
+    tree = self._ParseAndComputePenalties(code)
+    self._CheckPenalties(tree, [
+        ('x', None),
+        ('[', UNBREAKABLE),
+        ('a', 3000),
+        ('or', 0),
+        ('b', 4000),
+        ('[', 1001000),
+        ('c', 4000),
+        ('(', UNBREAKABLE),
+        ('d', 4000),
+        ('or', 4000),
+        ('e', 5000),
+        (')', 4500),
+        (']', 1001000),
+        (']', UNBREAKABLE),
+    ])
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -256,11 +256,11 @@ class StyleFromCommandLine(unittest.TestCase):
 
   def testDefaultBasedOnExplicitlyUnicodeTypeString(self):
     cfg = style.CreateStyleFromConfig(u'{}')
-    self.assertIsInstance(cfg, dict)
+    self.assertIsInstance(cfg, style.Style)
 
   def testDefaultBasedOnDetaultTypeString(self):
     cfg = style.CreateStyleFromConfig('{}')
-    self.assertIsInstance(cfg, dict)
+    self.assertIsInstance(cfg, style.Style)
 
   def testDefaultBasedOnStyleBadString(self):
     self.assertRaisesRegexp(style.StyleConfigError, 'Unknown style option',
@@ -281,5 +281,41 @@ class StyleHelp(unittest.TestCase):
     self.assertListEqual(settings, expected)
 
 
+class CompiledStyleTest(unittest.TestCase):
+
+  def testOptionsAreAttributes(self):
+    cfg = style.CreateStyleFromConfig('chromium')
+    self.assertEqual(2, cfg.INDENT_WIDTH)
+    self.assertEqual(2, cfg['INDENT_WIDTH'])
+    self.assertEqual(style.CreateChromiumStyle(), cfg)
+    self.assertEqual(cfg, style.CreateStyleFromConfig(cfg))
+
+  def testImmutable(self):
+    cfg = style.CreateStyleFromConfig('pep8')
+    with self.assertRaises(AttributeError):
+      cfg.INDENT_WIDTH = 2
+    with self.assertRaises(TypeError):
+      cfg['INDENT_WIDTH'] = 2
+
+    derived = cfg.AsDict()
+    derived['INDENT_WIDTH'] = 2
+    self.assertEqual(4, cfg.INDENT_WIDTH)
+    self.assertEqual(2, style.Style(derived).INDENT_WIDTH)
+
+  def testDerivedValues(self):
+    cfg = style.CreateStyleFromConfig('google')
+    self.assertTrue(cfg.i18n_comment_regex.match('#.Translators'))
+    self.assertEqual(frozenset(['N_', '_']), cfg.i18n_function_calls)
+
+    cfg = style.CreateStyleFromConfig('pep8')
+    self.assertIsNone(cfg.i18n_comment_regex)
+    self.assertEqual(frozenset(), cfg.i18n_function_calls)
+
+  def testUnknownOption(self):
+    with self.assertRaisesRegexp(style.StyleConfigError,
+                                 'Unknown style option'):
+      style.Style(dict(style.CreatePEP8Style(), NO_SUCH_OPTION=True))
+
+
 if __name__ == '__main__':
   unittest.main()
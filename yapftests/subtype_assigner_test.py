@@ -13,6 +13,8 @@
 # limitations under the License.
 """Tests for yapf.subtype_assigner."""
 
+import functools
+import operator
 import textwrap
 import unittest
 
@@ -29,7 +31,8 @@ class SubtypeAssignerTest(yapf_test_helper.YAPFTest):
 
     Args:
       uwlines: list of UnwrappedLine.
-      list_of_expected: list of (name, subtype) pairs. Non-semantic tokens are
+      list_of_expected: list of (name, subtypes) pairs, where subtypes is a
+        collection of format_token.Subtype flags. Non-semantic tokens are
         filtered out from the expected values.
     """
     actual = []
@@ -40,7 +43,10 @@ class SubtypeAssignerTest(yapf_test_helper.YAPFTest):
       if filtered_values:
         actual.append(filtered_values)
 
-    self.assertEqual(list_of_expected, actual)
+    expected = [[(value, functools.reduce(operator.or_, subtypes))
+                 for value, subtypes in line]
+                for line in list_of_expected]
+    self.assertEqual(expected, actual)
 
   def testFuncDefDefaultAssign(self):
     code = textwrap.dedent(r"""
@@ -59,6 +59,240 @@ class FormatCodeTest(unittest.TestCase):
         """)
     self._Check(unformatted_code, expected_formatted_code)
 
+  def testSearchBeamWidth(self):
+    unformatted_code = 'x = [%s]\n' % ', '.join('-%d' % i for i in range(60))
+    expected_formatted_code, _ = yapf_api.FormatCode(
+        unformatted_code, style_config='chromium')
+
+    messages = []
+    formatted_code, _ = yapf_api.FormatCode(
+        unformatted_code,
+        filename='foo.py',
+        style_config='chromium',
+        search_beam_width=5,
+        logger=messages.append)
+    self.assertEqual(expected_formatted_code, formatted_code)
+    self.assertEqual(1, len(messages))
+    self.assertTrue(messages[0].startswith('foo.py: line 1: '))
+
+    messages = []
+    yapf_api.FormatCode(
+        unformatted_code,
+        style_config='{based_on_style: chromium, search_beam_width: 5}',
+        logger=messages.append)
+    self.assertEqual(1, len(messages))
+
+  def testLineStats(self):
+    unformatted_code = textwrap.dedent("""\
+        x = 1
+        y = [f(a), g(b), h(c), f(a), g(b), h(c), f(a), g(b), h(c), f(a), g(b), h(c), f(a), g(b)]
+        """)
+    expected_formatted_code, _ = yapf_api.FormatCode(
+        unformatted_code, style_config='pep8')
+
+    result = yapf_api.FormatCode(unformatted_code, style_config='pep8')
+    self.assertIsNone(result.line_stats)
+
+    result = yapf_api.FormatCode(
+        unformatted_code, style_config='pep8', collect_line_stats=True)
+    self.assertEqual(expected_formatted_code, result.reformatted_source)
+    self.assertTrue(result.changed)
+    self.assertEqual(1, len(result.line_stats))
+    stats = result.line_stats[0]
+    self.assertEqual(2, stats.lineno)
+    self.assertGreater(stats.pushed, 0)
+    self.assertGreaterEqual(stats.pushed, stats.popped)
+    self.assertGreaterEqual(stats.popped, stats.seen_hits)
+    self.assertGreater(stats.peak_queue_size, 0)
+    self.assertGreaterEqual(stats.seconds, 0)
+    self.assertFalse(stats.fell_back)
+
+  def testLineStatsOfLongDictWithSplitEntries(self):
+    # Every entry must be split before, so the search can forget how it got to
+    # each one (see reformatter._ResetPoints).
+    unformatted_code = 'x = {\n%s}\n' % ''.join(
+        "    'key_%d': some_function_name(argument_%d, other_argument, "
+        "third_argument, fourth),\n" % (i, i) for i in range(80))
+    for style_name, expected_counts in (('chromium', (1810, 1809, 203)),
+                                        ('pep8', (964, 723, 0))):
+      line_stats = yapf_api.FormatCode(
+          unformatted_code, style_config=style_name,
+          collect_line_stats=True).line_stats
+      self.assertEqual(1, len(line_stats))
+      stats = line_stats[0]
+      self.assertEqual(expected_counts,
+                       (stats.pushed, stats.popped, stats.seen_hits))
+
+  def testTimeLimits(self):
+    unformatted_code = textwrap.dedent("""\
+        x = 1
+        y = [f(a), g(b), h(c), f(a), g(b), h(c), f(a), g(b), h(c), f(a), g(b), h(c), f(a), g(b)]
+        z = [f(a), g(b), h(c), f(a), g(b), h(c), f(a), g(b), h(c), f(a), g(b), h(c), f(a), g(b)]
+        """)
+    for limits in (dict(line_time_limit=1e-9), dict(file_time_limit=1e-9)):
+      messages = []
+      formatted_code, _ = result = yapf_api.FormatCode(
+          unformatted_code,
+          style_config='pep8',
+          logger=messages.append,
+          collect_line_stats=True,
+          **limits)
+      line_stats = result.line_stats
+      self.assertEqual([2, 3], [stats.lineno for stats in line_stats])
+      self.assertTrue(all(stats.timed_out for stats in line_stats))
+      self.assertFalse(any(stats.fell_back for stats in line_stats))
+      self.assertEqual(2, len(messages))
+      self.assertTrue('search time limit reached' in messages[0])
+      self.assertTrue(
+          all(len(line) <= 79 for line in formatted_code.splitlines()))
+      compile(formatted_code, '<string>', 'exec')
+
+    formatted_code, _ = yapf_api.FormatCode(
+        unformatted_code,
+        style_config='{based_on_style: pep8, search_line_time_limit: 60}')
+    self.assertEqual(
+        yapf_api.FormatCode(unformatted_code, style_config='pep8'),
+        (formatted_code, True))
+
+  def testCacheDir(self):
+    unformatted_code = textwrap.dedent("""\
+        def f(a,b):  # comment
+          return {'a':a,
+                  'b':b}
+        """)
+    expected_formatted_code, _ = yapf_api.FormatCode(
+        unformatted_code, style_config='chromium')
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+      for _ in range(2):
+        formatted_code, _ = yapf_api.FormatCode(
+            unformatted_code, style_config='chromium', cache_dir=cache_dir)
+        self.assertEqual(expected_formatted_code, formatted_code)
+        self.assertEqual(1, len(os.listdir(cache_dir)))
+
+      # A setting the cached passes depend on needs its own entry.
+      yapf_api.FormatCode(
+          unformatted_code,
+          style_config='{based_on_style: chromium, '
+          'indent_dictionary_value: false}',
+          cache_dir=cache_dir)
+      self.assertEqual(2, len(os.listdir(cache_dir)))
+
+      # A corrupt entry is a miss.
+      for name in os.listdir(cache_dir):
+        with open(os.path.join(cache_dir, name), 'wb') as fd:
+          fd.write(b'garbage')
+      formatted_code, _ = yapf_api.FormatCode(
+          unformatted_code, style_config='chromium', cache_dir=cache_dir)
+      self.assertEqual(expected_formatted_code, formatted_code)
+    finally:
+      shutil.rmtree(cache_dir)
+
+  def testLinesOnlyFormatTheirStatements(self):
+    unformatted_code = textwrap.dedent("""\
+        def f(a,b):
+            return [aaaaaaaaaaaaaaaaaaaa, bbbbbbbbbbbbbbbbbbbbbb, cccccccccccccccccccc]
+        x = {  'a':37,'b':42,
+        'c':927}
+
+        y = 'hello ''world'
+        class foo  (  object  ):
+            pass
+        """)
+    expected_formatted_code = textwrap.dedent("""\
+        def f(a,b):
+            return [aaaaaaaaaaaaaaaaaaaa, bbbbbbbbbbbbbbbbbbbbbb, cccccccccccccccccccc]
+
+
+        x = {'a': 37, 'b': 42, 'c': 927}
+
+        y = 'hello ''world'
+        class foo  (  object  ):
+            pass
+        """)
+    formatted_code, _ = yapf_api.FormatCode(
+        unformatted_code, style_config='chromium', lines=[(3, 4)])
+    self.assertEqual(expected_formatted_code, formatted_code)
+
+  def testDeeplyNestedExpression(self):
+    # Nested deeper than the recursion limit.
+    depth = sys.getrecursionlimit()
+    unformatted_code = 'x = (' + 'not ' * depth + 'y  # comment\n)\n'
+    expected_formatted_code = ('x = (\n    ' + 'not ' * depth +
+                               'y  # comment\n)\n')
+    self._Check(unformatted_code, expected_formatted_code)
+
+  def testGlobalStyleIsUnchanged(self):
+    global_style = style.Current()
+    yapf_api.FormatCode('x = 1\n', style_config='{indent_width: 7}')
+    self.assertIs(global_style, style.Current())
+
+  def testFormatCodeConcurrent(self):
+    unformatted_sources = [
+        'if True:\n pass\n',
+        'x = 1\n',
+        'def f(a,b):\n return a\n',
+    ]
+    results = yapf_api.FormatCodeConcurrent(
+        unformatted_sources, style_config='chromium', max_workers=2)
+    self.assertEqual([
+        yapf_api.FormatCode(source, style_config='chromium')
+        for source in unformatted_sources
+    ], results)
+    self.assertEqual(
+        [True, False, True], [changed for _, changed in results])
+
+  def testFormatCodeConcurrentWithLinesAndLineStats(self):
+    unformatted_sources = [
+        'x = [1,2]\ny = [3,4]\n',
+        'z = [%s]\n' % ', '.join(str(i) for i in range(30)),
+    ]
+    lines = [[(2, 2)], None]
+    results = yapf_api.FormatCodeConcurrent(
+        unformatted_sources,
+        style_config='chromium',
+        lines=lines,
+        collect_line_stats=True,
+        max_workers=2)
+    self.assertEqual('x = [1,2]\ny = [3, 4]\n', results[0].reformatted_source)
+    for source, source_lines, result in zip(unformatted_sources, lines,
+                                            results):
+      expected = yapf_api.FormatCode(
+          source,
+          style_config='chromium',
+          lines=source_lines,
+          collect_line_stats=True)
+      self.assertEqual(expected, result)
+      self.assertEqual([stats.lineno for stats in expected.line_stats],
+                       [stats.lineno for stats in result.line_stats])
+
+  def testThreadsWithDifferentStyles(self):
+    import threading  # pylint: disable=g-import-not-at-top
+
+    unformatted_code = 'if True:\n pass\n'
+    results = {}
+
+    def Format(indent_width):
+      for _ in range(20):
+        formatted_code, _ = yapf_api.FormatCode(
+            unformatted_code,
+            style_config='{based_on_style: pep8, indent_width: %d}' %
+            indent_width)
+        results.setdefault(indent_width, set()).add(formatted_code)
+
+    threads = [
+        threading.Thread(target=Format, args=(width,)) for width in (2, 4, 8)
+    ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    for width in (2, 4, 8):
+      self.assertEqual(
+          set(['if True:\n%spass\n' % (' ' * width)]), results[width])
+
 
 class FormatFileTest(unittest.TestCase):
 
@@ -223,7 +457,8 @@ class FormatFileTest(unittest.TestCase):
          pass
         """)
     with utils.TempFileContents(self.test_tmpdir, unformatted_code) as filepath:
-      diff, _, _ = yapf_api.FormatFile(filepath, print_diff=True)
+      diff, _, _ = yapf_api.FormatFile(
+          filepath, style_config='chromium', print_diff=True)
       self.assertTrue(u'+  pass' in diff)
 
   def testFormatFileInPlace(self):
@@ -912,13 +1147,13 @@ class CommandLineTest(unittest.TestCase):
         """)
     expected_formatted_code = textwrap.dedent("""\
         def horrible():
-            oh_god()
-            why_would_you()
-            [
-               'do',
+          oh_god()
+          why_would_you()
+          [
+             'do',
 
-                'that',
-            ]
+              'that',
+          ]
 
         def still_horrible():
             oh_god()
@@ -1227,6 +1462,23 @@ INDENT_WIDTH=1
           expected_formatted_code,
           extra_options=['--style={0}'.format(stylepath)])
 
+  def testReportSlowLines(self):
+    unformatted_code = textwrap.dedent(u"""\
+        x = 1
+        y = [f(a), g(b), h(c), f(a), g(b), h(c), f(a), g(b), h(c), f(a), g(b), h(c), f(a), g(b)]
+        """)
+    with utils.TempFileContents(
+        self.test_tmpdir, unformatted_code, suffix='.py') as filepath:
+      p = subprocess.Popen(
+          YAPF_BINARY + ['--report-slow-lines=0', filepath],
+          stdout=subprocess.PIPE,
+          stderr=subprocess.PIPE)
+      _, stderrdata = p.communicate()
+    report = stderrdata.decode('utf-8').splitlines()
+    self.assertEqual(1, len(report))
+    self.assertTrue(report[0].startswith('{0}:2: '.format(filepath)))
+    self.assertIn(' pushed, ', report[0])
+
   def testSpacingBeforeComments(self):
     unformatted_code = textwrap.dedent("""\
         A = 42